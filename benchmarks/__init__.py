@@ -0,0 +1,7 @@
+"""Benchmarks for Taswira.
+
+Run a benchmark as a module from the root of the repository, e.g.
+`python -m benchmarks.metadata`. `python -m benchmarks.suite` runs the whole
+pipeline on synthetic GCBM output and writes its measurements as JSON, for
+tracking them between releases (see `--help` for its scale).
+"""
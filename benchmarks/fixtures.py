@@ -0,0 +1,127 @@
+"""Generators of synthetic GCBM-like output."""
+import random
+import sqlite3
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+INDICATOR_TABLES = {
+    "v_flux_indicator_aggregates": "flux_tc",
+    "v_flux_indicators": "flux_tc",
+    "v_pool_indicators": "pool_tc",
+    "v_stock_change_indicators": "flux_tc",
+}
+
+
+def make_results_db(path,
+                    n_indicators=40,
+                    n_years=100,
+                    n_rows=1000000,
+                    start_year=2000,
+                    seed=0):
+    """Creates a compiled GCBM results DB filled with random values.
+
+    Rows are spread evenly over the indicator tables, and each indicator is
+    only present in one of them, as in real GCBM output.
+
+    Args:
+        path: Path of the DB to create.
+        n_indicators: Number of distinct indicators.
+        n_years: Number of simulation years.
+        n_rows: Total number of rows in the indicator tables.
+        start_year: First simulation year.
+        seed: Seed for the random number generator.
+
+    Returns:
+        A list of configs, one for each indicator.
+    """
+    rand = random.Random(seed)
+    tables = list(INDICATOR_TABLES.items())
+    years = range(start_year, start_year + n_years)
+    indicators = [f"Indicator {i}" for i in range(n_indicators)]
+
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE v_age_indicators "
+                     "(year INTEGER, age_range TEXT, area REAL)")
+        conn.executemany("INSERT INTO v_age_indicators VALUES (?, ?, ?)",
+                         [(year, "0-20", 1.0) for year in years])
+
+        for table, value_col in tables:
+            conn.execute(f"CREATE TABLE {table} (indicator TEXT, "
+                         f"year INTEGER, area REAL, {value_col} REAL)")
+
+        rows_per_indicator = max(n_rows // n_indicators, 1)
+        for i, indicator in enumerate(indicators):
+            table, _ = tables[i % len(tables)]
+            conn.executemany(
+                f"INSERT INTO {table} VALUES (?, ?, ?, ?)",
+                ((indicator, start_year + j % n_years, 1.0, rand.random())
+                 for j in range(rows_per_indicator)))
+
+    return [{
+        "database_indicator": indicator,
+        "file_pattern": f"{indicator.replace(' ', '_')}_*.tiff",
+        "palette": "Greens",
+    } for indicator in indicators]
+
+
+def make_rasters(rasterdir,
+                 configs,
+                 n_years=100,
+                 size=1024,
+                 start_year=2000,
+                 seed=0):
+    """Writes a GCBM-like raster file for every indicator and year.
+
+    Rasters are float32 GeoTIFFs with the profile GCBM is recommended to use
+    (tiled, ZSTD-compressed, without overviews), covering the same area.
+    Their values are a gradient plus noise, with 10% of the pixels set to
+    nodata. They're written a strip at a time, so any size fits in memory.
+
+    Args:
+        rasterdir: Path to directory for saving the rasters.
+        configs: List of indicator configs, as returned by
+            `make_results_db()`.
+        n_years: Number of simulation years.
+        size: Width and height of the rasters in pixels.
+        start_year: First simulation year.
+        seed: Seed for the random number generator.
+
+    Returns:
+        List of paths to the written rasters.
+    """
+    rng = np.random.default_rng(seed)
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'nodata': -1,
+        'width': size,
+        'height': size,
+        'count': 1,
+        'crs': 'epsg:4326',
+        'transform': rasterio.transform.from_origin(-119.3, 50.0, 0.01, 0.01),
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+        'compress': 'ZSTD',
+        'zstd_level': 1,
+        'bigtiff': 'YES',
+    }
+    strip_height = 256
+    paths = []
+    for config in configs:
+        name = config['file_pattern'].replace('*.tiff', '')
+        for year in range(start_year, start_year + n_years):
+            path = f"{rasterdir}/{name}{year}.tiff"
+            with rasterio.open(path, 'w', **profile) as dst:
+                for row in range(0, size, strip_height):
+                    height = min(strip_height, size - row)
+                    data = (np.linspace(0, 100, size, dtype='float32') +
+                            rng.random((height, size), dtype='float32') * 10 +
+                            year - start_year)
+                    data[rng.random((height, size)) < 0.1] = -1
+                    dst.write(data, 1, window=Window(0, row, size, height))
+            paths.append(path)
+
+    return paths
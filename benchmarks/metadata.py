@@ -0,0 +1,92 @@
+"""Benchmark of metadata extraction from a compiled GCBM results DB.
+
+Compares `get_metadata()`, with and without a snapshot of the results DB,
+with the former implementation that queried each indicator separately.
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from taswira.scripts import get_config, update_config
+from taswira.scripts.metadata import (RESULTS_TABLES, get_metadata,
+                                      get_snapshot)
+
+from .fixtures import make_results_db
+
+
+def _get_metadata_per_indicator(db_results):
+    """The former, one indicator at a time, implementation."""
+    metadata = {}
+    conn = sqlite3.connect(db_results)
+    for config in get_config():
+        indicator = config['database_indicator']
+        table = value_col = None
+        for table_, value_col_ in RESULTS_TABLES.items():
+            if conn.execute(f"SELECT 1 FROM {table_} WHERE indicator = ?",
+                            [indicator]).fetchone():
+                table, value_col = table_, value_col_
+                break
+        if table is None:
+            continue
+
+        start_year, end_year = conn.execute(
+            "SELECT MIN(year), MAX(year) from v_age_indicators").fetchone()
+        metadata[indicator] = dict(
+            conn.execute(f"""
+            SELECT years.year, COALESCE(SUM(i.{value_col}), 0) AS value
+            FROM (SELECT DISTINCT year FROM v_age_indicators) AS years
+            LEFT JOIN {table} i
+                ON years.year = i.year
+            WHERE i.indicator = ?
+                AND (years.year BETWEEN {start_year} AND {end_year})
+            GROUP BY years.year
+        """, [indicator]).fetchall())
+    conn.close()
+    return metadata
+
+
+def _time(func, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--indicators", type=int, default=40)
+    parser.add_argument("--years", type=int, default=100)
+    parser.add_argument("--rows", type=int, default=1000000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        db_results = os.path.join(tmpdirname, 'results.db')
+        update_config(
+            make_results_db(db_results, args.indicators, args.years,
+                            args.rows))
+
+        baseline = _time(_get_metadata_per_indicator, db_results)
+        batched = _time(get_metadata, db_results)
+
+        start = time.perf_counter()
+        get_snapshot(db_results, tmpdirname)
+        snapshot_build = time.perf_counter() - start
+        snapshot = _time(get_metadata, db_results, tmpdirname)
+
+    print(f"{args.indicators} indicators, {args.years} years, "
+          f"{args.rows} rows")
+    print(f"per-indicator queries: {baseline:.3f}s")
+    print(f"batched query:         {batched:.3f}s")
+    print(f"speedup:               {baseline / batched:.1f}x")
+    print(f"snapshot build:        {snapshot_build:.3f}s")
+    print(f"snapshot query:        {snapshot:.3f}s")
+    print(f"speedup:               {baseline / snapshot:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
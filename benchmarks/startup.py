@@ -0,0 +1,44 @@
+"""Benchmark of the startup time of the CLI.
+
+Times fresh interpreters running `taswira --help`, importing the modules
+needed for ingestion only, and importing the UI, which the former two avoid.
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+COMMANDS = {
+    'taswira --help': ("import sys; sys.argv = ['taswira', '--help']; "
+                       "import taswira; taswira.main()"),
+    'ingestion imports': "import taswira.scripts.ingestion",
+    'UI imports': "import taswira.app",
+}
+
+
+def _time(code, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code],
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL,
+                       check=False)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = _time("pass", args.repeat)
+    print(f"{'interpreter':<20} {baseline:.3f}s")
+    for name, code in COMMANDS.items():
+        print(f"{name:<20} {_time(code, args.repeat):.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""Benchmark suite of ingestion and serving.
+
+Synthesizes GCBM-like output at the given scale and measures:
+
+- ingestion with `taswira ingest --out`: wall time and peak RSS
+- extraction of indicator values from the results DB
+- startup of `taswira serve`, until the UI responds
+- latency of tile requests, first when they're rendered, then when cached
+
+Results are written as JSON, so they can be compared between releases.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import mercantile
+import numpy as np
+from terracotta import get_driver
+
+import taswira
+from taswira.scripts import update_config
+from taswira.scripts.helpers import get_free_port
+from taswira.scripts.metadata import get_metadata, get_snapshot
+from taswira.tiles import get_tile_url
+
+from .fixtures import make_rasters, make_results_db
+
+TASWIRA = [sys.executable, '-c', 'import taswira; taswira.main()']
+STARTUP_TIMEOUT = 60  # seconds
+
+
+def _time(func, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _get_peak_rss():
+    """Returns the peak RSS of the terminated child processes in MB."""
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Reported in bytes on macOS, in KB elsewhere
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def _summarize(latencies):
+    if not latencies:
+        return {'count': 0}
+    latencies = np.array(latencies) * 1000
+    return {
+        'count': len(latencies),
+        'mean_ms': latencies.mean(),
+        'p50_ms': np.percentile(latencies, 50),
+        'p90_ms': np.percentile(latencies, 90),
+        'p99_ms': np.percentile(latencies, 99),
+        'max_ms': latencies.max(),
+    }
+
+
+def _get(url):
+    try:
+        with urllib.request.urlopen(url) as response:
+            response.read()
+            return response.getcode()
+    except urllib.error.HTTPError as err:
+        return err.code
+
+
+def bench_ingestion(config_path, rasterdir, db_results, outpath, jobs):
+    """Ingests the rasters with `taswira ingest --out` in a new process."""
+    start = time.perf_counter()
+    subprocess.run(TASWIRA + [
+        'ingest', config_path, rasterdir, db_results, '--out', outpath,
+        '--jobs',
+        str(jobs), '--allow-unoptimized'
+    ],
+                   stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL,
+                   check=True)
+    return {
+        'wall_time_s': time.perf_counter() - start,
+        'peak_rss_mb': _get_peak_rss(),
+    }
+
+
+def bench_metadata(db_results, repeat):
+    """Times `get_metadata()`, with and without a snapshot of the DB."""
+    with tempfile.TemporaryDirectory() as cachedir:
+        start = time.perf_counter()
+        get_snapshot(db_results, cachedir)
+        snapshot_build = time.perf_counter() - start
+        return {
+            'query_s': _time(get_metadata, db_results, repeat=repeat),
+            'snapshot_build_s': snapshot_build,
+            'snapshot_query_s': _time(get_metadata,
+                                      db_results,
+                                      cachedir,
+                                      repeat=repeat),
+        }
+
+
+def _get_tile_urls(dbpath, n_datasets, zoom):
+    driver = get_driver(dbpath, provider='sqlite')
+    with driver.connect():
+        datasets = sorted(driver.get_datasets())
+        step = max(len(datasets) // n_datasets, 1)
+        urls = []
+        for keys in datasets[::step][:n_datasets]:
+            metadata = driver.get_metadata(keys)
+            for tile in mercantile.tiles(*metadata['bounds'], zooms=[zoom]):
+                urls.append(
+                    get_tile_url(keys, metadata,
+                                 f'{tile.z}/{tile.x}/{tile.y}'))
+    return urls
+
+
+def bench_serving(dbpath, n_datasets, zoom):
+    """Starts `taswira serve` and requests tiles from it.
+
+    Prefetching is disabled, so the first requests of tiles always render
+    them. Only the latencies of successful requests are summarized, failed
+    ones are counted as `errors`.
+    """
+    port = get_free_port()
+    base_url = f'http://localhost:{port}'
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        TASWIRA +
+        ['serve', dbpath, '--port',
+         str(port), '--prefetch-years', '0'],
+        env=dict(os.environ, IN_DOCKER='1'),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                if _get(base_url + '/') == 200:
+                    break
+            except urllib.error.URLError:
+                pass
+            if time.perf_counter() - start > STARTUP_TIMEOUT:
+                raise RuntimeError("The server didn't start")
+            time.sleep(0.01)
+        startup = time.perf_counter() - start
+
+        results = {'startup_s': startup}
+        urls = _get_tile_urls(dbpath, n_datasets, zoom)
+        for name in ('rendered', 'cached'):
+            latencies = []
+            errors = 0
+            for url in urls:
+                start = time.perf_counter()
+                if _get(base_url + url) == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+            results[f'tiles_{name}'] = dict(_summarize(latencies),
+                                            errors=errors)
+        return results
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def _get_environment():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                  capture_output=True,
+                                  check=True,
+                                  text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return {
+        'taswira_version': taswira.__version__,
+        'git_revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+
+def main():
+    """Run the benchmarks and write the results."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--indicators", type=int, default=4)
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--size",
+                        type=int,
+                        default=1024,
+                        help="width and height of the rasters")
+    parser.add_argument("--rows",
+                        type=int,
+                        default=1000000,
+                        help="rows in the results DB")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--tile-datasets",
+                        type=int,
+                        default=5,
+                        help="number of datasets to request tiles of")
+    parser.add_argument("--zoom", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="benchmark-results.json")
+    args = parser.parse_args()
+
+    results = {
+        'environment': _get_environment(),
+        'parameters': {
+            k: v
+            for k, v in vars(args).items() if k != 'output'
+        },
+    }
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        print("Generating GCBM-like output...")
+        db_results = os.path.join(tmpdirname, 'results.db')
+        configs = make_results_db(db_results, args.indicators, args.years,
+                                  args.rows)
+        config_path = os.path.join(tmpdirname, 'config.json')
+        with open(config_path, 'w') as file:
+            json.dump(configs, file)
+        rasterdir = os.path.join(tmpdirname, 'rasters')
+        os.mkdir(rasterdir)
+        make_rasters(rasterdir, configs, args.years, args.size)
+
+        print("Ingesting...")
+        dbpath = os.path.join(tmpdirname, 'terracotta.sqlite')
+        results['ingestion'] = bench_ingestion(config_path, rasterdir,
+                                               db_results, dbpath, args.jobs)
+
+        print("Extracting indicator values...")
+        update_config(configs)
+        results['metadata'] = bench_metadata(db_results, args.repeat)
+
+        print("Serving...")
+        results['serving'] = bench_serving(dbpath, args.tile_datasets,
+                                           args.zoom)
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps(results, indent=2))
+
+    errors = sum(tiles['errors'] for name, tiles in results['serving'].items()
+                 if name.startswith('tiles_'))
+    if errors:
+        sys.exit(f"{errors} tile requests failed, the serving results "
+                 "aren't comparable")
+
+
+if __name__ == '__main__':
+    main()
@@ -45,6 +45,8 @@ setup(
     packages=find_packages(where='src'),
     python_requires=">=3.6",
     install_requires=[
+        # Kept exact, as drivers.py relies on Terracotta's private driver
+        # cache and raster executor
         "terracotta ==0.6.0",
         "dash ==1.13.3",
         "dash-leaflet ==0.0.19",
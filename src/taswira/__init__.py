@@ -1,9 +1,10 @@
 """A command-line tool for visualizing GCBM output."""
-from .scripts.console import console
 
 __version__ = "0.1.3"
 
 
 def main():
     """Entry point for the CLI"""
+    # Imported here, so importing the package doesn't import the whole CLI
+    from .scripts.console import console  # pylint: disable=import-outside-toplevel
     console()
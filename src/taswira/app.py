@@ -7,23 +7,97 @@ import dash_leaflet.express as dlx
 import plotly.graph_objects as go
 import terracotta as tc
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 from terracotta.handlers.colormap import colormap as get_colormap
 
+from .prefetch import DEFAULT_LAYER_LOOKAHEAD
+from .scripts.catalog import Catalog
+from .scripts.ingestion import get_status
+from .temporal import (DIVERGING_COLORMAP, get_temporal_stretch_range,
+                       get_temporal_tile_url)
+from .tiles import get_tile_url
+from .timeseries import CubeReader
+from .zonal import ZonalStats
+
 BASE_MAP_ATTRIBUTION = ('© <a href="https://www.openstreetmap.org/copyright">'
                         'OpenStreetMap</a> contributors')
 N_COLORBAR_ROWS = 6
+REFRESH_INTERVAL = 5000  # ms
+BUTTON_STYLE = {
+    'height': '30px',
+    'backgroundColor': '#fff',
+    'textAlign': 'center',
+    'borderRadius': '4px',
+    'border': '2px solid rgba(0,0,0,0.2)',
+    'fontWeight': 'bold'
+}
+TEMPORAL_OPTIONS = [
+    {'label': 'Change since', 'value': 'difference'},
+    {'label': 'Ratio to', 'value': 'ratio'},
+    {'label': 'Total since', 'value': 'sum'},
+]
+
+
+def _get_title_options(titles):
+    return [{'label': k, 'value': k} for k in titles]
+
+
+def _count_datasets(titles):
+    return sum(titles.values())
+
+
+def _is_ingesting(status):
+    return bool(status) and not status['finished'] and not status['error']
+
+
+def format_status(status):
+    """Formats the progress of ingestion for display.
+
+    Args:
+        status: dict returned by `get_status()`, or None.
+
+    Returns:
+        A string describing the progress, empty if ingestion is complete.
+    """
+    if not status:
+        return ''
+    if status['error']:
+        return status['error']
+    if status['finished']:
+        return ''
+    return f"Loading rasters: {status['processed']}/{status['total'] or '?'}"
+
+
+def get_stretch_range(metadata):
+    """Returns the range of values of an indicator over all years.
 
+    Args:
+        metadata: Sequence of metadata of the indicator's datasets.
+
+    Returns:
+        list of lower and upper limit.
+    """
+    stretch_ranges = [m['metadata'].get('stretch_range') for m in metadata]
+    if stretch_ranges[0] is not None and all(r == stretch_ranges[0]
+                                             for r in stretch_ranges):
+        return stretch_ranges[0]
+
+    # Still being ingested, so it's not been computed yet
+    lowers, uppers = list(zip(*[m['range'] for m in metadata]))
+    return [min(lowers), max(uppers)]
+
+
+def get_region_geometry(vertices):
+    """Converts the vertices of a region drawn on the map to GeoJSON.
+
+    Args:
+        vertices: List of latitude and longitude of the vertices.
 
-def _get_data():
-    driver = tc.get_driver(tc.get_settings().DRIVER_PATH)
-    data = {}
-    with driver.connect():
-        for k in driver.get_datasets():
-            title, year = k
-            if not title in data:
-                data[title] = {}
-            data[title][year] = driver.get_metadata(k)
-    return data
+    Returns:
+        dict of a GeoJSON Polygon.
+    """
+    ring = [[lon, lat] for lat, lon in vertices]
+    return {'type': 'Polygon', 'coordinates': [ring + ring[:1]]}
 
 
 def get_element_after(current_element, iterator):
@@ -72,39 +146,121 @@ def get_colorbar(stretch_range, colormap):
                                     position="bottomright")
 
 
-def get_app():
+def get_app(watch=False, layer_lookahead=DEFAULT_LAYER_LOOKAHEAD):
     """Create a new Dash instance with a Terracotta instance embedded in it.
 
+    Only the titles of the datasets are read from the DB's catalog up front,
+    and the datasets of a title once it's selected (see `Catalog`). The DB is
+    also checked periodically while it's still being filled by `ingest()`.
+
+    The map only has tile layers for the year being viewed and the
+    `layer_lookahead` following ones, which are loaded while hidden so the
+    animation doesn't wait for their tiles. The layers are reused as the
+    year changes: moving to the next year only changes the URL of the layer
+    that showed the previous one.
+
+    Years can also be compared to a base year, or summed since then, with
+    tiles computed on the fly (see `temporal.install_temporal_tiles()`).
+
+    Clicking the map plots the values of the clicked pixel over all years in
+    place of those of the whole indicator, if the DB has a time-series cube
+    of the indicator (see `cube.build_cube()`). Regions can also be drawn on
+    the map, by clicking their vertices, to plot the sum of the indicator's
+    values within them (see `ZonalStats`).
+
     Args:
-        tc_app: Flask instance of Terracotta
+        watch: Periodically check the DB for newly ingested datasets?
+        layer_lookahead: Number of following years to load tiles of.
 
     Returns:
         A Flask instance of a Dash app.
     """
     # pylint: disable=unused-variable
-    data = _get_data()
+    dbpath = tc.get_settings().DRIVER_PATH
+    status = get_status(dbpath)
+    catalog = Catalog(dbpath)
+    cubes = CubeReader(dbpath)
+    zonal_stats = ZonalStats(dbpath)
+    titles = catalog.get_titles()
     app = dash.Dash(__name__, server=False)
     app.title = 'Taswira'
-    options = [{'label': k, 'value': k} for k in list(data)]
+    options = _get_title_options(titles)
     app.layout = html.Div(
         [
             dcc.Store(id='raster-layers-store'),
+            dcc.Store(id='layer-lookahead', data=layer_lookahead),
+            dcc.Store(id='tile-focus'),
+            dcc.Store(id='region-store', data={
+                'drawing': False,
+                'vertices': []
+            }),
+            dcc.Store(id='data-version',
+                      data=[_count_datasets(titles),
+                            _is_ingesting(status)]),
+            dcc.Interval(id='refresh-interval',
+                         interval=REFRESH_INTERVAL,
+                         disabled=not (watch or _is_ingesting(status))),
+            html.Div(format_status(status),
+                     id='ingestion-status',
+                     style={
+                         'position': 'relative',
+                         'top': '10px',
+                         'left': '50px',
+                         'zIndex': '500',
+                         'height': '0',
+                         'fontWeight': 'bold',
+                         'textShadow': '1px 1px 2px #fff'
+                     }),
             dcc.Dropdown(id='title-dropdown',
                          clearable=False,
                          options=options,
-                         value=options[0]['value'],
+                         value=options[0]['value'] if options else None,
                          style={
                              'position': 'relative',
                              'top': '5px',
-                             'zIndex': '500',
+                             'zIndex': '501',
                              'height': '0',
                              'maxWidth': '200px',
                              'marginLeft': 'auto',
                              'marginRight': '10px'
                          }),
+            html.Div([
+                dcc.Dropdown(id='temporal-operation',
+                             options=TEMPORAL_OPTIONS,
+                             placeholder='Compare years',
+                             style={'width': '130px'}),
+                dcc.Dropdown(id='temporal-base-year',
+                             clearable=False,
+                             placeholder='Year',
+                             style={'width': '70px'})
+            ],
+                     style={
+                         'position': 'relative',
+                         'top': '45px',
+                         'zIndex': '500',
+                         'height': '0',
+                         'display': 'flex',
+                         'justifyContent': 'flex-end',
+                         'marginRight': '10px'
+                     }),
+            html.Div([
+                html.Button(
+                    'Draw region', id='region-btn', style=BUTTON_STYLE),
+                html.Button('Clear', id='region-clear-btn', style=BUTTON_STYLE)
+            ],
+                     style={
+                         'position': 'relative',
+                         'top': '85px',
+                         'zIndex': '499',
+                         'height': '0',
+                         'display': 'flex',
+                         'justifyContent': 'flex-end',
+                         'marginRight': '10px'
+                     }),
             html.Div(dl.Map([
                 dl.TileLayer(attribution=BASE_MAP_ATTRIBUTION),
                 dl.LayerGroup(id='raster-layers'),
+                dl.LayerGroup(id='region-layer'),
                 dl.LayerGroup(id='colorbar-layer')
             ],
                             id='main-map'),
@@ -160,43 +316,125 @@ def get_app():
             'fontFamily': 'sans-serif'
         })
 
+    # Layers are used in turn as the animation steps through the years, so
+    # every layer keeps its URL until its year is passed. Steps are counted
+    # rather than derived from the year, so the first years, loaded ahead of
+    # looping back to them, stay in their layers too.
     app.clientside_callback(
         """
-        function(year, layers){
-            return layers.map(l => {
-                console.log(typeof l.props.id, typeof year);
-                if (Number(l.props.id) === year)
-                    return {...l,props: {...l.props, opacity: 1.0}};
-                return l;
-            });
+        function(year, layers, lookahead){
+            if (!layers)
+                return window.dash_clientside.no_update;
+            const n = layers.years.length;
+            const current = Math.max(layers.years.indexOf(String(year)), 0);
+            const size = Math.min(lookahead + 1, n);
+            const last = window.taswiraLayerStep || {current: 0, step: 0};
+            let step = current;  // After a jump, any layer will do
+            if (current === last.current)
+                step = last.step;
+            else if (current === (last.current + 1) % n)
+                step = last.step + 1;
+            window.taswiraLayerStep = {current: current, step: step};
+
+            const children = new Array(size);
+            for (let k = 0; k < size; k++) {
+                const slot = (step + k) % size;
+                children[slot] = {
+                    namespace: 'dash_leaflet',
+                    type: 'TileLayer',
+                    props: {
+                        id: `raster-layer-${slot}`,
+                        url: layers.urls[(current + k) % n],
+                        opacity: k === 0 ? 1.0 : 0
+                    }
+                };
+            }
+            return children;
         }
         """, Output('raster-layers', 'children'),
         [Input('year-slider', 'value'),
          Input('raster-layers-store', 'data')],
-        [State('raster-layers', 'children')])
+        [State('layer-lookahead', 'data')])
+
+    # Let the server render tiles of the year being viewed first
+    app.clientside_callback(
+        """
+        function(year, title){
+            if (title && year)
+                fetch(`/tile-focus/${encodeURIComponent(title)}/${year}`,
+                      {method: 'POST'});
+            return year;
+        }
+        """, Output('tile-focus', 'data'), [Input('year-slider', 'value')],
+        [State('title-dropdown', 'value')])
+
+    @app.callback([
+        Output('title-dropdown', 'options'),
+        Output('title-dropdown', 'value'),
+        Output('data-version', 'data'),
+        Output('ingestion-status', 'children'),
+        Output('refresh-interval', 'disabled'),
+    ], [Input('refresh-interval', 'n_intervals')], [
+        State('title-dropdown', 'value'),
+        State('data-version', 'data'),
+    ])
+    def refresh_data(n_intervals, title, version):  # pylint: disable=unused-argument
+        status = get_status(dbpath)
+        is_ingesting = _is_ingesting(status)
+        is_disabled = not (watch or is_ingesting)
+
+        titles = catalog.get_titles()
+        new_version = [_count_datasets(titles), is_ingesting]
+        if new_version == version:
+            return (dash.no_update, dash.no_update, dash.no_update,
+                    format_status(status), is_disabled)
+
+        options = _get_title_options(titles)
+        if title is None and options:
+            title = options[0]['value']
+
+        return options, title, new_version, format_status(status), is_disabled
 
     @app.callback([
         Output('raster-layers-store', 'data'),
         Output('colorbar-layer', 'children'),
         Output('main-map', 'bounds')
-    ], [Input('title-dropdown', 'value')])
-    def update_raster_layers_colobar_map_bounds(title):
-        ranges = [data[title][year]['range'] for year in data[title].keys()]
-        lowers, uppers = list(zip(*ranges))
-        stretch_range = [min(lowers), max(uppers)]
-
-        xyz = '{z}/{x}/{y}'
-        layers = []
-        for year in data[title]:
-            raster_data = data[title][year]
-            colormap = raster_data['metadata']['colormap']
-            bounds = format_bounds(raster_data['bounds'])
-            layers.append(
-                dl.TileLayer(
-                    url=
-                    f'/singleband/{title}/{year}/{xyz}.png?colormap={colormap}',
-                    opacity=0,
-                    id=year))
+    ], [
+        Input('title-dropdown', 'value'),
+        Input('data-version', 'data'),
+        Input('temporal-operation', 'value'),
+        Input('temporal-base-year', 'value')
+    ])
+    def update_raster_layers_colobar_map_bounds(title, version, operation,
+                                                base_year):  # pylint: disable=unused-argument
+        if title is None:
+            raise PreventUpdate
+
+        # The stretch ranges of the title may have been computed since its
+        # datasets were cached, as seen by whichever process refreshed data
+        catalog.get_titles()
+        datasets = catalog.get_datasets(title)
+        latest = next(reversed(datasets.values()))
+        colormap = latest['metadata']['colormap']
+        bounds = format_bounds(latest['bounds'])
+
+        layers = {'years': list(datasets), 'urls': []}
+        if operation and base_year in datasets:
+            # Shared by all years, so their colors can be compared
+            stretch_range = get_temporal_stretch_range(
+                catalog, operation, title, base_year, tuple(datasets))
+            if operation != 'sum':
+                colormap = DIVERGING_COLORMAP
+            options = {'colormap': colormap, 'stretch_range': stretch_range}
+            for year in datasets:
+                layers['urls'].append(
+                    get_temporal_tile_url(operation, title, base_year, year,
+                                          options))
+        else:
+            stretch_range = get_stretch_range(list(datasets.values()))
+            for year, raster_data in datasets.items():
+                layers['urls'].append(get_tile_url((title, year),
+                                                   raster_data))
 
         colorbar = get_colorbar(stretch_range, colormap)
 
@@ -206,23 +444,34 @@ def get_app():
         Output('year-slider', 'marks'),
         Output('year-slider', 'min'),
         Output('year-slider', 'max'),
-    ], [Input('title-dropdown', 'value')])
-    def update_slider(title):
+        Output('temporal-base-year', 'options'),
+        Output('temporal-base-year', 'value'),
+    ], [Input('title-dropdown', 'value'),
+        Input('data-version', 'data')], [State('temporal-base-year', 'value')])
+    def update_slider(title, version, base_year):  # pylint: disable=unused-argument
+        if title is None:
+            raise PreventUpdate
+
+        years = list(catalog.get_datasets(title))
         mark_style = {'color': '#fff', 'textShadow': '1px 1px 2px #000'}
-        marks = {
-            int(k): dict(label=k, style=mark_style)
-            for k in data[title].keys()
-        }
+        marks = {int(k): dict(label=k, style=mark_style) for k in years}
         min_value = min(marks.keys())
         max_value = max(marks.keys())
 
-        return marks, min_value, max_value
+        year_options = [{'label': k, 'value': k} for k in years]
+        if base_year not in years:
+            base_year = years[0]
+
+        return marks, min_value, max_value, year_options, base_year
 
     @app.callback(Output('year-slider', 'value'), [
         Input('year-slider', 'marks'),
         Input('animation-interval', 'n_intervals')
     ], [State('year-slider', 'value')])
     def update_slider_value(marks, n_intervals, current_value):  # pylint: disable=unused-argument
+        if not marks:
+            raise PreventUpdate
+
         ctx = dash.callback_context
         min_value = min(marks.keys())
 
@@ -239,25 +488,54 @@ def get_app():
 
         return int(min_value)
 
-    @app.callback(Output('indicator-change-graph', 'figure'),
-                  [Input('title-dropdown', 'value')])
-    def update_graph(title):
-        fig = go.Figure()
-        x_marks = []
-        y_margs = []
-        for year, meta in data[title].items():
-            x_marks.append(year)
-            y_margs.append(meta['metadata']['indicator_value'])
-        fig.add_trace(go.Scatter(x=x_marks, y=y_margs, mode='lines+markers'))
+    @app.callback(Output('indicator-change-graph', 'figure'), [
+        Input('title-dropdown', 'value'),
+        Input('data-version', 'data'),
+        Input('main-map', 'click_lat_lng'),
+        Input('region-store', 'data')
+    ])
+    def update_graph(title, version, click_lat_lng, region):  # pylint: disable=unused-argument
+        if title is None:
+            raise PreventUpdate
 
-        unit = ''
-        for _, meta in data[title].items():
-            unit = meta['metadata']['unit']
-            break
+        ctx = dash.callback_context
+        vertices = region['vertices']
+        series = None
+        if (ctx.triggered
+                and ctx.triggered[0]['prop_id'].startswith('main-map.')
+                and click_lat_lng and not region['drawing']):
+            series = cubes.get_series(title, *click_lat_lng)
+
+        if series is not None:
+            lat, lon = click_lat_lng
+            x_marks = list(series)
+            y_margs = list(series.values())
+            y_title = f'{title} at {lat:.3f}, {lon:.3f}'
+        elif not region['drawing'] and len(vertices) >= 3:
+            stats = zonal_stats.get_stats(title,
+                                          get_region_geometry(vertices))
+            x_marks = list(stats)
+            y_margs = [s['sum'] for s in stats.values()]
+            y_title = f'{title} in region'
+        else:
+            datasets = catalog.get_datasets(title)
+            x_marks = []
+            y_margs = []
+            for year, meta in datasets.items():
+                x_marks.append(year)
+                y_margs.append(meta['metadata']['indicator_value'])
+
+            unit = ''
+            for _, meta in datasets.items():
+                unit = meta['metadata']['unit']
+                break
+            y_title = f'{title} ({unit})'
 
+        fig = go.Figure()
+        fig.add_trace(go.Scatter(x=x_marks, y=y_margs, mode='lines+markers'))
         fig.update_layout(autosize=False,
                           xaxis_title='Year',
-                          yaxis_title=f'{title} ({unit})',
+                          yaxis_title=y_title,
                           xaxis_type='category',
                           height=150,
                           margin=dict(t=10, b=0))
@@ -272,16 +550,44 @@ def get_app():
         btn = html.Button(new_value.capitalize(),
                           value=new_value,
                           id='animation-btn',
-                          style={
-                              'height': '30px',
-                              'backgroundColor': '#fff',
-                              'textAlign': 'center',
-                              'borderRadius': '4px',
-                              'border': '2px solid rgba(0,0,0,0.2)',
-                              'fontWeight': 'bold'
-                          })
+                          style=BUTTON_STYLE)
         is_paused = (new_value == 'play')
         interval = dcc.Interval(id='animation-interval', disabled=is_paused)
         return [btn, interval]
 
+    @app.callback(Output('region-store', 'data'), [
+        Input('main-map', 'click_lat_lng'),
+        Input('region-btn', 'n_clicks'),
+        Input('region-clear-btn', 'n_clicks')
+    ], [State('region-store', 'data')])
+    def update_region(click_lat_lng, draw_clicks, clear_clicks, region):  # pylint: disable=unused-argument
+        ctx = dash.callback_context
+        if not ctx.triggered:
+            raise PreventUpdate
+
+        trigger = ctx.triggered[0]['prop_id'].split('.')[0]
+        if trigger == 'region-clear-btn':
+            return {'drawing': False, 'vertices': []}
+        if trigger == 'region-btn':
+            if region['drawing']:
+                return dict(region, drawing=False)
+            return {'drawing': True, 'vertices': []}
+        if trigger == 'main-map' and region['drawing'] and click_lat_lng:
+            return dict(region, vertices=region['vertices'] + [click_lat_lng])
+
+        raise PreventUpdate
+
+    @app.callback([
+        Output('region-layer', 'children'),
+        Output('region-btn', 'children')
+    ], [Input('region-store', 'data')])
+    def update_region_layer(region):
+        vertices = region['vertices']
+        if region['drawing']:
+            layer = [dl.Polyline(positions=vertices)] if vertices else []
+            return layer, 'Done'
+
+        layer = [dl.Polygon(positions=vertices)] if len(vertices) >= 3 else []
+        return layer, 'Draw region'
+
     return app
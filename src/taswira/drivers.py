@@ -0,0 +1,78 @@
+"""Terracotta drivers safe to use from several threads and processes."""
+import pathlib
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from terracotta import drivers
+from terracotta.drivers import raster_base
+from terracotta.drivers.sqlite import SQLiteDriver
+
+RASTER_PROCESSES = 3
+
+
+class ThreadSafeSQLiteDriver(SQLiteDriver):
+    """SQLite driver that keeps its connection state per thread.
+
+    Terracotta's driver stores a single open connection on the instance,
+    which every thread then tries to use. SQLite connections can't be shared
+    between threads, so serving requests from several threads fails with
+    this driver.
+    """
+    def __init__(self, path):
+        self._local = threading.local()
+        super().__init__(path)
+
+    @property
+    def _connection(self):
+        return self._local.connection
+
+    @_connection.setter
+    def _connection(self, connection):
+        self._local.connection = connection
+
+    @property
+    def _connected(self):
+        return getattr(self._local, 'connected', False)
+
+    @_connected.setter
+    def _connected(self, connected):
+        self._local.connected = connected
+
+
+def use_thread_safe_driver(dbpath):
+    """Make Terracotta use a `ThreadSafeSQLiteDriver` for the given DB.
+
+    Must be called before the DB's driver is first retrieved with
+    `terracotta.get_driver()`. Terracotta has no API for registering a
+    driver instance, so this fills its private cache of drivers, which is
+    why setup.py pins the version of Terracotta.
+
+    Args:
+        dbpath: Path to a Terracotta-generated DB.
+
+    Returns:
+        The driver instance.
+    """
+    path = str(pathlib.Path(dbpath).resolve())
+    driver = ThreadSafeSQLiteDriver(path)
+    drivers._DRIVER_CACHE[(path, 'sqlite')] = driver  # pylint: disable=protected-access
+    return driver
+
+
+def reset_raster_executor():
+    """Give a forked process its own pool of processes for reading rasters.
+
+    Terracotta reads raster tiles on a process pool created at import time.
+    A forked process would share the pipes of that pool with its parent and
+    siblings, mixing up their tiles.
+
+    Returns:
+        The new pool, to be shut down before the process exits.
+    """
+    try:
+        raster_base.executor = ProcessPoolExecutor(
+            max_workers=RASTER_PROCESSES)
+    except OSError:
+        # Same fallback as Terracotta's, for systems without /dev/shm
+        raster_base.executor = ThreadPoolExecutor(max_workers=1)
+    return raster_base.executor
@@ -0,0 +1,283 @@
+"""Timers and counters of the work done by Taswira.
+
+`StageTimings` breaks ingestion down by stage, while `install_metrics()`
+exposes metrics of the server in Prometheus' text format.
+"""
+import bisect
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from .tiles import get_tile_key
+
+# Upper bounds of the buckets of request durations, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class StageTimings:
+    """Thread-safe timers and counters of the stages of a pipeline.
+
+    If `jsonl_path` is given, every timed stage is appended to that file as a
+    JSON line with the name of the stage, its duration and any extra fields,
+    followed by a line with the summary of all stages once closed.
+
+    Args:
+        jsonl_path: Path to the file to append JSON lines to.
+    """
+    def __init__(self, jsonl_path=None):
+        self._stages = OrderedDict()
+        self._counters = OrderedDict()
+        self._lock = threading.Lock()
+        self._file = None
+        if jsonl_path is not None:
+            self._file = open(jsonl_path, 'a', buffering=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def time(self, stage, **fields):
+        """Returns a context manager timing a stage.
+
+        Args:
+            stage: Name of the stage.
+            fields: Extra fields of the JSON line.
+        """
+        return _Timer(self, stage, fields)
+
+    def add(self, stage, seconds, **fields):
+        """Records a stage timed elsewhere (e.g. in another process)."""
+        with self._lock:
+            count, total, longest = self._stages.get(stage, (0, 0.0, 0.0))
+            self._stages[stage] = (count + 1, total + seconds,
+                                   max(longest, seconds))
+            if self._file is not None:
+                self._file.write(
+                    json.dumps(dict(stage=stage, seconds=seconds, **fields)) +
+                    '\n')
+
+    def count(self, counter, value=1):
+        """Increments a counter."""
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def stats(self):
+        """Returns a dict of the `stages` and `counters` recorded so far.
+
+        Stages are described by their `count`, `total` and `max` durations.
+        """
+        with self._lock:
+            return {
+                'stages': {
+                    stage: {
+                        'count': count,
+                        'total': total,
+                        'max': longest
+                    }
+                    for stage, (count, total, longest) in self._stages.items()
+                },
+                'counters': dict(self._counters),
+            }
+
+    def summary(self):
+        """Returns a table of the recorded stages and counters."""
+        stats = self.stats()
+        width = max(map(len, ['stage', *stats['stages'], *stats['counters']]))
+        lines = [f"{'stage':<{width}} {'count':>7} {'total':>9} {'max':>9}"]
+        for stage, stage_stats in stats['stages'].items():
+            lines.append(f"{stage:<{width}} {stage_stats['count']:>7} "
+                         f"{stage_stats['total']:>8.2f}s "
+                         f"{stage_stats['max']:>8.2f}s")
+        for counter, value in stats['counters'].items():
+            lines.append(f"{counter:<{width}} {value:>7}")
+        return '\n'.join(lines)
+
+    def close(self):
+        """Writes the summary to the JSON lines file and closes it."""
+        if self._file is not None:
+            self._file.write(json.dumps({'summary': self.stats()}) + '\n')
+            self._file.close()
+            self._file = None
+
+
+class _Timer:
+    def __init__(self, timings, stage, fields):
+        self.timings = timings
+        self.stage = stage
+        self.fields = fields
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.stage,
+                         time.perf_counter() - self.start, **self.fields)
+
+
+class Histogram:
+    """Thread-safe histogram of values, like those of Prometheus.
+
+    Args:
+        buckets: Sorted upper bounds of the buckets.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Adds a value to the histogram."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def collect(self):
+        """Returns the cumulative counts by upper bound, the sum and count."""
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'), ), counts):
+            running += count
+            cumulative.append((bound, running))
+        return cumulative, total, running
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+            '\n', r'\n')
+
+    return '{' + ','.join(f'{k}="{escape(v)}"'
+                          for k, v in labels.items()) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def format_metric(name, metric_type, description, samples):
+    """Formats a metric in Prometheus' text format.
+
+    Args:
+        name: Name of the metric.
+        metric_type: 'counter', 'gauge' or 'histogram'.
+        description: Help text of the metric.
+        samples: List of tuples of a dict of labels and a value, or a
+            `Histogram` for histograms.
+
+    Returns:
+        A list of lines.
+    """
+    lines = [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}']
+    if metric_type == 'histogram':
+        cumulative, total, count = samples.collect()
+        for bound, bucket_count in cumulative:
+            lines.append(f'{name}_bucket'
+                         f'{_format_labels({"le": _format_value(bound)})} '
+                         f'{bucket_count}')
+        lines.append(f'{name}_sum {_format_value(total)}')
+        lines.append(f'{name}_count {count}')
+    else:
+        for labels, value in samples:
+            lines.append(
+                f'{name}{_format_labels(labels)} {_format_value(value)}')
+    return lines
+
+
+def install_metrics(server, renderer=None, caches=()):
+    """Exposes metrics of a Flask app in Prometheus' text format.
+
+    Metrics are served at `/metrics`. Requests are counted by route and
+    status code, and the durations of tile requests, and of tile renders by
+    `renderer`, are kept in histograms. The hit ratio of every tile cache is
+    exposed along with its counters.
+
+    Metrics are kept by each process, so with several worker processes, a
+    scrape only gets those of the one serving it. Should be called before
+    any other request hooks are installed (like those of
+    `tiles.install_tile_cache()`), so every request is timed.
+
+    Args:
+        server: Flask instance serving the Terracotta API.
+        renderer: A `rendering.TileRenderer` instance.
+        caches: `TileCache` or `DiskTileCache` instances.
+    """
+    from flask import Response, g, request  # pylint: disable=import-outside-toplevel
+
+    request_counts = {}
+    tile_durations = Histogram()
+    lock = threading.Lock()
+
+    @server.before_request
+    def start_request_timer():  # pylint: disable=unused-variable
+        g.request_start = time.perf_counter()
+
+    @server.after_request
+    def count_request(response):  # pylint: disable=unused-variable
+        route = request.url_rule.rule if request.url_rule else None
+        key = (route, response.status_code)
+        with lock:
+            request_counts[key] = request_counts.get(key, 0) + 1
+        if 'request_start' in g and get_tile_key(request.path,
+                                                 request.args) is not None:
+            tile_durations.observe(time.perf_counter() - g.request_start)
+        return response
+
+    @server.route('/metrics')
+    def metrics():  # pylint: disable=unused-variable
+        with lock:
+            counts = sorted(request_counts.items(),
+                            key=lambda item: (str(item[0][0]), item[0][1]))
+        lines = format_metric(
+            'taswira_requests_total', 'counter',
+            'Requests served, by route and status code.',
+            [({
+                'route': route or 'unmatched',
+                'status': status
+            }, count) for (route, status), count in counts])
+        lines += format_metric('taswira_tile_request_seconds', 'histogram',
+                               'Durations of tile requests.', tile_durations)
+        if renderer is not None:
+            lines += format_metric('taswira_tile_render_seconds', 'histogram',
+                                   'Durations of tile renders.',
+                                   renderer.render_durations)
+
+        cache_stats = [({'cache': cache.name}, cache.stats())
+                       for cache in caches]
+        if cache_stats:
+            for stat, name, metric_type, description in [
+                ('hits', 'hits_total', 'counter', 'Tiles found in the cache.'),
+                ('misses', 'misses_total', 'counter',
+                 'Tiles missing from the cache.'),
+                ('tiles', 'tiles', 'gauge', 'Tiles in the cache.'),
+                ('size', 'size_bytes', 'gauge',
+                 'Total size of the cached tiles.'),
+            ]:
+                lines += format_metric(
+                    f'taswira_tile_cache_{name}', metric_type, description,
+                    [(labels, stats[stat]) for labels, stats in cache_stats])
+            lines += format_metric(
+                'taswira_tile_cache_hit_ratio', 'gauge',
+                'Share of tile lookups found in the cache.',
+                [(labels, stats['hits'] /
+                  max(stats['hits'] + stats['misses'], 1))
+                 for labels, stats in cache_stats])
+
+        return Response('\n'.join(lines) + '\n',
+                        content_type='text/plain; version=0.0.4')
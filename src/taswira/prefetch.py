@@ -0,0 +1,225 @@
+"""Rendering of tiles ahead of the animation."""
+import contextlib
+import sqlite3
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import mercantile
+import terracotta as tc
+from tqdm import tqdm
+
+from .tiles import get_tile_key, get_tile_url
+
+PREFETCH_HEADER = 'X-Taswira-Prefetch'
+DEFAULT_LOOKAHEAD = 3  # years
+DEFAULT_LAYER_LOOKAHEAD = 2  # years
+
+
+def get_years(dbpath, title):
+    """Returns the sorted list of years of all datasets with the given title."""
+    with contextlib.closing(sqlite3.connect(dbpath)) as conn:
+        rows = conn.execute(
+            "SELECT year FROM datasets WHERE title = ? ORDER BY year",
+            [title]).fetchall()
+    return [year for year, in rows]
+
+
+def _get_tile_path(keys, xyz, options):
+    path = urllib.parse.quote('/'.join(keys))
+    query = urllib.parse.urlencode(options)
+    return f"/singleband/{path}/{'/'.join(map(str, xyz))}.png?{query}"
+
+
+class TilePrefetcher:
+    """Renders tiles in the background, so they're cached before being needed.
+
+    Tiles are requested from the server itself, so they go through the same
+    caches (see `tiles.install_tile_cache()`) as the ones requested by the UI.
+    A tile already queued isn't queued again. The years of every title are
+    kept in memory, and only read again from the DB when a tile of a year
+    that's missing from them, or of the last one, is requested.
+
+    Args:
+        server: Flask instance serving the Terracotta API.
+        dbpath: Path to the Terracotta-generated DB being served.
+        lookahead: Number of following years to prefetch a tile for.
+        workers: Number of threads rendering tiles.
+    """
+    def __init__(self,
+                 server,
+                 dbpath,
+                 lookahead=DEFAULT_LOOKAHEAD,
+                 workers=1):
+        self.server = server
+        self.dbpath = dbpath
+        self.lookahead = lookahead
+        self._pending = set()
+        self._years = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _get_years(self, title, year):
+        with self._lock:
+            years = self._years.get(title)
+        # Years may have been ingested since, most likely after the last one
+        if not years or year not in years or year == years[-1]:
+            years = get_years(self.dbpath, title)
+            with self._lock:
+                self._years[title] = years
+        return years
+
+    def _render(self, url):
+        try:
+            response = self.server.test_client().get(
+                url, headers={PREFETCH_HEADER: '1'})
+            return response.status_code == 200
+        finally:
+            with self._lock:
+                self._pending.discard(url)
+
+    def submit(self, url):
+        """Queues a tile for rendering.
+
+        Args:
+            url: URL of the tile, relative to the server.
+
+        Returns:
+            A Future resolving to whether the tile could be rendered, or None
+            if it's already queued.
+        """
+        with self._lock:
+            if url in self._pending:
+                return None
+            self._pending.add(url)
+        return self._executor.submit(self._render, url)
+
+    def prefetch_following(self, key):
+        """Queues the same tile of the years following the one of a tile.
+
+        Args:
+            key: Key of the tile as returned by `tiles.get_tile_key()`.
+
+        Returns:
+            A list of Futures of the queued tiles.
+        """
+        keys, xyz, options = key
+        if len(keys) != 2:
+            return []
+
+        title, year = keys
+        following = [y for y in self._get_years(title, year) if y > year]
+        futures = [
+            self.submit(_get_tile_path((title, y), xyz, options))
+            for y in following[:self.lookahead]
+        ]
+        return [f for f in futures if f is not None]
+
+    def prefetch_viewport(self, title, year, bounds, zoom, options):
+        """Queues the tiles covering a viewport for a year and the following
+        ones.
+
+        Args:
+            title: Title of the datasets.
+            year: First year to prefetch.
+            bounds: A 4 element tuple of west, south, east and north bounds in
+                WGS84 coordinates.
+            zoom: Zoom level of the viewport.
+            options: Mapping of query arguments of the tiles.
+
+        Returns:
+            A list of Futures of the queued tiles.
+        """
+        years = [y for y in self._get_years(title, year) if y >= year]
+        futures = [
+            self.submit(
+                _get_tile_path((title, y), (tile.z, tile.x, tile.y), options))
+            for y in years[:self.lookahead + 1]
+            for tile in mercantile.tiles(*bounds, [zoom])
+        ]
+        return [f for f in futures if f is not None]
+
+    def shutdown(self, wait=True):
+        """Stops rendering tiles, optionally waiting for queued ones."""
+        self._executor.shutdown(wait=wait)
+
+
+def install_prefetcher(server, prefetcher):
+    """Prefetches tiles ahead of the ones requested from a Flask app.
+
+    Every singleband tile served causes the same tile of the following years
+    to be prefetched. Tiles for a whole viewport can be prefetched from the
+    `/prefetch/<title>/<year>` endpoint, given the `bounds` (as `w,s,e,n`)
+    and `zoom` of the viewport. Other query arguments are passed on to the
+    tiles.
+
+    Args:
+        server: Flask instance serving the Terracotta API, preferably with tile
+            caches installed.
+        prefetcher: A `TilePrefetcher` instance.
+    """
+    from flask import jsonify, request  # pylint: disable=import-outside-toplevel
+
+    @server.after_request
+    def prefetch_following_tiles(response):  # pylint: disable=unused-variable
+        if response.status_code != 200 or PREFETCH_HEADER in request.headers:
+            return response
+
+        key = get_tile_key(request.path, request.args)
+        if key is not None:
+            prefetcher.prefetch_following(key)
+        return response
+
+    @server.route('/prefetch/<title>/<year>')
+    def prefetch_viewport(title, year):  # pylint: disable=unused-variable
+        options = request.args.to_dict()
+        try:
+            bounds = [float(b) for b in options.pop('bounds').split(',')]
+            zoom = int(options.pop('zoom'))
+        except (KeyError, ValueError):
+            return jsonify({'message': 'bounds and zoom are required'}), 400
+        if len(bounds) != 4:
+            return jsonify({'message': 'bounds must be w,s,e,n'}), 400
+
+        futures = prefetcher.prefetch_viewport(title, year, bounds, zoom,
+                                               options)
+        return jsonify({'queued': len(futures)}), 202
+
+
+def prewarm(server, dbpath, max_zoom, workers=1):
+    """Renders tiles of all datasets at zoom levels 0 to `max_zoom`.
+
+    Tiles are requested with the same arguments as the UI uses, so the
+    server's tile caches should be installed beforehand for this to be of
+    any use.
+
+    Args:
+        server: Flask instance serving the Terracotta API.
+        dbpath: Path to a Terracotta-generated DB.
+        max_zoom: Highest zoom level to render.
+        workers: Number of threads rendering tiles.
+
+    Returns:
+        Number of tiles that couldn't be rendered.
+    """
+    driver = tc.get_driver(dbpath)
+    urls = []
+    with driver.connect():
+        for keys in driver.get_datasets():
+            metadata = driver.get_metadata(keys)
+            for tile in mercantile.tiles(*metadata['bounds'],
+                                         range(max_zoom + 1)):
+                urls.append(
+                    get_tile_url(keys, metadata, f'{tile.z}/{tile.x}/{tile.y}'))
+
+    prefetcher = TilePrefetcher(server, dbpath, workers=workers)
+    futures = [prefetcher.submit(url) for url in set(urls)]
+    failures = 0
+    try:
+        for future in tqdm(as_completed(futures),
+                           total=len(futures),
+                           desc="Rendering tiles"):
+            failures += not future.result()
+    finally:
+        prefetcher.shutdown()
+    return failures
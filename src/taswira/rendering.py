@@ -0,0 +1,178 @@
+"""Rendering of tiles on a pool of threads shared by all requests."""
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, Future
+
+from .metrics import Histogram
+from .prefetch import PREFETCH_HEADER
+from .tiles import get_tile_key
+
+DEFAULT_RENDER_THREADS = 4
+
+
+class _Job:
+    def __init__(self, key, path, query_string, prefetch, seq):
+        self.key = key
+        self.path = path
+        self.query_string = query_string
+        self.prefetch = prefetch
+        self.seq = seq
+        self.future = Future()
+
+
+class TileRenderer:
+    """Renders singleband tiles of a Flask app on a fixed number of threads.
+
+    Requests for a tile that's already being rendered wait for that render
+    instead of starting another one. Queued tiles are rendered in order of
+    relevance to the year being viewed (see `set_focus()`): tiles of past
+    years come last, after the ones requested by the UI and then the
+    prefetched ones. Prefetches of past years are dropped. The durations of
+    renders are kept in the `render_durations` histogram.
+
+    Args:
+        server: Flask instance serving the Terracotta API.
+        threads: Number of tiles rendered at a time.
+    """
+    def __init__(self, server, threads=DEFAULT_RENDER_THREADS):
+        self.server = server
+        self.threads = threads
+        self.render_durations = Histogram()
+        self._jobs = {}
+        self._queue = []
+        self._focus = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def _start_threads(self):
+        # Threads don't survive forking, so they're started in the process
+        # that actually renders tiles
+        if self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self._jobs.clear()
+        self._queue.clear()
+        for _ in range(self.threads):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def _is_passed(self, job):
+        keys = job.key[0]
+        if len(keys) != 2:
+            return False
+
+        title, year = keys
+        focus = self._focus.get(title)
+        return focus is not None and year < focus
+
+    def _get_priority(self, job):
+        return self._is_passed(job), job.prefetch, job.seq
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job = min(self._queue, key=self._get_priority)
+                self._queue.remove(job)
+
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            try:
+                job.future.set_result(self._render(job))
+            except Exception as err:  # pylint: disable=broad-except
+                job.future.set_exception(err)
+            finally:
+                with self._cond:
+                    if self._jobs.get(job.key) is job:
+                        del self._jobs[job.key]
+
+    def _render(self, job):
+        start = time.perf_counter()
+        with self.server.test_request_context(job.path,
+                                              query_string=job.query_string):
+            response = self.server.make_response(
+                self.server.dispatch_request())
+            response.direct_passthrough = False
+            data = response.get_data()
+        self.render_durations.observe(time.perf_counter() - start)
+        return response.status_code, data, response.mimetype
+
+    def render(self, key, path, query_string, prefetch=False):
+        """Queues a tile for rendering, unless it's already queued.
+
+        Args:
+            key: Key of the tile as returned by `tiles.get_tile_key()`.
+            path: Path of the tile request.
+            query_string: Query string of the tile request.
+            prefetch: Is the tile requested ahead of being viewed?
+
+        Returns:
+            A Future resolving to a tuple of the status code, the data and the
+            mimetype of the response.
+        """
+        with self._cond:
+            self._start_threads()
+            job = self._jobs.get(key)
+            if job is not None:
+                job.prefetch = job.prefetch and prefetch
+                return job.future
+
+            job = _Job(key, path, query_string, prefetch, next(self._seq))
+            self._jobs[key] = job
+            self._queue.append(job)
+            self._cond.notify()
+            return job.future
+
+    def set_focus(self, title, year):
+        """Sets the year being viewed for the datasets of a title.
+
+        Queued prefetches of earlier years are cancelled.
+        """
+        with self._cond:
+            self._focus[title] = year
+            for job in [j for j in self._queue if j.prefetch]:
+                if self._is_passed(job):
+                    self._queue.remove(job)
+                    del self._jobs[job.key]
+                    job.future.cancel()
+
+
+def install_tile_renderer(server, renderer):
+    """Renders the singleband tiles of a Flask app with a `TileRenderer`.
+
+    Should be called after `tiles.install_tile_cache()`, so cached tiles are
+    served without going through the renderer. The year being viewed is set
+    by POST requests to the `/tile-focus/<title>/<year>` endpoint.
+
+    The year being viewed is kept by each process, like the renderer's queue,
+    so with several worker processes, it only reorders the tiles queued in
+    the one serving the POST request.
+
+    Args:
+        server: Flask instance serving the Terracotta API.
+        renderer: A `TileRenderer` instance.
+    """
+    from flask import Response, request  # pylint: disable=import-outside-toplevel
+
+    @server.before_request
+    def render_tile():  # pylint: disable=unused-variable
+        key = get_tile_key(request.path, request.args)
+        if key is None:
+            return None
+
+        future = renderer.render(key, request.path, request.query_string,
+                                 PREFETCH_HEADER in request.headers)
+        try:
+            status, data, mimetype = future.result()
+        except CancelledError:
+            return Response(status=204)
+        return Response(data, status=status, mimetype=mimetype)
+
+    @server.route('/tile-focus/<title>/<year>', methods=['POST'])
+    def set_tile_focus(title, year):  # pylint: disable=unused-variable
+        renderer.set_focus(title, year)
+        return Response(status=204)
@@ -4,10 +4,13 @@ These functions are used with `argparse` to validate command-line
 arguments.
 """
 import argparse
+import contextlib
 import json
 import os
+import sqlite3
 
 INDICATOR_REQUIRED_KEYS = ("database_indicator", "file_pattern")
+MAX_ZOOM_LEVEL = 24
 
 
 def validate_path(path):
@@ -68,3 +71,165 @@ def db_results(path):
     """
     validate_path(path)
     return os.path.abspath(path)
+
+
+def terracotta_db(path):
+    """Validates the path of a DB made by `taswira ingest --out`.
+
+    Args:
+        path: String passed with command.
+
+    Returns:
+        Absolute path to the DB.
+
+    Raises:
+        ArgumentTypeError: If the file is not a Terracotta DB.
+    """
+    validate_path(path)
+    try:
+        with contextlib.closing(sqlite3.connect(path)) as conn:
+            conn.execute("SELECT 1 FROM datasets LIMIT 1")
+    except sqlite3.DatabaseError:
+        raise argparse.ArgumentTypeError(
+            f"{path} is not a Terracotta DB.") from None
+
+    return os.path.abspath(path)
+
+
+def output_file(path):
+    """Validates the path to write a file to.
+
+    Args:
+        path: String passed with command.
+
+    Returns:
+        Absolute path to the file.
+
+    Raises:
+        ArgumentTypeError: If the path is a directory, or its parent doesn't
+            exist.
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        raise argparse.ArgumentTypeError(f"{path} is a directory.")
+    if not os.path.isdir(os.path.dirname(path)):
+        raise argparse.ArgumentTypeError(
+            f"{os.path.dirname(path)} is not a directory.")
+
+    return path
+
+
+def cache_dir(path):
+    """Converts cache directory path, creating the directory if needed.
+
+    Args:
+        path: String passed with command.
+
+    Returns:
+        Absolute path to the cache directory.
+
+    Raises:
+        ArgumentTypeError: If the path exists but is not a directory.
+    """
+    if os.path.exists(path) and not os.path.isdir(path):
+        raise argparse.ArgumentTypeError(f"{path} is not a directory.")
+
+    os.makedirs(path, exist_ok=True)
+    return os.path.abspath(path)
+
+
+def non_negative_int(value):
+    """Validates a count or size that may be 0.
+
+    Args:
+        value: String passed with command.
+
+    Returns:
+        The count as an int.
+
+    Raises:
+        ArgumentTypeError: If the value is not a non-negative integer.
+    """
+    try:
+        count = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"{value} is not an integer.") from None
+
+    if count < 0:
+        raise argparse.ArgumentTypeError(f"{value} can't be negative.")
+
+    return count
+
+
+def zoom_level(value):
+    """Validates a zoom level of the map.
+
+    Args:
+        value: String passed with command.
+
+    Returns:
+        Zoom level as an int.
+
+    Raises:
+        ArgumentTypeError: If the value is not an integer from 0 to 24.
+    """
+    try:
+        zoom = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"{value} is not an integer.") from None
+
+    if not 0 <= zoom <= MAX_ZOOM_LEVEL:
+        raise argparse.ArgumentTypeError(
+            f"Zoom level must be from 0 to {MAX_ZOOM_LEVEL}.")
+
+    return zoom
+
+
+def positive_int(value):
+    """Validates a count that must be at least 1.
+
+    Args:
+        value: String passed with command.
+
+    Returns:
+        The count as an int.
+
+    Raises:
+        ArgumentTypeError: If the value is not a positive integer.
+    """
+    try:
+        count = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"{value} is not an integer.") from None
+
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not at least 1.")
+
+    return count
+
+
+def port(value):
+    """Validates a port number.
+
+    Args:
+        value: String passed with command.
+
+    Returns:
+        The port number as an int.
+
+    Raises:
+        ArgumentTypeError: If the value is not a valid port number.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"{value} is not an integer.") from None
+
+    if not 0 < number < 65536:
+        raise argparse.ArgumentTypeError(f"{value} is not a port number.")
+
+    return number
@@ -0,0 +1,90 @@
+"""Ingestion in the background of a running server."""
+import multiprocessing
+import os
+
+from ..metrics import StageTimings
+from . import get_config, update_config
+from .ingestion import UnoptimizedRaster, ingest, set_status
+from .watch import watch
+
+UNOPTIMIZED_ERROR = ("Found a raster file that is not a valid cloud-optimized "
+                     "GeoTIFF. Restart with `--convert` to convert it, or with "
+                     "`--allow-unoptimized` to process it anyway.")
+
+
+def _run_ingestion(config, rasterdir, db_results, dbpath, outputdir,
+                   allow_unoptimized, jobs, cachedir, keep_watching,
+                   fast_stats, convert, timings_file, cube):
+    update_config(config)
+    try:
+        with StageTimings(timings_file) as timings:
+            ingest(rasterdir,
+                   db_results,
+                   outputdir,
+                   allow_unoptimized,
+                   jobs,
+                   cachedir,
+                   create=False,
+                   fast_stats=fast_stats,
+                   convert=convert,
+                   timings=timings,
+                   cube=cube)
+    except UnoptimizedRaster:
+        set_status(dbpath, error=UNOPTIMIZED_ERROR)
+        return
+    except Exception as err:
+        # Shown in the UI, while the traceback goes to the server's stderr
+        set_status(dbpath, error=f'Ingestion failed: {err!r}')
+        raise
+
+    if keep_watching:
+        watch(rasterdir,
+              dbpath,
+              db_results,
+              allow_unoptimized,
+              cachedir=cachedir,
+              fast_stats=fast_stats,
+              convert=convert,
+              cube=cube)
+
+
+def start_ingestion(rasterdir,
+                    db_results,
+                    dbpath,
+                    allow_unoptimized=False,
+                    jobs=1,
+                    cachedir=None,
+                    keep_watching=False,
+                    fast_stats=False,
+                    convert=False,
+                    timings_file=None,
+                    cube=False):
+    """Run `ingest()` in a separate process.
+
+    Args:
+        rasterdir: Path to directory containing raster files.
+        db_results: Path to DB containing non-spatial data.
+        dbpath: Path to a DB created with `create_db()`.
+        allow_unoptimized: Should unoptimized raster files be processed?
+        jobs: Number of worker processes to use.
+        cachedir: Path to directory of a persistent ingestion cache.
+        keep_watching: Continue with `watch()` once ingestion is done?
+        fast_stats: Compute approximate raster statistics from overviews?
+        convert: Convert unoptimized rasters to COGs and ingest those?
+        timings_file: Path to a file to append the durations of ingestion
+            stages to. See `metrics.StageTimings`.
+        cube: Build time-series cubes of the indicators once all rasters
+            are in?
+
+    Returns:
+        The started `multiprocessing.Process`.
+    """
+    # Not a daemon, since those can't start worker processes of their own
+    proc = multiprocessing.Process(target=_run_ingestion,
+                                   args=(get_config(), rasterdir, db_results,
+                                         dbpath, os.path.dirname(dbpath),
+                                         allow_unoptimized, jobs, cachedir,
+                                         keep_watching, fast_stats, convert,
+                                         timings_file, cube))
+    proc.start()
+    return proc
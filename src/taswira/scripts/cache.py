@@ -0,0 +1,100 @@
+"""Persistent cache of per-raster ingestion results."""
+import hashlib
+import json
+import os
+import sqlite3
+
+CACHE_DB_NAME = 'ingestion_cache.sqlite'
+
+
+def get_fingerprint(raster):
+    """Computes a key identifying a raster file and its indicator config.
+
+    Files are identified by their path, size and modification time, so any
+    rewrite of a raster (or a change to its config entry) yields a new key.
+
+    Args:
+        raster: dict of indicator config with an additional `path` key.
+
+    Returns:
+        Hex digest string.
+    """
+    stat = os.stat(raster['path'])
+    key = json.dumps([
+        os.path.abspath(raster['path']), stat.st_size, stat.st_mtime_ns, raster
+    ],
+                     sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _to_json(value):
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class IngestionCache:
+    """SQLite-backed store of COG validity and computed raster metadata.
+
+    Only the metadata derived from raster contents is stored; the extra
+    metadata taken from the results DB is attached again on every run.
+
+    Args:
+        cachedir: Path to directory for saving the cache DB.
+    """
+    def __init__(self, cachedir):
+        self.path = os.path.join(cachedir, CACHE_DB_NAME)
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS rasters (
+                fingerprint TEXT PRIMARY KEY,
+                path TEXT,
+                valid_cog INTEGER,
+                metadata TEXT
+            )""")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, fingerprint):
+        """Looks up a cached raster.
+
+        Args:
+            fingerprint: Key returned by `get_fingerprint()`.
+
+        Returns:
+            A dict with keys `valid_cog` and `metadata`, or None on a miss.
+        """
+        row = self._conn.execute(
+            "SELECT valid_cog, metadata FROM rasters WHERE fingerprint = ?",
+            [fingerprint]).fetchone()
+        if row is None:
+            return None
+
+        return {'valid_cog': bool(row[0]), 'metadata': json.loads(row[1])}
+
+    def put(self, fingerprint, path, valid_cog, metadata):
+        """Stores the results for a raster, replacing stale entries of its path.
+
+        Args:
+            fingerprint: Key returned by `get_fingerprint()`.
+            path: Path to the raster file.
+            valid_cog: Whether the file is a valid cloud-optimized GeoTIFF.
+            metadata: dict of metadata computed by the Terracotta driver.
+        """
+        metadata = {k: v for k, v in metadata.items() if k != 'metadata'}
+        self._conn.execute("DELETE FROM rasters WHERE path = ?", [path])
+        self._conn.execute(
+            "INSERT OR REPLACE INTO rasters VALUES (?, ?, ?, ?)", [
+                fingerprint, path,
+                int(valid_cog),
+                json.dumps(metadata, default=_to_json)
+            ])
+
+    def close(self):
+        """Commits pending writes and closes the cache DB."""
+        self._conn.commit()
+        self._conn.close()
@@ -0,0 +1,187 @@
+"""Compact catalog of the datasets of a DB made by `ingest()`.
+
+Terracotta keeps the percentiles, convex hull and other statistics of every
+dataset in its metadata, of which the UI only needs a few fields. These are
+kept in a table of their own, so the UI can start without reading the
+metadata of every dataset.
+"""
+import contextlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from terracotta import get_driver
+
+CATALOG_TABLE = 'catalog'
+CATALOG_FIELDS = ('colormap', 'unit', 'indicator_value')
+DEFAULT_CACHE_SIZE = 16  # titles
+
+
+def create_catalog(conn):
+    """Creates the catalog table, unless it exists already.
+
+    Args:
+        conn: Open connection to the DB.
+    """
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CATALOG_TABLE} (
+            title TEXT,
+            year TEXT,
+            west REAL,
+            south REAL,
+            east REAL,
+            north REAL,
+            min REAL,
+            max REAL,
+            stretch_min REAL,
+            stretch_max REAL,
+            metadata TEXT,
+            PRIMARY KEY (title, year)
+        )""")
+
+
+def update_catalog(dbpath, rasters=(), stretch_ranges=None):
+    """Adds datasets and the stretch ranges of their titles to the catalog.
+
+    Both are written in a single transaction.
+
+    Args:
+        dbpath: Path to the DB.
+        rasters: Sequence of tuples of the keys, path and metadata of
+            datasets, as inserted into the DB. Existing datasets are
+            replaced.
+        stretch_ranges: dict mapping titles to the stretch range shared by
+            all their datasets (see `ingestion.get_title_stats()`).
+    """
+    rows = []
+    for keys, _, metadata in rasters:
+        extra = metadata['metadata']
+        stretch_range = extra.get('stretch_range') or (None, None)
+        rows.append([
+            *keys, *metadata['bounds'], *metadata['range'], *stretch_range,
+            json.dumps({field: extra.get(field)
+                        for field in CATALOG_FIELDS})
+        ])
+    stretch_rows = [[*stretch_range, title]
+                    for title, stretch_range in (stretch_ranges or {}).items()]
+
+    with contextlib.closing(sqlite3.connect(dbpath, timeout=30)) as conn:
+        conn.executemany(
+            f"INSERT OR REPLACE INTO {CATALOG_TABLE} "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.executemany(
+            f"UPDATE {CATALOG_TABLE} SET stretch_min = ?, stretch_max = ? "
+            "WHERE title = ?", stretch_rows)
+        conn.commit()
+
+
+def build_catalog(dbpath):
+    """Fills the catalog of a DB from the Terracotta metadata of its datasets.
+
+    Only needed for DBs made before the catalog existed, since `ingest()`
+    keeps it up to date.
+
+    Args:
+        dbpath: Path to a Terracotta-generated DB.
+    """
+    driver = get_driver(dbpath, provider='sqlite')
+    with driver.connect():
+        rasters = [(keys, path, driver.get_metadata(keys))
+                   for keys, path in driver.get_datasets().items()]
+
+    with contextlib.closing(sqlite3.connect(dbpath, timeout=30)) as conn:
+        create_catalog(conn)
+        conn.commit()
+    update_catalog(dbpath, rasters)
+
+
+def _parse_row(row):
+    west, south, east, north, low, high, stretch_min, stretch_max, extra = row
+    extra = json.loads(extra)
+    if stretch_min is not None:
+        extra['stretch_range'] = [stretch_min, stretch_max]
+    return {
+        'bounds': (west, south, east, north),
+        'range': (low, high),
+        'metadata': extra,
+    }
+
+
+class Catalog:
+    """Thread-safe reader of the catalog of a DB.
+
+    Titles are listed up front, but their datasets are only read when first
+    needed. The datasets of the `cache_size` most recently used titles are
+    kept in memory, and are read again once their number, or the number of
+    them with a stretch range, changes (see `get_titles()`). The catalog of
+    DBs made before it existed is built on first use.
+
+    Args:
+        dbpath: Path to a DB made by `ingest()`.
+        cache_size: Number of titles to keep the datasets of.
+    """
+    def __init__(self, dbpath, cache_size=DEFAULT_CACHE_SIZE):
+        self.dbpath = dbpath
+        self.cache_size = cache_size
+        self._titles = OrderedDict()
+        self._lock = threading.Lock()
+        with contextlib.closing(sqlite3.connect(dbpath)) as conn:
+            exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+                "name = ?", [CATALOG_TABLE]).fetchone()
+        if not exists:
+            build_catalog(dbpath)
+
+    def get_titles(self):
+        """Returns an OrderedDict mapping titles to their number of datasets.
+
+        Cached datasets of titles whose number changed are dropped, as are
+        those of titles whose stretch range was computed since they were
+        cached, possibly by another process.
+        """
+        with contextlib.closing(sqlite3.connect(self.dbpath)) as conn:
+            rows = conn.execute(
+                "SELECT title, COUNT(*), COUNT(stretch_min) FROM "
+                f"{CATALOG_TABLE} GROUP BY title ORDER BY title").fetchall()
+        counts = OrderedDict((title, count) for title, count, _ in rows)
+        states = {title: tuple(state) for title, *state in rows}
+
+        with self._lock:
+            for title, datasets in list(self._titles.items()):
+                stretched = sum('stretch_range' in dataset['metadata']
+                                for dataset in datasets.values())
+                if (len(datasets), stretched) != states.get(title):
+                    del self._titles[title]
+        return counts
+
+    def get_datasets(self, title):
+        """Returns the datasets of a title.
+
+        Args:
+            title: Title of the datasets.
+
+        Returns:
+            An OrderedDict mapping years, in order, to dicts with the
+            `bounds` and `range` of the dataset, and its `metadata`: colormap,
+            unit, indicator value and stretch range (if computed yet), like
+            those of the Terracotta driver.
+        """
+        with self._lock:
+            datasets = self._titles.get(title)
+            if datasets is not None:
+                self._titles.move_to_end(title)
+                return datasets
+
+        with contextlib.closing(sqlite3.connect(self.dbpath)) as conn:
+            rows = conn.execute(
+                "SELECT year, west, south, east, north, min, max, "
+                f"stretch_min, stretch_max, metadata FROM {CATALOG_TABLE} "
+                "WHERE title = ? ORDER BY year", [title]).fetchall()
+        datasets = OrderedDict((row[0], _parse_row(row[1:])) for row in rows)
+
+        with self._lock:
+            self._titles[title] = datasets
+            while len(self._titles) > self.cache_size:
+                self._titles.popitem(last=False)
+        return datasets
@@ -1,5 +1,11 @@
-"""Taswira's CLI"""
+"""Taswira's CLI
+
+Modules for serving the UI (Terracotta's server, Dash, etc.) take seconds to
+import, so they're only imported by the commands that need them.
+"""
+# pylint: disable=import-outside-toplevel
 import argparse
+import contextlib
 import os
 import signal
 import sys
@@ -7,35 +13,108 @@ import tempfile
 import threading
 import warnings
 import webbrowser
-import socket
-import terracotta as tc
-from terracotta.server.app import app as tc_app
-from werkzeug.serving import run_simple
 
-from ..app import get_app
+from ..prefetch import DEFAULT_LAYER_LOOKAHEAD, DEFAULT_LOOKAHEAD
+from ..rendering import DEFAULT_RENDER_THREADS
 from . import arg_types, update_config
 from .helpers import get_free_port
-from .ingestion import UnoptimizedRaster, ingest
+
+DEFAULT_TILE_CACHE_SIZE = 256  # MB
+DEFAULT_TILE_CACHE_DISK_SIZE = 1024  # MB
+DEFAULT_PREWARM_ZOOM = 8
+
+
+def configure_terracotta(dbpath):
+    """Point Terracotta to the given DB, so it can be served from threads."""
+    import terracotta as tc
+
+    from ..drivers import use_thread_safe_driver
+
+    tc.update_settings(DRIVER_PATH=dbpath, DRIVER_PROVIDER='sqlite')
+    use_thread_safe_driver(dbpath)
 
 
-def start_servers(dbpath, port):
+def start_servers(dbpath,
+                  port,
+                  watch=False,
+                  tile_cache_size=DEFAULT_TILE_CACHE_SIZE,
+                  tile_cache_dir=None,
+                  tile_cache_disk_size=DEFAULT_TILE_CACHE_DISK_SIZE,
+                  prefetch_years=DEFAULT_LOOKAHEAD,
+                  workers=1,
+                  threads=1,
+                  render_threads=DEFAULT_RENDER_THREADS,
+                  layer_lookahead=DEFAULT_LAYER_LOOKAHEAD):
     """Load given DB and start a Terracotta and Dash server.
 
     Args:
         dbpath: Path to a Terracotta-generated DB.
         port: Port number for Terracotta server.
+        watch: Should the UI pick up datasets added to the DB later on?
+        tile_cache_size: Memory budget of the tile cache in MB. Set to 0 to
+            disable caching.
+        tile_cache_dir: Path to directory for a persistent tile cache.
+        tile_cache_disk_size: Disk budget of the persistent tile cache in MB.
+        prefetch_years: Number of following years to render every requested
+            tile for ahead of time. Only used when tiles are cached.
+        workers: Number of server processes. See `wsgi.serve()`.
+        threads: Number of threads per server process.
+        render_threads: Number of threads rendering tiles in every server
+            process.
+        layer_lookahead: Number of following years the browser loads tiles
+            of. See `app.get_app()`.
     """
+    from flask import jsonify
+    from terracotta.server.app import app as tc_app
+    from werkzeug.serving import run_simple
+
+    from ..app import get_app
+    from ..metrics import install_metrics
+    from ..prefetch import TilePrefetcher, install_prefetcher
+    from ..rendering import TileRenderer, install_tile_renderer
+    from ..temporal import install_temporal_tiles
+    from ..tiles import DiskTileCache, TileCache, install_tile_cache
+    from ..timeseries import CubeReader, install_timeseries
+    from ..zonal import ZonalStats, install_zonal_stats
+    from .catalog import Catalog
+    from .ingestion import get_status
+    from .wsgi import get_backend, serve
+
     def handler(signum, frame):
         sys.exit(0)
 
     signal.signal(signal.SIGINT, handler)
 
     # Update Terracotta settings
-    tc.update_settings(DRIVER_PATH=dbpath, DRIVER_PROVIDER='sqlite')
+    configure_terracotta(dbpath)
 
     # Initialize the Dash app
-    app = get_app()
+    app = get_app(watch, layer_lookahead)
     app.init_app(tc_app)
+    install_temporal_tiles(tc_app, Catalog(dbpath))
+    install_timeseries(tc_app, CubeReader(dbpath))
+    install_zonal_stats(tc_app, ZonalStats(dbpath))
+
+    tile_caches = []
+    if tile_cache_size > 0:
+        tile_caches.append(TileCache(tile_cache_size * 1024 * 1024))
+    if tile_cache_dir is not None:
+        tile_caches.append(
+            DiskTileCache(tile_cache_dir, tile_cache_disk_size * 1024 * 1024,
+                          dbpath))
+    renderer = TileRenderer(tc_app, render_threads)
+    install_metrics(tc_app, renderer, tile_caches)
+    if tile_caches:
+        install_tile_cache(tc_app, *tile_caches)
+    install_tile_renderer(tc_app, renderer)
+    if tile_caches and prefetch_years > 0:
+        install_prefetcher(
+            tc_app,
+            TilePrefetcher(tc_app, dbpath, prefetch_years, render_threads))
+
+    @tc_app.route('/ingestion-status')
+    def ingestion_status():  # pylint: disable=unused-variable
+        return jsonify(get_status(dbpath))
 
     # Automatically open browser only if not in Docker
     def open_browser():
@@ -47,15 +126,16 @@ def start_servers(dbpath, port):
     # Start the server
     if 'DEBUG' in os.environ:
         app.run_server(host='0.0.0.0', port=port, threaded=False, debug=True)
-    else:
+    elif workers == 1 and threads == 1:
         print('Starting Taswira...')
         run_simple('0.0.0.0', port, app.server)
+    else:
+        print(f'Starting Taswira with {workers} worker(s) of {threads} '
+              f'thread(s), using {get_backend(workers)}...')
+        serve(app.server, '0.0.0.0', port, workers, threads)
 
 
-def console():
-    """The command-line interface for Taswira"""
-    parser = argparse.ArgumentParser(
-        description="Interactive visualization tool for GCBM")
+def _add_ingestion_arguments(parser):
     parser.add_argument(
         "config",
         type=arg_types.indicator_file,
@@ -70,29 +150,331 @@ def console():
     parser.add_argument("--allow-unoptimized",
                         action="store_true",
                         help="allow processing unoptimized raster files")
-    args = parser.parse_args()
+    parser.add_argument("-j",
+                        "--jobs",
+                        type=arg_types.positive_int,
+                        default=1,
+                        help="number of processes used for ingesting rasters")
+    parser.add_argument(
+        "--cache-dir",
+        type=arg_types.cache_dir,
+        help="directory for keeping ingested data between launches")
+    parser.add_argument(
+        "--fast-stats",
+        action="store_true",
+        help="compute approximate raster statistics from overviews, which is "
+        "faster for large rasters")
+    parser.add_argument(
+        "--convert",
+        action="store_true",
+        help="convert unoptimized raster files to cloud-optimized GeoTIFFs "
+        "in the cache directory")
+    parser.add_argument(
+        "--timings-file",
+        type=arg_types.output_file,
+        metavar="PATH",
+        help="append the duration of every ingestion stage to a file, as JSON "
+        "lines")
+    parser.add_argument(
+        "--cube",
+        action="store_true",
+        help="build a time-series cube of every indicator, for plotting the "
+        "values of a pixel over all years (kept in the cache directory)")
 
-    update_config(args.config)
 
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        try:
-            if args.allow_unoptimized:
-                warnings.simplefilter('ignore')  # Supress Terracotta warnings
+def _add_server_arguments(parser):
+    parser.add_argument(
+        "--port",
+        type=arg_types.port,
+        help="port to serve the UI on (5000, or a free one, by default)")
+    parser.add_argument(
+        "--tile-cache-size",
+        type=arg_types.non_negative_int,
+        default=DEFAULT_TILE_CACHE_SIZE,
+        metavar="MB",
+        help="memory budget for caching rendered tiles (0 disables caching)")
+    parser.add_argument(
+        "--tile-cache-dir",
+        type=arg_types.cache_dir,
+        help="directory for caching rendered tiles between launches")
+    parser.add_argument(
+        "--tile-cache-disk-size",
+        type=arg_types.non_negative_int,
+        default=DEFAULT_TILE_CACHE_DISK_SIZE,
+        metavar="MB",
+        help="disk budget for caching rendered tiles between launches")
+    parser.add_argument(
+        "--prefetch-years",
+        type=arg_types.non_negative_int,
+        default=DEFAULT_LOOKAHEAD,
+        metavar="N",
+        help="number of following years to render requested tiles for ahead "
+        "of time (0 disables prefetching)")
+    parser.add_argument(
+        "--layer-lookahead",
+        type=arg_types.non_negative_int,
+        default=DEFAULT_LAYER_LOOKAHEAD,
+        metavar="N",
+        help="number of following years whose map tiles the browser loads "
+        "ahead of time")
+    parser.add_argument(
+        "--workers",
+        type=arg_types.positive_int,
+        default=1,
+        metavar="N",
+        help="number of server processes (uses Gunicorn if installed)")
+    parser.add_argument("--threads",
+                        type=arg_types.positive_int,
+                        default=1,
+                        metavar="M",
+                        help="number of threads per server process")
+    parser.add_argument(
+        "--render-threads",
+        type=arg_types.positive_int,
+        default=DEFAULT_RENDER_THREADS,
+        metavar="N",
+        help="number of threads rendering tiles in every server process")
+
+
+@contextlib.contextmanager
+def _record_timings(path):
+    """Yields `StageTimings` for ingestion, then prints their summary."""
+    from ..metrics import StageTimings
+
+    with StageTimings(path) as timings:
+        yield timings
+    print(timings.summary(), file=sys.stderr)
 
-            dbpath = ingest(args.spatial_results, args.db_results, tmpdirname,
-                            args.allow_unoptimized)
-            port = get_free_port()
-            start_servers(dbpath, port)
-        except UnoptimizedRaster:
-            sys.exit("""\
+
+@contextlib.contextmanager
+def _handle_ingestion_errors():
+    from .ingestion import UnoptimizedRaster
+
+    try:
+        yield
+    except UnoptimizedRaster:
+        sys.exit("""\
 Found a raster file that is not a valid cloud-optimized GeoTIFFs. This tool
-wasn't designed to work with such files. You can try continuing anyway by
-passing the `--allow-unoptimized` flag but it's not recommended.
+wasn't designed to work with such files. Pass the `--convert` flag to convert
+them to cloud-optimized GeoTIFFs. You can also try continuing anyway by passing
+the `--allow-unoptimized` flag but it's not recommended.
 
 For best experience, regenerate the raster files after configuring GCBM to use
 the following GDAL parameters:
 
 BIGTIFF=YES, TILED=YES, COMPRESS=ZSTD, ZSTD_LEVEL=1
 """)
-        except KeyboardInterrupt:
-            sys.exit("Raster loading was interrupted")
+    except KeyboardInterrupt:
+        sys.exit("Raster loading was interrupted")
+
+
+def ingest_console(argv=None):
+    """The `taswira ingest` command, for ingesting without starting the UI.
+
+    Writes the ingested DB to `--out`, for `taswira serve`, and/or fills the
+    cache directory, so later launches with it start right away.
+
+    Args:
+        argv: List of command-line arguments, `sys.argv[2:]` by default.
+    """
+    parser = argparse.ArgumentParser(
+        prog="taswira ingest",
+        description="Ingest GCBM output into a DB for `taswira serve` or a "
+        "cache directory")
+    _add_ingestion_arguments(parser)
+    parser.add_argument("--out",
+                        type=arg_types.output_file,
+                        metavar="PATH",
+                        help="path to write the ingested DB to")
+    args = parser.parse_args(sys.argv[2:] if argv is None else argv)
+    if args.out is None and args.cache_dir is None:
+        parser.error("one of --out or --cache-dir is required")
+    if args.convert and args.cache_dir is None:
+        parser.error("--convert requires --cache-dir for keeping the "
+                     "converted rasters")
+    if args.cube and args.cache_dir is None:
+        parser.error("--cube requires --cache-dir for keeping the cubes")
+
+    from .ingestion import export_db, ingest
+
+    update_config(args.config)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        with _handle_ingestion_errors():
+            if args.allow_unoptimized:
+                warnings.simplefilter('ignore')  # Supress Terracotta warnings
+
+            with _record_timings(args.timings_file) as timings:
+                dbpath = ingest(args.spatial_results,
+                                args.db_results,
+                                args.cache_dir or tmpdirname,
+                                args.allow_unoptimized,
+                                args.jobs,
+                                args.cache_dir,
+                                fast_stats=args.fast_stats,
+                                convert=args.convert,
+                                timings=timings,
+                                cube=args.cube)
+        if args.out is not None:
+            export_db(dbpath, args.out)
+            dbpath = args.out
+    print(f'Ingested rasters into {dbpath}')
+
+
+def serve_console(argv=None):
+    """The `taswira serve` command, for serving a DB made by `taswira ingest`.
+
+    No raster files are scanned, so the UI starts right away.
+
+    Args:
+        argv: List of command-line arguments, `sys.argv[2:]` by default.
+    """
+    parser = argparse.ArgumentParser(
+        prog="taswira serve",
+        description="Serve GCBM output ingested with `taswira ingest --out`")
+    parser.add_argument("db",
+                        type=arg_types.terracotta_db,
+                        help="path to the ingested DB")
+    _add_server_arguments(parser)
+    args = parser.parse_args(sys.argv[2:] if argv is None else argv)
+
+    start_servers(args.db, args.port or get_free_port(), False,
+                  args.tile_cache_size,
+                  args.tile_cache_dir, args.tile_cache_disk_size,
+                  args.prefetch_years, args.workers, args.threads,
+                  args.render_threads, args.layer_lookahead)
+
+
+def prewarm_console(argv=None):
+    """The `taswira prewarm` command, for filling a tile cache ahead of time.
+
+    Args:
+        argv: List of command-line arguments, `sys.argv[2:]` by default.
+    """
+    parser = argparse.ArgumentParser(
+        prog="taswira prewarm",
+        description="Render map tiles of GCBM output into a tile cache")
+    _add_ingestion_arguments(parser)
+    parser.add_argument("--tile-cache-dir",
+                        type=arg_types.cache_dir,
+                        required=True,
+                        help="directory for caching rendered tiles")
+    parser.add_argument(
+        "--tile-cache-disk-size",
+        type=arg_types.non_negative_int,
+        default=DEFAULT_TILE_CACHE_DISK_SIZE,
+        metavar="MB",
+        help="disk budget for caching rendered tiles")
+    parser.add_argument("--max-zoom",
+                        type=arg_types.zoom_level,
+                        default=DEFAULT_PREWARM_ZOOM,
+                        help="highest zoom level to render tiles for")
+    args = parser.parse_args(sys.argv[2:] if argv is None else argv)
+
+    from terracotta.server.app import app as tc_app
+
+    from ..prefetch import prewarm
+    from ..tiles import DiskTileCache, install_tile_cache
+    from .ingestion import ingest
+
+    update_config(args.config)
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        with _handle_ingestion_errors():
+            if args.allow_unoptimized:
+                warnings.simplefilter('ignore')  # Supress Terracotta warnings
+
+            with _record_timings(args.timings_file) as timings:
+                dbpath = ingest(args.spatial_results,
+                                args.db_results,
+                                args.cache_dir or tmpdirname,
+                                args.allow_unoptimized,
+                                args.jobs,
+                                args.cache_dir,
+                                fast_stats=args.fast_stats,
+                                convert=args.convert,
+                                timings=timings,
+                                cube=args.cube)
+
+        configure_terracotta(dbpath)
+        install_tile_cache(
+            tc_app,
+            DiskTileCache(args.tile_cache_dir,
+                          args.tile_cache_disk_size * 1024 * 1024, dbpath))
+        failures = prewarm(tc_app, dbpath, args.max_zoom, args.jobs)
+
+    if failures:
+        sys.exit(f"Failed to render {failures} tiles")
+
+
+SUBCOMMANDS = {
+    'ingest': ingest_console,
+    'serve': serve_console,
+    'prewarm': prewarm_console,
+}
+
+
+def console():
+    """The command-line interface for Taswira"""
+    subcommand = SUBCOMMANDS.get(sys.argv[1] if len(sys.argv) > 1 else None)
+    if subcommand is not None:
+        subcommand()
+        return
+
+    parser = argparse.ArgumentParser(
+        description="Interactive visualization tool for GCBM",
+        epilog="Run `taswira ingest -h` and `taswira serve -h` for ingesting "
+        "and serving separately, or `taswira prewarm -h` for filling a tile "
+        "cache ahead of time.")
+    _add_ingestion_arguments(parser)
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep ingesting new raster files while the server is running")
+    parser.add_argument(
+        "--lazy-start",
+        action="store_true",
+        help="start the server right away and ingest rasters in the background")
+    _add_server_arguments(parser)
+    args = parser.parse_args()
+
+    from .background import start_ingestion
+    from .ingestion import create_db, ingest
+    from .watch import start_watcher
+
+    update_config(args.config)
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        with _handle_ingestion_errors():
+            if args.allow_unoptimized:
+                warnings.simplefilter('ignore')  # Supress Terracotta warnings
+
+            outputdir = args.cache_dir or tmpdirname
+            if args.lazy_start:
+                dbpath = create_db(outputdir)
+                start_ingestion(args.spatial_results, args.db_results, dbpath,
+                                args.allow_unoptimized, args.jobs,
+                                args.cache_dir, args.watch, args.fast_stats,
+                                args.convert, args.timings_file,
+                                args.cube)
+            else:
+                with _record_timings(args.timings_file) as timings:
+                    dbpath = ingest(args.spatial_results,
+                                    args.db_results,
+                                    outputdir,
+                                    args.allow_unoptimized,
+                                    args.jobs,
+                                    args.cache_dir,
+                                    fast_stats=args.fast_stats,
+                                    convert=args.convert,
+                                    timings=timings,
+                                    cube=args.cube)
+                if args.watch:
+                    start_watcher(args.spatial_results, dbpath,
+                                  args.db_results, args.allow_unoptimized,
+                                  args.cache_dir, args.fast_stats,
+                                  args.convert, args.cube)
+            port = args.port or get_free_port()
+            start_servers(dbpath, port, args.watch, args.tile_cache_size,
+                          args.tile_cache_dir, args.tile_cache_disk_size,
+                          args.prefetch_years, args.workers, args.threads,
+                          args.render_threads, args.layer_lookahead)
@@ -0,0 +1,95 @@
+"""Conversion of raster files to cloud-optimized GeoTIFFs."""
+import hashlib
+import json
+import math
+import os
+import tempfile
+import warnings
+
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.shutil import copy
+
+CONVERTED_DIR = 'converted'
+BLOCK_SIZE = 256
+# The profile recommended for GCBM's output
+COG_PROFILE = {
+    'driver': 'GTiff',
+    'tiled': True,
+    'blockxsize': BLOCK_SIZE,
+    'blockysize': BLOCK_SIZE,
+    'compress': 'ZSTD',
+    'zstd_level': 1,
+    'bigtiff': 'YES',
+}
+
+
+def get_converted_path(path, outputdir):
+    """Returns the path `convert_raster()` writes the COG copy of a raster to.
+
+    The path depends on the identity of the original file, so a raster that
+    has since been rewritten is converted again. It keeps the file's name,
+    which the year of its data is read from.
+
+    Args:
+        path: Path to the raster file.
+        outputdir: Path to directory for saving converted rasters.
+    """
+    stat = os.stat(path)
+    identity = json.dumps(
+        [os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return os.path.join(outputdir, CONVERTED_DIR,
+                        hashlib.sha1(identity.encode()).hexdigest(),
+                        os.path.basename(path))
+
+
+def _get_overview_factors(width, height):
+    levels = math.ceil(
+        math.log2(max(width // BLOCK_SIZE, height // BLOCK_SIZE, 1)))
+    return [2**level for level in range(1, levels + 1)]
+
+
+def convert_raster(path, outputdir):
+    """Converts a raster file to a cloud-optimized GeoTIFF.
+
+    The raster is copied block by block into a tiled file, overviews are
+    added, and the result is compressed with ZSTD. Rasters that were already
+    converted are left alone.
+
+    Args:
+        path: Path to the raster file.
+        outputdir: Path to directory for saving converted rasters.
+
+    Returns:
+        Path to the converted file (see `get_converted_path()`).
+    """
+    cog_path = get_converted_path(path, outputdir)
+    if os.path.exists(cog_path):
+        return cog_path
+
+    os.makedirs(os.path.dirname(cog_path), exist_ok=True)
+    with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(cog_path)) as tmpdir, \
+            warnings.catch_warnings(), \
+            rasterio.Env(GDAL_TIFF_OVR_BLOCKSIZE=BLOCK_SIZE):
+        warnings.filterwarnings('ignore', message='invalid value encountered.*')
+        tiled_path = os.path.join(tmpdir, 'tiled.tif')
+        with rasterio.open(path) as src:
+            profile = dict(src.profile, **COG_PROFILE)
+            with rasterio.open(tiled_path, 'w', **profile) as dst:
+                for _, window in dst.block_windows(1):
+                    dst.write(src.read(window=window), window=window)
+
+        with rasterio.open(tiled_path, 'r+') as dst:
+            dst.build_overviews(
+                _get_overview_factors(dst.width, dst.height),
+                Resampling.average)
+            dst.update_tags(ns='rio_overview', resampling='average')
+
+        # Copying moves the overviews to the start of the file, as COGs have
+        # them, and only then is the result moved into place
+        converted_path = os.path.join(tmpdir, 'converted.tif')
+        copy(tiled_path, converted_path, copy_src_overviews=True, **profile)
+        os.replace(converted_path, cog_path)
+
+    return cog_path
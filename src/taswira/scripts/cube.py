@@ -0,0 +1,248 @@
+"""Time-series cubes of the datasets of a DB made by `ingest()`.
+
+Reading the values of a pixel over all years from the rasters means opening
+one file per year. A cube keeps the datasets of a title in a single `.npy`
+file instead, with the years as the innermost axis, so the series of a pixel
+is a single contiguous read from a memory map.
+"""
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+CUBE_TABLE = 'cubes'
+CUBE_DTYPE = 'float32'
+STRIP_SIZE = 64 * 1024 * 1024  # bytes of all years read at a time
+
+
+def _get_cube_path(cubedir, title, sources):
+    # Cubes of other DBs sharing the directory have other sources, so they
+    # never overwrite each other
+    slug = re.sub(r'[^\w-]+', '_', title)
+    digest = hashlib.sha1(json.dumps([title,
+                                      sources]).encode()).hexdigest()[:16]
+    return os.path.join(cubedir, f'{slug}-{digest}.npy')
+
+
+def _create_cube_table(conn):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CUBE_TABLE} (
+            title TEXT PRIMARY KEY,
+            path TEXT,
+            metadata TEXT
+        )""")
+
+
+def _get_metadata_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def _read_metadata(path):
+    try:
+        with open(_get_metadata_path(path)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_metadata(path, metadata):
+    with open(_get_metadata_path(path), 'w') as file:
+        json.dump(metadata, file)
+
+
+def _is_registered(dbpath, path):
+    try:
+        with contextlib.closing(
+                sqlite3.connect(f'file:{dbpath}?mode=ro', uri=True,
+                                timeout=30)) as conn:
+            return conn.execute(
+                f"SELECT 1 FROM {CUBE_TABLE} WHERE path = ?",
+                [path]).fetchone() is not None
+    except sqlite3.Error:
+        return False  # The DB or its cube table is gone
+
+
+def _release_cube(path, dbpath):
+    """Unlists a DB from the users of a cube, deleting the cube once no other
+    DB still has it registered."""
+    metadata = _read_metadata(path)
+    if metadata is None:
+        return
+    dbpath = os.path.abspath(dbpath)
+    users = [
+        user for user in metadata.get('dbs', [])
+        if user != dbpath and _is_registered(user, path)
+    ]
+    if users:
+        _write_metadata(path, {**metadata, 'dbs': users})
+        return
+    for cube_path in (path, _get_metadata_path(path)):
+        with contextlib.suppress(OSError):
+            os.remove(cube_path)
+
+
+def _get_file_identity(path):
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+def _get_strip_windows(shape, block_shape, depth):
+    """Splits a raster into windows of whole blocks, holding at most
+    `STRIP_SIZE` bytes of all `depth` years at a time.
+
+    Windows span whole rows of blocks, unless a single row of blocks is over
+    budget, in which case it's split into columns of whole blocks. Reading a
+    window then never decompresses a block that a later window also needs.
+    """
+    height, width = shape
+    block_height, block_width = block_shape
+    item_size = np.dtype(CUBE_DTYPE).itemsize
+    row_size = width * depth * item_size
+    strip_height = max(1, STRIP_SIZE //
+                       (row_size * block_height)) * block_height
+    strip_width = width
+    if strip_height * row_size > STRIP_SIZE:
+        column_size = strip_height * depth * item_size
+        strip_width = max(1, STRIP_SIZE //
+                          (column_size * block_width)) * block_width
+    for row in range(0, height, strip_height):
+        for col in range(0, width, strip_width):
+            yield Window(col, row, min(strip_width, width - col),
+                         min(strip_height, height - row))
+
+
+def _write_cube(path, raster_paths):
+    """Writes the rasters into a cube, one strip of blocks at a time.
+
+    Returns:
+        A dict of the `crs`, `transform` and `shape` shared by the rasters.
+
+    Raises:
+        ValueError: If the rasters aren't all on the same grid.
+    """
+    with contextlib.ExitStack() as stack:
+        rasters = [stack.enter_context(rasterio.open(p)) for p in raster_paths]
+        first = rasters[0]
+        grid = (first.shape, first.transform, first.crs)
+        for raster in rasters[1:]:
+            if (raster.shape, raster.transform, raster.crs) != grid:
+                raise ValueError(
+                    f'{raster.name} is not on the grid of {first.name}')
+
+        height, width = first.shape
+        tmppath = path + '.tmp'
+        cube = np.lib.format.open_memmap(tmppath,
+                                         mode='w+',
+                                         dtype=CUBE_DTYPE,
+                                         shape=(height, width, len(rasters)))
+        for window in _get_strip_windows(first.shape, first.block_shapes[0],
+                                         len(rasters)):
+            rows, cols = window.toslices()
+            for i, raster in enumerate(rasters):
+                data = raster.read(1, window=window, masked=True)
+                cube[rows, cols, i] = data.astype(CUBE_DTYPE).filled(np.nan)
+        cube.flush()
+        del cube
+        metadata = {
+            'crs': first.crs.to_wkt(),
+            'transform': list(first.transform)[:6],
+            'shape': [height, width],
+        }
+
+    os.replace(tmppath, path)
+    return metadata
+
+
+def build_cube(dbpath, title, cubedir):
+    """Builds the cube of the datasets of a title.
+
+    The cube is written to `cubedir` and registered in the DB, replacing the
+    title's previous cube. Cubes are named after the identity of the raster
+    files they're built from, so a cube already in `cubedir` is reused if it
+    was built from the same files, even by another DB. A replaced cube is
+    deleted once no DB has it registered anymore.
+
+    Args:
+        dbpath: Path to a Terracotta-generated DB.
+        title: Title of the datasets.
+        cubedir: Path to directory for saving the cube.
+
+    Returns:
+        Path to the cube.
+
+    Raises:
+        ValueError: If the rasters of the title aren't all on the same grid.
+    """
+    with contextlib.closing(sqlite3.connect(dbpath)) as conn:
+        datasets = conn.execute(
+            "SELECT year, filepath FROM datasets WHERE title = ? "
+            "ORDER BY year", [title]).fetchall()
+    sources = [[year, *_get_file_identity(filepath)]
+               for year, filepath in datasets]
+
+    path = _get_cube_path(cubedir, title, sources)
+    metadata = _read_metadata(path)
+    if (metadata is None or metadata['sources'] != sources
+            or not os.path.exists(path)):
+        metadata = _write_cube(path, [filepath for _, filepath in datasets])
+        metadata['years'] = [year for year, _ in datasets]
+        metadata['sources'] = sources
+
+    # The sidecar lists the DBs using the cube, so it outlives replacements
+    # by any one of them
+    users = metadata.pop('dbs', [])
+    if os.path.abspath(dbpath) not in users:
+        users.append(os.path.abspath(dbpath))
+    _write_metadata(path, {**metadata, 'dbs': users})
+
+    with contextlib.closing(sqlite3.connect(dbpath, timeout=30)) as conn:
+        _create_cube_table(conn)
+        previous = conn.execute(
+            f"SELECT path FROM {CUBE_TABLE} WHERE title = ?",
+            [title]).fetchone()
+        conn.execute(f"INSERT OR REPLACE INTO {CUBE_TABLE} VALUES (?, ?, ?)",
+                     [title, path, json.dumps(metadata)])
+        conn.commit()
+
+    if previous is not None and previous[0] != path:
+        _release_cube(previous[0], dbpath)
+    return path
+
+
+def _drop_cube(dbpath, title):
+    with contextlib.closing(sqlite3.connect(dbpath, timeout=30)) as conn:
+        _create_cube_table(conn)
+        previous = conn.execute(
+            f"SELECT path FROM {CUBE_TABLE} WHERE title = ?",
+            [title]).fetchone()
+        conn.execute(f"DELETE FROM {CUBE_TABLE} WHERE title = ?", [title])
+        conn.commit()
+    if previous is not None:
+        _release_cube(previous[0], dbpath)
+
+
+def build_cubes(dbpath, cubedir, titles):
+    """Builds the cubes of several titles with `build_cube()`.
+
+    Titles whose rasters aren't all on the same grid are skipped with a
+    warning, and their previous cube is dropped from the DB, so it's never
+    read with fewer years than the title has.
+
+    Args:
+        dbpath: Path to a Terracotta-generated DB.
+        cubedir: Path to directory for saving the cubes.
+        titles: Iterable of titles.
+    """
+    for title in titles:
+        try:
+            build_cube(dbpath, title, cubedir)
+        except ValueError as err:
+            logging.warning(f"Skipping time-series cube of {title}: {err}")
+            _drop_cube(dbpath, title)
@@ -1,18 +1,34 @@
 """Ingest data into a Terracotta DB."""
+import collections
+import contextlib
 import glob
+import logging
 import os
 import re
-import logging
+import sqlite3
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
+import numpy as np
 import tqdm
+from rasterio.errors import RasterioIOError
 from terracotta import get_driver
 from terracotta.cog import validate as is_valid_cog
 
+from ..metrics import StageTimings
 from ..units import find_units
 from . import get_config
+from .cache import IngestionCache, get_fingerprint
+from .catalog import create_catalog, update_catalog
+from .convert import convert_raster, get_converted_path
+from .cube import build_cubes
 from .metadata import get_metadata
+from .stats import compute_metadata
 
 DB_NAME = 'terracotta.sqlite'
+QUEUE_SIZE = 4  # rasters in flight per worker process
+COMMIT_INTERVAL = 1  # seconds
+STATUS_TABLE = 'ingestion_status'
 GCBM_RASTER_NAME_PATTERN = r'.*_(?P<year>\d{4}).tif{1,2}'
 GCBM_RASTER_KEYS = ('title', 'year')
 GCBM_RASTER_KEYS_DESCRIPTION = {
@@ -35,51 +51,532 @@ class UnoptimizedRaster(Exception):
     """Raised when an unoptimized raster file is encountered."""
 
 
-def ingest(rasterdir, db_results, outputdir, allow_unoptimized=False):
+@contextlib.contextmanager
+def _get_submitter(jobs):
+    """Yields an `Executor.submit`-like callable for `jobs` worker processes.
+
+    With a single job, the function is run right away in the calling process.
+    """
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            yield executor.submit
+    else:
+        yield lambda func, *args: _completed(func(*args))
+
+
+def _completed(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _buffered(iterable, size):
+    """Iterates over `iterable`, staying up to `size` items ahead of the caller.
+
+    Used as a bounded queue between pipeline stages: the stage producing
+    `iterable` keeps working on the next items while the caller consumes the
+    current one, without ever holding more than `size` of them.
+    """
+    buffer = collections.deque()
+    for item in iterable:
+        buffer.append(item)
+        if len(buffer) > size:
+            yield buffer.popleft()
+    yield from buffer
+
+
+def _process_raster(path, allow_unoptimized, fast_stats, convertdir):
+    """Returns the validity and metadata of a raster, with the durations of
+    the stages taken to get them, since worker processes can't record them.
+    """
+    durations = []
+
+    def timed(stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        durations.append((stage, time.perf_counter() - start))
+        return result
+
+    is_valid = timed('validate', is_valid_cog, path)
+    if not is_valid and convertdir is not None:
+        path = timed('convert', convert_raster, path, convertdir)
+    elif not is_valid and not allow_unoptimized:
+        return is_valid, None, durations
+
+    return is_valid, timed('compute_metadata', compute_metadata, path,
+                           fast_stats), durations
+
+
+def _get_raster_keys(raster):
+    title = raster.get('title', raster['database_indicator'])
+    return title, _find_raster_year(raster['path'])
+
+
+def _iter_raster_files(rasterdir):
+    for config in get_config():
+        for file in glob.iglob(rasterdir + os.sep + config['file_pattern']):
+            yield dict(path=file, **config)
+
+
+def _get_extra_metadata(raster, metadata):
+    title, year = _get_raster_keys(raster)
+    unit = find_units(raster.get('graph_units'))
+    try:
+        indicator_value = str(metadata[title][year])
+    except KeyError:
+        # Handle missing metadata gracefully
+        logging.warning(f"Metadata for year {year} and title {title} is missing.")
+        indicator_value = "N/A"
+
+    return {
+        'indicator_value': indicator_value,
+        'colormap': raster.get('palette').lower(),
+        'unit': unit.value[2]
+    }
+
+
+def create_db(outputdir):
+    """Create an empty Terracotta database for GCBM rasters.
+
+    Besides the tables of Terracotta, the DB has a table for tracking the
+    progress of `ingest()`, and the catalog of datasets read by the UI (see
+    `catalog.Catalog`).
+
+    Args:
+        outputdir: Path to directory for saving the DB. An existing DB in it
+            is replaced.
+
+    Returns:
+        Path to the created DB.
+    """
+    dbpath = os.path.join(outputdir, DB_NAME)
+    if os.path.exists(dbpath):
+        os.remove(dbpath)
+    driver = get_driver(dbpath, provider='sqlite')
+    driver.create(GCBM_RASTER_KEYS, GCBM_RASTER_KEYS_DESCRIPTION)
+
+    with contextlib.closing(sqlite3.connect(driver.path)) as conn:
+        conn.execute(f"""
+            CREATE TABLE {STATUS_TABLE} (
+                processed INTEGER,
+                total INTEGER,
+                finished INTEGER,
+                error TEXT
+            )""")
+        conn.execute(f"INSERT INTO {STATUS_TABLE} VALUES (0, NULL, 0, NULL)")
+        create_catalog(conn)
+        conn.commit()
+
+    return driver.path
+
+
+def set_status(dbpath, **status):
+    """Update the ingestion progress stored in a DB made by `create_db()`.
+
+    Args:
+        dbpath: Path to the DB.
+        status: New values of `processed`, `total`, `finished` or `error`.
+    """
+    columns = ', '.join(f'{k} = ?' for k in status)
+    with contextlib.closing(sqlite3.connect(dbpath)) as conn:
+        conn.execute(f"UPDATE {STATUS_TABLE} SET {columns}",
+                     list(status.values()))
+        conn.commit()
+
+
+def get_status(dbpath):
+    """Read the ingestion progress stored in a DB made by `create_db()`.
+
+    Args:
+        dbpath: Path to the DB.
+
+    Returns:
+        A dict with keys `processed`, `total`, `finished` and `error`, or
+        None if the DB doesn't track the progress.
+    """
+    with contextlib.closing(sqlite3.connect(dbpath)) as conn:
+        conn.row_factory = sqlite3.Row
+        try:
+            row = conn.execute(f"SELECT * FROM {STATUS_TABLE}").fetchone()
+        except sqlite3.OperationalError:
+            return None
+
+    status = dict(row)
+    status['finished'] = bool(status['finished'])
+    return status
+
+
+def export_db(dbpath, outpath):
+    """Copy a DB made by `ingest()`, for serving it somewhere else.
+
+    The copy is moved into place once complete, so a DB at `outpath` can be
+    replaced while it's being served. Raster files are referenced by their
+    absolute path, so they must be available at the same path wherever the
+    copy is served.
+
+    Args:
+        dbpath: Path to the DB.
+        outpath: Path to write the copy to.
+    """
+    tmppath = outpath + '.tmp'
+    with contextlib.closing(sqlite3.connect(dbpath)) as src, \
+            contextlib.closing(sqlite3.connect(tmppath)) as dst:
+        src.backup(dst)
+    os.replace(tmppath, outpath)
+
+
+def _insert_rasters(driver, rasters):
+    with driver.connect():
+        for keys, path, metadata in rasters:
+            driver.insert(keys, path, metadata=metadata)
+
+
+def get_title_stats(metadata):
+    """Computes statistics shared by all datasets of an indicator.
+
+    Percentiles are approximated from those of the individual datasets, which
+    all cover the same area.
+
+    Args:
+        metadata: Sequence of the datasets' metadata from the Terracotta
+            driver.
+
+    Returns:
+        A dict with the `stretch_range` covering all datasets, and the 1st to
+        99th `title_percentiles` of their values.
+    """
+    lowers, uppers = zip(*(m['range'] for m in metadata))
+    percentiles = np.percentile(
+        np.concatenate([m['percentiles'] for m in metadata]),
+        np.arange(1, 100))
+    return {
+        'stretch_range': [float(min(lowers)), float(max(uppers))],
+        'title_percentiles': percentiles.tolist()
+    }
+
+
+def _update_title_stats(driver, titles):
+    """Adds the stats of `get_title_stats()` to every dataset of the titles.
+
+    Returns:
+        A dict mapping the titles to their stretch range.
+    """
+    stretch_ranges = {}
+    with driver.connect():
+        datasets = driver.get_datasets()
+        for title in titles:
+            metadata = {
+                keys: driver.get_metadata(keys)
+                for keys in datasets if keys[0] == title
+            }
+            stats = get_title_stats(list(metadata.values()))
+            for keys, dataset_metadata in metadata.items():
+                dataset_metadata['metadata'].update(stats)
+                driver.insert(keys,
+                              datasets[keys],
+                              metadata=dataset_metadata)
+            stretch_ranges[title] = stats['stretch_range']
+    return stretch_ranges
+
+
+def ingest(rasterdir,
+           db_results,
+           outputdir,
+           allow_unoptimized=False,
+           jobs=1,
+           cachedir=None,
+           create=True,
+           fast_stats=False,
+           convert=False,
+           timings=None,
+           cube=False):
     """Ingest raster files into a Terracotta database.
 
+    Rasters stream through discovery, COG validation, metadata computation
+    and insertion one by one, so each file is in the DB shortly after it's
+    found. Validation and metadata computation are spread across `jobs`
+    worker processes, while indicator values are extracted from `db_results`
+    in the background. Only the inserts into the generated DB happen in the
+    calling process. They're committed in batches, with the progress being
+    recorded in the DB (see `get_status()`), so the DB can be served while
+    it's being filled. The total number of rasters is recorded once they've
+    all been found. Once all rasters are in, statistics of each indicator
+    over all years (see `get_title_stats()`) are added to the metadata of its
+    datasets. Raster statistics are computed with bounded memory use (see
+    `stats.compute_metadata()`). The catalog of datasets read by the UI is
+    updated along with every batch of inserts.
+
+    With `convert`, rasters that aren't valid COGs are converted to ones (see
+    `convert.convert_raster()`) by the worker processes, and the converted
+    copies are ingested instead.
+
+    With `cube`, the datasets of every indicator are also copied into a
+    time-series cube (see `cube.build_cube()`) once all rasters are in.
+
+    If `cachedir` is given, results for rasters that haven't changed since a
+    previous run are read from the cache instead of being recomputed, and
+    indicator values are read from a snapshot of `db_results` kept there.
+
+    The time spent in every stage, including those run by worker processes,
+    is recorded in `timings`, along with counters of the rasters processed
+    and of cache hits and misses.
+
     Args:
         rasterdir: Path to directory containing raster files.
         db_results: Path to DB containing non-spatial data.
         outputdir: Path to directory for saving the generated DB.
         allow_unoptimized: Should unoptimized raster files be processed?
+        jobs: Number of worker processes to use.
+        cachedir: Path to directory of a persistent ingestion cache.
+        create: Create a new DB? If False, the DB must have already been
+            created in `outputdir` with `create_db()`.
+        fast_stats: Compute approximate raster statistics from overviews?
+        convert: Convert unoptimized rasters into `cachedir` (or `outputdir`
+            if not given)?
+        timings: A `metrics.StageTimings` instance.
+        cube: Build time-series cubes into `cachedir` (or `outputdir` if not
+            given)?
 
     Returns:
         Path to generated DB.
     """
-    driver = get_driver(os.path.join(outputdir, DB_NAME), provider='sqlite')
-    driver.create(GCBM_RASTER_KEYS, GCBM_RASTER_KEYS_DESCRIPTION)
+    start = time.perf_counter()
+    if timings is None:
+        timings = StageTimings()
+    if create:
+        dbpath = create_db(outputdir)
+    else:
+        dbpath = os.path.join(outputdir, DB_NAME)
+    driver = get_driver(dbpath, provider='sqlite')
+    convertdir = (cachedir or outputdir) if convert else None
+
+    with contextlib.ExitStack() as stack:
+        # Extract indicator values while the rasters are being processed
+        metadata_future = stack.enter_context(
+            ThreadPoolExecutor(max_workers=1)).submit(get_metadata,
+                                                      db_results, cachedir,
+                                                      timings)
+        cache = None
+        if cachedir is not None:
+            cache = stack.enter_context(IngestionCache(cachedir))
+        submit = stack.enter_context(_get_submitter(jobs))
+
+        def process(raster_files):
+            for raster in raster_files:
+                fingerprint = entry = None
+                if cache is not None:
+                    # Approximate stats mustn't be used in place of exact ones
+                    source = dict(raster,
+                                  fast_stats=True) if fast_stats else raster
+                    with timings.time('cache_lookup'):
+                        fingerprint = get_fingerprint(source)
+                        entry = cache.get(fingerprint)
+                    if entry is not None and convertdir is not None and not (
+                            entry['valid_cog'] or os.path.exists(
+                                get_converted_path(raster['path'],
+                                                   convertdir))):
+                        entry = None  # The converted copy is gone
+                    timings.count('cache_misses' if entry is None else
+                                  'cache_hits')
 
-    progress = tqdm.tqdm(get_config(), desc='Searching raster files')
-    raster_files = []
-    for config in progress:
-        for file in glob.glob(rasterdir + os.sep + config['file_pattern']):
-            if not is_valid_cog(file) and not allow_unoptimized:
+                if entry is None:
+                    future = submit(_process_raster, raster['path'],
+                                    allow_unoptimized, fast_stats, convertdir)
+                else:
+                    future = _completed(
+                        (entry['valid_cog'], entry['metadata'], []))
+                yield raster, fingerprint, entry is None, future
+
+        def discover():
+            # The total is only known once the directory has been listed
+            rasters = _iter_raster_files(rasterdir)
+            total = 0
+            seconds = 0.0
+            while True:
+                discover_start = time.perf_counter()
+                raster = next(rasters, None)
+                seconds += time.perf_counter() - discover_start
+                if raster is None:
+                    break
+                total += 1
+                yield raster
+            timings.add('discover', seconds)
+            progress.total = total
+            set_status(driver.path, total=total)
+
+        progress = tqdm.tqdm(_buffered(process(discover()),
+                                       QUEUE_SIZE * jobs),
+                             desc='Processing raster files')
+        batch = []
+        titles = set()
+        n_processed = 0
+        last_commit = time.monotonic()
+        for raster, fingerprint, is_new, future in progress:
+            with timings.time('wait_for_workers'):
+                is_valid, computed_metadata, durations = future.result()
+            for stage, seconds in durations:
+                timings.add(stage, seconds, path=raster['path'])
+            timings.count('rasters')
+            path = raster['path']
+            if not is_valid and convertdir is not None:
+                path = get_converted_path(path, convertdir)
+            elif not is_valid and not allow_unoptimized:
                 raise UnoptimizedRaster
-            raster_files.append(dict(path=file, **config))
+            if is_new and cache is not None:
+                with timings.time('cache_store'):
+                    cache.put(fingerprint, raster['path'], is_valid,
+                              computed_metadata)
 
-    with driver.connect():
-        metadata = get_metadata(db_results)
-        progress = tqdm.tqdm(raster_files, desc='Processing raster files')
-        for raster in progress:
-            title = raster.get('title', raster['database_indicator'])
-            year = _find_raster_year(raster['path'])
-            unit = find_units(raster.get('graph_units'))
-            try:
-                indicator_value = str(metadata[title][year])
-            except KeyError:
-                # Handle missing metadata gracefully
-                logging.warning(f"Metadata for year {year} and title {title} is missing.")
-                indicator_value = "N/A"
-            computed_metadata = driver.compute_metadata(
-                raster['path'],
-                extra_metadata={
-                    'indicator_value': indicator_value,
-                    'colormap': raster.get('palette').lower(),
-                    'unit': unit.value[2]
-                })
-            driver.insert((title, year),
-                          raster['path'],
-                          metadata=computed_metadata)
+            with timings.time('wait_for_indicator_values'):
+                metadata = metadata_future.result()
+            computed_metadata = dict(computed_metadata,
+                                     metadata=_get_extra_metadata(
+                                         raster, metadata))
+            keys = _get_raster_keys(raster)
+            titles.add(keys[0])
+            batch.append((keys, path, computed_metadata))
+
+            if time.monotonic() - last_commit >= COMMIT_INTERVAL:
+                with timings.time('insert', rasters=len(batch)):
+                    _insert_rasters(driver, batch)
+                    update_catalog(driver.path, batch)
+                    n_processed += len(batch)
+                    set_status(driver.path, processed=n_processed)
+                batch = []
+                last_commit = time.monotonic()
+
+        with timings.time('insert', rasters=len(batch)):
+            _insert_rasters(driver, batch)
+            update_catalog(driver.path, batch)
+            set_status(driver.path, processed=n_processed + len(batch))
+
+    with timings.time('title_stats', titles=len(titles)):
+        update_catalog(driver.path,
+                       stretch_ranges=_update_title_stats(driver, titles))
+    if cube:
+        with timings.time('cube', titles=len(titles)):
+            build_cubes(driver.path, cachedir or outputdir, titles)
+    set_status(driver.path, finished=True)
+    timings.add('total', time.perf_counter() - start)
 
     return driver.path
+
+
+def ingest_new(rasterdir,
+               dbpath,
+               db_results,
+               allow_unoptimized=False,
+               min_age=0,
+               cachedir=None,
+               fast_stats=False,
+               convert=False,
+               timings=None,
+               cube=False,
+               skipped=None):
+    """Ingest raster files that aren't in an existing Terracotta database yet.
+
+    Unlike `ingest()`, problematic files are skipped with a warning instead
+    of aborting, since they may still be in the middle of being written.
+    Skipped files are recorded in `skipped`, and aren't looked at again by
+    calls passing the same dict until they change.
+
+    Args:
+        rasterdir: Path to directory containing raster files.
+        dbpath: Path to a Terracotta-generated DB.
+        db_results: Path to DB containing non-spatial data.
+        allow_unoptimized: Should unoptimized raster files be processed?
+        min_age: Skip files modified less than this many seconds ago.
+        cachedir: Path to directory for keeping a snapshot of `db_results`.
+        fast_stats: Compute approximate raster statistics from overviews?
+        convert: Convert unoptimized rasters into `cachedir` (or the
+            directory of the DB if not given) and ingest the converted
+            copies?
+        timings: A `metrics.StageTimings` instance recording the time spent
+            in every stage.
+        cube: Rebuild the time-series cubes (see `cube.build_cube()`) of the
+            titles of new rasters, into `cachedir` (or the directory of the
+            DB if not given)?
+        skipped: dict mapping paths of skipped files to their size and
+            modification time, updated in place.
+
+    Returns:
+        List of keys of the newly ingested datasets.
+    """
+    if timings is None:
+        timings = StageTimings()
+    driver = get_driver(dbpath, provider='sqlite')
+    with driver.connect():
+        known_files = set(driver.get_datasets().values())
+    convertdir = None
+    if convert:
+        convertdir = cachedir or os.path.dirname(os.path.abspath(dbpath))
+
+    def is_known(path):
+        return path in known_files or (convertdir is not None
+                                       and get_converted_path(
+                                           path, convertdir) in known_files)
+
+    if skipped is None:
+        skipped = {}
+
+    def get_identity(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+
+    now = time.time()
+    with timings.time('discover'):
+        raster_files = []
+        for raster in _iter_raster_files(rasterdir):
+            if is_known(raster['path']):
+                continue
+            identity = get_identity(raster['path'])
+            if now - identity[1] >= min_age and skipped.get(
+                    raster['path']) != identity:
+                raster_files.append(dict(raster, identity=identity))
+    if not raster_files:
+        return []
+
+    metadata = get_metadata(db_results, cachedir, timings)
+    new_rasters = []
+    for raster in raster_files:
+        path = raster['path']
+        try:
+            with timings.time('validate', path=path):
+                is_valid = is_valid_cog(path)
+            if not is_valid:
+                if convertdir is not None:
+                    with timings.time('convert', path=path):
+                        path = convert_raster(path, convertdir)
+                elif not allow_unoptimized:
+                    logging.warning(f"Skipping unoptimized raster {path}.")
+                    skipped[path] = raster['identity']
+                    continue
+            with timings.time('compute_metadata', path=path):
+                computed_metadata = dict(
+                    compute_metadata(path, fast_stats),
+                    metadata=_get_extra_metadata(raster, metadata))
+        except (RasterioIOError, ValueError) as err:
+            logging.warning(f"Could not process {raster['path']}: {err}")
+            skipped[raster['path']] = raster['identity']
+            continue
+
+        timings.count('rasters')
+        new_rasters.append((_get_raster_keys(raster), path, computed_metadata))
+
+    # Insert the rasters along with the updated stats of their indicators in
+    # a single transaction, so readers never see one without the other. The
+    # same goes for the catalog, which can only be written once the driver's
+    # transaction is committed.
+    with timings.time('insert', rasters=len(new_rasters)):
+        with driver.connect():
+            _insert_rasters(driver, new_rasters)
+            stretch_ranges = _update_title_stats(
+                driver, {keys[0] for keys, _, _ in new_rasters})
+        update_catalog(dbpath, new_rasters, stretch_ranges)
+
+    if cube and new_rasters:
+        cubedir = cachedir or os.path.dirname(os.path.abspath(dbpath))
+        with timings.time('cube', titles=len(stretch_ranges)):
+            build_cubes(dbpath, cubedir, stretch_ranges)
+
+    return [keys for keys, _, _ in new_rasters]
@@ -1,7 +1,13 @@
 """Functions for extracting metadata from DB generated by GCBM"""
+import contextlib
+import hashlib
+import os
+import pathlib
 import sqlite3
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+from ..metrics import StageTimings
 from ..units import Units
 from . import get_config
 
@@ -13,63 +19,201 @@ RESULTS_TABLES = {
 }
 
 
-def _get_simulation_years(conn):
-    years = conn.execute(
-        "SELECT MIN(year), MAX(year) from v_age_indicators").fetchone()
+def _get_source_identity(db_results):
+    stat = os.stat(db_results)
+    return [os.path.abspath(db_results), stat.st_size, stat.st_mtime_ns]
+
+
+def _is_snapshot_current(path, identity):
+    if not os.path.exists(path):
+        return False
+
+    with contextlib.closing(sqlite3.connect(path)) as conn:
+        try:
+            row = conn.execute(
+                "SELECT path, size, mtime_ns FROM snapshot_source").fetchone()
+        except sqlite3.DatabaseError:
+            return False
+
+    return list(row or []) == identity
+
+
+def _create_snapshot(db_results, path):
+    tmp_path = f'{path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    with contextlib.closing(sqlite3.connect(tmp_path)) as conn:
+        conn.execute("ATTACH DATABASE ? AS results", [db_results])
+        conn.execute("""
+            CREATE TABLE v_age_indicators AS
+            SELECT DISTINCT year FROM results.v_age_indicators""")
+        for table, value_col in RESULTS_TABLES.items():
+            conn.execute(f"""
+                CREATE TABLE {table} (
+                    indicator TEXT,
+                    year INTEGER,
+                    {value_col} REAL,
+                    PRIMARY KEY (indicator, year)
+                )""")
+            conn.execute(f"""
+                INSERT INTO {table}
+                SELECT indicator, year, SUM({value_col})
+                FROM results.{table}
+                GROUP BY indicator, year""")
+        conn.execute(
+            "CREATE TABLE snapshot_source (path TEXT, size INTEGER, "
+            "mtime_ns INTEGER)")
+        conn.execute("INSERT INTO snapshot_source VALUES (?, ?, ?)",
+                     _get_source_identity(db_results))
+        conn.commit()
+
+    os.replace(tmp_path, path)
+
+
+def get_snapshot(db_results, cachedir):
+    """Return a local snapshot of the results views used for metadata.
+
+    The snapshot holds the annual sums of every indicator in tables indexed
+    by (indicator, year), so lookups don't have to scan the views of the
+    (often huge) results DB. It's reused as long as the size and modification
+    time of the results DB stay the same.
 
-    return years
+    Args:
+        db_results: Path to SQLite DB with non-spatial data.
+        cachedir: Path to directory for saving the snapshot.
 
+    Returns:
+        Path to the snapshot DB.
+    """
+    identity = _get_source_identity(db_results)
+    digest = hashlib.sha1(identity[0].encode()).hexdigest()[:16]
+    path = os.path.join(cachedir, f'results_{digest}.sqlite')
+    if not _is_snapshot_current(path, identity):
+        _create_snapshot(db_results, path)
 
-def _find_indicator_table(conn, indicator):
-    for table, value_col in RESULTS_TABLES.items():
-        if conn.execute(f"SELECT 1 FROM {table} WHERE indicator = ?",
-                        [indicator]).fetchone():
-            return table, value_col
+    return path
 
-    return None, None
+
+def _connect_readonly(path, immutable=False):
+    """Open a read-only connection to an SQLite DB.
+
+    `immutable` should only be set for DBs that can't change while the
+    connection is open, since SQLite skips all locking for them.
+    """
+    uri = f'{pathlib.Path(path).resolve().as_uri()}?mode=ro'
+    if immutable:
+        uri += '&immutable=1'
+    return sqlite3.connect(uri, uri=True)
 
 
-def _get_annual_result(conn, indicator, units=Units.Tc):
-    table, value_col = _find_indicator_table(conn, indicator)
+def _get_simulation_years(db_results, immutable=False):
+    with contextlib.closing(_connect_readonly(db_results, immutable)) as conn:
+        years = conn.execute(
+            "SELECT DISTINCT year FROM v_age_indicators ORDER BY year"
+        ).fetchall()
 
-    # If table is None, skip processing
-    if table is None:
-        print(f"Warning: No table found for indicator '{indicator}', skipping.")
-        return {}
+    return [year for year, in years]
 
+
+def _query_results_table(db_results, table, indicators, units, immutable):
+    value_col = RESULTS_TABLES[table]
     _, units_tc, _ = units.value
-    start_year, end_year = _get_simulation_years(conn)
-
-    db_result = conn.execute(f"""
-        SELECT years.year, COALESCE(SUM(i.{value_col}), 0) / {units_tc} AS value
-        FROM (SELECT DISTINCT year FROM v_age_indicators ORDER BY year) AS years
-        LEFT JOIN {table} i
-            ON years.year = i.year
-        WHERE i.indicator = '{indicator}'
-            AND (years.year BETWEEN {start_year} AND {end_year})
-        GROUP BY years.year
-        ORDER BY years.year
-    """).fetchall()
-
-    data = OrderedDict()
-    for year, value in db_result:
-        data[str(year)] = value
+    placeholders = ', '.join('?' * len(indicators))
+    with contextlib.closing(_connect_readonly(db_results, immutable)) as conn:
+        return conn.execute(
+            f"""
+            SELECT indicator, year, COALESCE(SUM({value_col}), 0) / {units_tc}
+            FROM {table}
+            WHERE indicator IN ({placeholders})
+            GROUP BY indicator, year
+        """, list(indicators)).fetchall()
+
+
+def _get_annual_results(db_results,
+                        indicators,
+                        units=Units.Tc,
+                        immutable=False,
+                        timings=None):
+    """Sum up the values of all given indicators by year.
+
+    Every results table is scanned once for all indicators, with the tables
+    being queried concurrently on separate read-only connections. As in
+    GCBM's own tools, an indicator is read from the first table of
+    `RESULTS_TABLES` that contains it. The query of every table is timed in
+    `timings`, if given.
+
+    Returns:
+        A dict mapping each indicator to an OrderedDict of year-wise values.
+        Indicators that aren't found in any table are left out.
+    """
+    indicators = sorted(indicators)
+    if timings is None:
+        timings = StageTimings()
+
+    def query(table):
+        with timings.time('results_table', table=table):
+            return _query_results_table(db_results, table, indicators, units,
+                                        immutable)
+
+    with ThreadPoolExecutor(max_workers=len(RESULTS_TABLES) + 1) as executor:
+        years_future = executor.submit(_get_simulation_years, db_results,
+                                       immutable)
+        table_results = list(executor.map(query, RESULTS_TABLES))
+        simulation_years = set(years_future.result())
+
+    data = {}
+    for rows in table_results:
+        found = set()
+        for indicator, year, value in sorted(rows):
+            if indicator in data and indicator not in found:
+                continue
+            found.add(indicator)
+            annual = data.setdefault(indicator, OrderedDict())
+            if year in simulation_years:
+                annual[str(year)] = value
 
     return data
 
-def get_metadata(db_results):
+
+def get_metadata(db_results, cachedir=None, timings=None):
     """Extract all metadata from non-spatial DB.
 
     Args:
         db_results: Path to SQLite DB with non-spatial data.
+        cachedir: Path to directory for keeping a snapshot of the DB. See
+            `get_snapshot()`.
+        timings: A `metrics.StageTimings` instance recording the time spent
+            getting the snapshot and querying the DB.
 
     Returns:
         A dict mapping keys to year-wise values of an indicator.
     """
+    indicators = {
+        config.get('title', config['database_indicator']):
+        config['database_indicator']
+        for config in get_config()
+    }
+
+    if timings is None:
+        timings = StageTimings()
+    immutable = cachedir is not None
+    if cachedir is not None:
+        # Snapshots are replaced rather than modified, so they can be opened
+        # without locking.
+        with timings.time('results_snapshot'):
+            db_results = get_snapshot(db_results, cachedir)
+    with timings.time('results_query'):
+        results = _get_annual_results(db_results,
+                                      indicators.values(),
+                                      immutable=immutable,
+                                      timings=timings)
+
     metadata = {}
-    conn = sqlite3.connect(db_results)
-    for config in get_config():
-        indicator = config['database_indicator']
-        title = config.get('title', indicator)
-        metadata[title] = _get_annual_result(conn, indicator)
+    for title, indicator in indicators.items():
+        if indicator not in results:
+            print(
+                f"Warning: No table found for indicator '{indicator}', skipping."
+            )
+        metadata[title] = results.get(indicator, {})
     return metadata
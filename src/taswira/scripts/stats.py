@@ -0,0 +1,169 @@
+"""Computation of raster metadata with bounded memory use."""
+import math
+import warnings
+
+import numpy as np
+import rasterio
+from rasterio import warp, windows
+from shapely import geometry
+
+SAMPLE_SIZE = 1000000  # values kept for estimating percentiles
+FAST_MAX_SIZE = 1024  # pixels read along each side in fast mode
+BLOCK_CACHE_SIZE = 32  # MB, blocks are only read once anyway
+
+
+def _get_hull_points(mask, transform):
+    """Returns the corners of the outermost valid pixels of every row."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    first_cols = np.argmax(mask[rows], axis=1)
+    last_cols = mask.shape[1] - np.argmax(mask[rows, ::-1], axis=1)
+    cols = np.concatenate([first_cols, first_cols, last_cols, last_cols])
+    rows = np.concatenate([rows, rows + 1, rows, rows + 1])
+    xs, ys = transform * (cols, rows)
+    return np.column_stack([xs, ys])
+
+
+class RasterStats:
+    """Accumulates statistics of raster data, chunk by chunk.
+
+    Minimum, maximum, mean and variance are exact. Percentiles are estimated
+    from a random sample of the values, whose size is bounded by
+    `SAMPLE_SIZE`. The convex hull of valid data is reduced to its vertices
+    after every chunk.
+
+    Args:
+        size: Total number of pixels that will be accumulated.
+    """
+    def __init__(self, size):
+        self.total = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.mean = 0.0
+        self.m2 = 0.0
+        self._sample_rate = min(1.0, SAMPLE_SIZE / max(size, 1))
+        self._samples = []
+        self._hull = np.empty((0, 2))
+        self._rng = np.random.default_rng(0)
+
+    def update(self, data, transform):
+        """Adds a chunk of data.
+
+        Args:
+            data: 2D masked array of the chunk.
+            transform: Affine transform of the chunk.
+        """
+        data = np.ma.masked_invalid(data)
+        self.total += data.size
+        valid = data.compressed().astype('float64')
+        if valid.size == 0:
+            return
+
+        # Chan et al.'s method of combining the mean and variance of chunks
+        count = self.count + valid.size
+        mean = valid.mean()
+        delta = mean - self.mean
+        self.m2 += ((valid - mean)**2).sum() + delta**2 * self.count * (
+            valid.size / count)
+        self.mean += delta * valid.size / count
+        self.count = count
+        self.min = min(self.min, valid.min())
+        self.max = max(self.max, valid.max())
+
+        if self._sample_rate < 1:
+            valid = valid[self._rng.random(valid.size) < self._sample_rate]
+        self._samples.append(valid)
+
+        hull = geometry.MultiPoint(
+            np.concatenate(
+                [self._hull,
+                 _get_hull_points(~np.ma.getmaskarray(data), transform)
+                 ])).convex_hull
+        if hull.geom_type == 'Polygon':
+            hull = hull.exterior
+        self._hull = np.array(hull.coords)
+
+    def result(self, crs):
+        """Returns the accumulated statistics, or None if no data was valid.
+
+        Args:
+            crs: Coordinate reference system of the data, for transforming
+                the convex hull to WGS84.
+        """
+        if self.count == 0:
+            return None
+
+        convex_hull = geometry.MultiPoint(self._hull).convex_hull
+        return {
+            'valid_percentage': self.count / self.total * 100,
+            'range': (float(self.min), float(self.max)),
+            'mean': float(self.mean),
+            'stdev': math.sqrt(self.m2 / self.count),
+            'percentiles': np.percentile(np.concatenate(self._samples),
+                                         np.arange(1, 100)),
+            'convex_hull': warp.transform_geom(crs, 'epsg:4326',
+                                               geometry.mapping(convex_hull))
+        }
+
+
+def _read_masked(src, **kwargs):
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='invalid value encountered.*')
+        data = src.read(1, masked=True, **kwargs)
+
+    if src.nodata is not None:
+        # Resampled reads can let nodata values through
+        data[data == src.nodata] = np.ma.masked
+    return data
+
+
+def compute_metadata(path, fast=False):
+    """Computes the metadata of a raster like Terracotta's drivers do.
+
+    Unlike `driver.compute_metadata()`, the raster is read one internal block
+    at a time, so memory use doesn't grow with its size. See `RasterStats`
+    for the accuracy of the statistics.
+
+    Args:
+        path: Path to the raster file.
+        fast: Compute statistics from a single read of at most
+            `FAST_MAX_SIZE` pixels along each side instead, which GDAL serves
+            from the overviews of the raster. Much faster, but statistics
+            are only approximate.
+
+    Returns:
+        A dict of metadata that can be passed to `driver.insert()`, except
+        for the extra `metadata` key.
+
+    Raises:
+        ValueError: If the raster doesn't contain any valid data.
+    """
+    with rasterio.Env(GDAL_CACHEMAX=BLOCK_CACHE_SIZE), \
+            rasterio.open(path) as src:
+        bounds = warp.transform_bounds(src.crs,
+                                       'epsg:4326',
+                                       *src.bounds,
+                                       densify_pts=21)
+
+        if fast:
+            scale = max(src.width / FAST_MAX_SIZE,
+                        src.height / FAST_MAX_SIZE, 1)
+            out_shape = (math.ceil(src.height / scale),
+                         math.ceil(src.width / scale))
+            stats = RasterStats(out_shape[0] * out_shape[1])
+            stats.update(
+                _read_masked(src, out_shape=out_shape),
+                src.transform * src.transform.scale(
+                    src.width / out_shape[1], src.height / out_shape[0]))
+        else:
+            stats = RasterStats(src.width * src.height)
+            for _, window in src.block_windows(1):
+                stats.update(_read_masked(src, window=window),
+                             windows.transform(window, src.transform))
+
+        raster_stats = stats.result(src.crs)
+
+    if raster_stats is None:
+        raise ValueError(f'Raster file {path} does not contain any valid data')
+
+    return dict(raster_stats, bounds=bounds)
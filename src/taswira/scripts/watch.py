@@ -0,0 +1,89 @@
+"""Incremental ingestion of rasters written by an in-progress GCBM run."""
+import multiprocessing
+import time
+
+from . import get_config, update_config
+from .ingestion import ingest_new
+
+POLL_INTERVAL = 5
+
+
+def watch(rasterdir,
+          dbpath,
+          db_results,
+          allow_unoptimized=False,
+          interval=POLL_INTERVAL,
+          cachedir=None,
+          fast_stats=False,
+          convert=False,
+          cube=False):
+    """Poll for new raster files and ingest them into an existing DB.
+
+    Files are only picked up once they haven't been modified for a whole
+    polling interval, so rasters that GCBM is still writing are left alone.
+    Files that can't be ingested are only looked at again once they change.
+
+    Args:
+        rasterdir: Path to directory containing raster files.
+        dbpath: Path to a Terracotta-generated DB.
+        db_results: Path to DB containing non-spatial data.
+        allow_unoptimized: Should unoptimized raster files be processed?
+        interval: Number of seconds to wait between polls.
+        cachedir: Path to directory for keeping a snapshot of `db_results`.
+        fast_stats: Compute approximate raster statistics from overviews?
+        convert: Convert unoptimized rasters to COGs and ingest those?
+        cube: Rebuild the time-series cubes of indicators with new rasters?
+    """
+    skipped = {}
+    while True:
+        ingest_new(rasterdir,
+                   dbpath,
+                   db_results,
+                   allow_unoptimized,
+                   min_age=interval,
+                   cachedir=cachedir,
+                   fast_stats=fast_stats,
+                   convert=convert,
+                   cube=cube,
+                   skipped=skipped)
+        time.sleep(interval)
+
+
+def _run_watcher(config, *args, **kwargs):
+    update_config(config)
+    watch(*args, **kwargs)
+
+
+def start_watcher(rasterdir,
+                  dbpath,
+                  db_results,
+                  allow_unoptimized=False,
+                  cachedir=None,
+                  fast_stats=False,
+                  convert=False,
+                  cube=False):
+    """Run `watch()` in a daemon process.
+
+    Args:
+        rasterdir: Path to directory containing raster files.
+        dbpath: Path to a Terracotta-generated DB.
+        db_results: Path to DB containing non-spatial data.
+        allow_unoptimized: Should unoptimized raster files be processed?
+        cachedir: Path to directory for keeping a snapshot of `db_results`.
+        fast_stats: Compute approximate raster statistics from overviews?
+        convert: Convert unoptimized rasters to COGs and ingest those?
+        cube: Rebuild the time-series cubes of indicators with new rasters?
+
+    Returns:
+        The started `multiprocessing.Process`.
+    """
+    proc = multiprocessing.Process(target=_run_watcher,
+                                   args=(get_config(), rasterdir, dbpath,
+                                         db_results, allow_unoptimized),
+                                   kwargs=dict(cachedir=cachedir,
+                                               fast_stats=fast_stats,
+                                               convert=convert,
+                                               cube=cube),
+                                   daemon=True)
+    proc.start()
+    return proc
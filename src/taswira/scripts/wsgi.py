@@ -0,0 +1,210 @@
+"""Serving of the app with several worker processes and threads."""
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+from ..drivers import reset_raster_executor
+
+MIN_WORKER_LIFETIME = 5  # seconds, workers dying sooner failed to start
+RESPAWN_DELAY = 1  # seconds, before replacing a worker that failed to start
+MAX_STARTUP_FAILURES = 5  # in a row, before giving up
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug server handling requests on a fixed-size pool of threads.
+
+    Args:
+        host: Address to listen on.
+        port: Port number to listen on.
+        app: WSGI application to serve.
+        threads: Number of requests handled at a time.
+        fd: File descriptor of an already listening socket to use instead of
+            binding a new one.
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, threads=1, fd=None):
+        super().__init__(host, port, app, fd=fd)
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:  # pylint: disable=broad-except
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False)
+
+
+def _serve_worker(app, host, sock, threads):
+    executor = reset_raster_executor()
+    server = PooledWSGIServer(host, 0, app, threads, fd=sock.fileno())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        executor.shutdown()
+
+
+def _serve_prefork(app, host, port, workers, threads):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                _serve_worker(app, host, sock, threads)
+                status = 0
+            except (KeyboardInterrupt, SystemExit):
+                status = 0
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+            finally:
+                # Never return into the master's code, even when interrupted
+                # while handling an exception
+                os._exit(status)  # pylint: disable=protected-access
+        spawn_times[pid] = time.monotonic()
+        return pid
+
+    def handler(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, handler)
+    spawn_times = {}
+    children = {spawn() for _ in range(workers)}
+    startup_failures = 0
+    try:
+        while children:
+            pid, status = os.wait()
+            children.discard(pid)
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                continue
+
+            # Replace workers that crashed, like other pre-forking servers do,
+            # but give up on ones that can't even start
+            lifetime = time.monotonic() - spawn_times.pop(pid)
+            if lifetime >= MIN_WORKER_LIFETIME:
+                startup_failures = 0
+            else:
+                startup_failures += 1
+                if startup_failures >= MAX_STARTUP_FAILURES:
+                    sys.exit('Error: Server workers keep failing to start, '
+                             'see the errors above.')
+                time.sleep(RESPAWN_DELAY)
+            children.add(spawn())
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sock.close()
+
+
+def _serve_gunicorn(app, host, port, workers, threads):
+    from gunicorn.app.base import BaseApplication  # pylint: disable=import-outside-toplevel
+
+    class Application(BaseApplication):  # pylint: disable=abstract-method
+        """Gunicorn application serving `app` with threaded workers."""
+        def load_config(self):
+            """Sets the Gunicorn config from the arguments."""
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('post_fork',
+                         lambda server, worker: reset_raster_executor())
+
+        def load(self):
+            """Returns the WSGI app to serve."""
+            return app
+
+    Application().run()
+
+
+def _serve_waitress(app, host, port, threads):
+    from waitress import serve as waitress_serve  # pylint: disable=import-outside-toplevel
+
+    waitress_serve(app, host=host, port=port, threads=threads)
+
+
+def _is_installed(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+def get_backend(workers):
+    """Picks the server to use for the given number of worker processes.
+
+    Gunicorn and Waitress are used if installed. Waitress can't run several
+    processes though, so it's only used for a single one.
+
+    Args:
+        workers: Number of worker processes.
+
+    Returns:
+        One of 'gunicorn', 'waitress', 'prefork' (the built-in pre-forking
+        server) or 'threaded' (a single process, where forking isn't
+        supported).
+    """
+    can_fork = hasattr(os, 'fork')
+    if can_fork and _is_installed('gunicorn'):
+        return 'gunicorn'
+    if workers == 1 and _is_installed('waitress'):
+        return 'waitress'
+    return 'prefork' if can_fork else 'threaded'
+
+
+def serve(app, host, port, workers=1, threads=1):
+    """Serves a WSGI app from several processes, each using several threads.
+
+    Processes are forked from the calling one once the app is set up, so
+    they share everything loaded beforehand (like the ingested DB). Every
+    process keeps its own in-memory state, like tile caches. Crashed workers
+    are replaced, but the built-in server exits once they keep failing right
+    after starting.
+
+    Args:
+        app: WSGI application to serve.
+        host: Address to listen on.
+        port: Port number to listen on.
+        workers: Number of worker processes.
+        threads: Number of threads per worker process.
+    """
+    backend = get_backend(workers)
+    if backend == 'gunicorn':
+        _serve_gunicorn(app, host, port, workers, threads)
+    elif backend == 'waitress':
+        _serve_waitress(app, host, port, threads)
+    elif backend == 'prefork':
+        _serve_prefork(app, host, port, workers, threads)
+    else:
+        if workers > 1:
+            print("Warning: Multiple workers aren't supported on this "
+                  "platform, using a single one.",
+                  file=sys.stderr)
+        server = PooledWSGIServer(host, port, app, threads)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
@@ -0,0 +1,286 @@
+"""Tiles comparing or aggregating several years of an indicator.
+
+Tiles are computed on the fly from the tiles of the ingested datasets, which
+Terracotta reads from windows of their COGs, so no raster is ever written.
+"""
+import functools
+import json
+import urllib.parse
+
+import mercantile
+import numpy as np
+import terracotta as tc
+from terracotta import exceptions, image, xyz
+
+OPERATIONS = ('difference', 'ratio', 'sum')
+DIVERGING_COLORMAP = 'rdbu'
+STRETCH_PERCENTILES = (2, 98)
+STRETCH_TILE_SIZE = (256, 256)  # pixels read from each dataset for stretching
+
+
+def get_operand_years(years, operation, start, end):
+    """Returns the years of the datasets an operation combines.
+
+    Differences and ratios compare the `end` year to the `start` year, while
+    sums add up all years from `start` to `end`. `end` may come before
+    `start`, like when comparing the past to a base year.
+
+    Args:
+        years: Sorted sequence of the years of all datasets of a title.
+        operation: One of `OPERATIONS`.
+        start: First year.
+        end: Last year.
+
+    Raises:
+        InvalidArgumentsError: If the operation is unknown.
+        DatasetNotFoundError: If `start` or `end` isn't a year of a dataset.
+    """
+    if operation not in OPERATIONS:
+        raise exceptions.InvalidArgumentsError(
+            f'Unknown operation {operation}')
+    for year in (start, end):
+        if year not in years:
+            raise exceptions.DatasetNotFoundError(
+                f'No dataset for year {year}')
+
+    if operation == 'sum':
+        first, last = sorted([start, end])
+        return [year for year in years if first <= year <= last]
+    return [start, end]
+
+
+def combine(operation, arrays):
+    """Combines masked arrays of several years, pixel by pixel.
+
+    Args:
+        operation: One of `OPERATIONS`.
+        arrays: Iterable of masked arrays, ordered as returned by
+            `get_operand_years()`. Only one is held at a time for sums.
+
+    Returns:
+        A masked array. Pixels missing from a compared year, or from all
+        summed years, are masked, as are ratios to zero.
+    """
+    arrays = iter(arrays)
+    if operation == 'sum':
+        first = next(arrays)
+        total = np.ma.filled(first.astype('float64'), 0)
+        valid = ~np.ma.getmaskarray(first)
+        for array in arrays:
+            total += np.ma.filled(array, 0)
+            valid |= ~np.ma.getmaskarray(array)
+        return np.ma.masked_array(total, ~valid)
+
+    start, end = (array.astype('float64') for array in arrays)
+    if operation == 'difference':
+        return end - start
+    return np.ma.divide(end, start)
+
+
+def _get_datasets(catalog, title, years):
+    """Returns the datasets of a title in the catalog, which is read again
+    if some of `years` are missing, like those ingested since it was cached.
+    """
+    datasets = catalog.get_datasets(title)
+    if not set(years) <= set(datasets):
+        catalog.get_titles()  # Drops the title if its datasets changed
+        datasets = catalog.get_datasets(title)
+    return datasets
+
+
+def _read_tiles(catalog, title, years, tile_xyz, tile_size):
+    """Reads a tile of the datasets of several years, checking it against
+    the bounds in the catalog rather than the metadata of every dataset.
+    """
+    tile_bounds = None
+    if tile_xyz is not None:
+        datasets = catalog.get_datasets(title)
+        tile_x, tile_y, tile_z = tile_xyz
+        for year in years:
+            if not xyz.tile_exists(datasets[year]['bounds'], tile_x, tile_y,
+                                   tile_z):
+                raise exceptions.TileOutOfBoundsError(
+                    f'Tile {tile_z}/{tile_x}/{tile_y} is outside image '
+                    'bounds')
+        tile_bounds = mercantile.xy_bounds(tile_x, tile_y, tile_z)
+
+    driver = tc.get_driver(catalog.dbpath, provider='sqlite')
+    with driver.connect():
+        futures = [
+            driver.get_raster_tile((title, year),
+                                   tile_bounds=tile_bounds,
+                                   tile_size=tile_size,
+                                   asynchronous=True) for year in years
+        ]
+    for future in futures:
+        yield future.result()
+
+
+def _get_stretch_center(operation):
+    return {'difference': 0, 'ratio': 1}.get(operation)
+
+
+@functools.lru_cache(maxsize=256)
+def get_temporal_stretch_range(catalog, operation, title, start, ends):
+    """Returns the stretch range of tiles of an operation over several years.
+
+    The range covers the 2nd to 98th percentiles of the results for all the
+    `ends` years, computed from reads of whole datasets at a low resolution
+    (which GDAL serves from overviews). Ranges of differences and ratios are
+    centered on 0 and 1 respectively, for diverging colormaps. Ranges are
+    cached, since they're shared by all tiles.
+
+    Args:
+        catalog: `catalog.Catalog` of the DB being served.
+        operation: One of `OPERATIONS`.
+        title: Title of the datasets.
+        start: First year.
+        ends: Tuple of the last years.
+
+    Returns:
+        A tuple of lower and upper limit.
+    """
+    years = list(_get_datasets(catalog, title, (start, *ends)))
+    operand_years = {
+        end: get_operand_years(years, operation, start, end)
+        for end in ends
+    }
+
+    # Every year is only read once, however many results it's part of
+    read_years = sorted(set().union(*operand_years.values()))
+    arrays = dict(
+        zip(read_years,
+            _read_tiles(catalog, title, read_years, None,
+                        STRETCH_TILE_SIZE)))
+    values = np.concatenate([
+        combine(operation, (arrays[year] for year in operand_years[end]))
+        .compressed() for end in ends
+    ])
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        lower = upper = 0.0
+    else:
+        lower, upper = np.percentile(values, STRETCH_PERCENTILES)
+
+    center = _get_stretch_center(operation)
+    if center is not None:
+        spread = max(abs(lower - center), abs(upper - center))
+        lower, upper = center - spread, center + spread
+    if upper <= lower:
+        lower, upper = lower - 1, upper + 1
+    return float(lower), float(upper)
+
+
+def render_tile(catalog,
+                operation,
+                title,
+                start,
+                end,
+                tile_xyz,
+                stretch_range=None,
+                colormap=None):
+    """Renders a tile of the result of an operation on several years.
+
+    The years and bounds of the datasets are read from the catalog, so the
+    DB is only queried for the paths of the datasets being read.
+
+    Args:
+        catalog: `catalog.Catalog` of the DB being served.
+        operation: One of `OPERATIONS`.
+        title: Title of the datasets.
+        start: First year.
+        end: Last year.
+        tile_xyz: Tuple of the x, y and z coordinates of the tile.
+        stretch_range: Lower and upper limit of the colormap, or None
+            for the one returned by `get_temporal_stretch_range()`.
+        colormap: Name of a Terracotta colormap.
+
+    Returns:
+        A file-like object of the PNG image.
+    """
+    settings = tc.get_settings()
+    years = get_operand_years(
+        list(_get_datasets(catalog, title, (start, end))), operation, start,
+        end)
+    if stretch_range is None:
+        stretch_range = get_temporal_stretch_range(catalog, operation, title,
+                                                   start, (end, ))
+
+    result = combine(
+        operation,
+        _read_tiles(catalog, title, years, tile_xyz,
+                    settings.DEFAULT_TILE_SIZE))
+    result = np.ma.masked_invalid(result)
+    out = np.ma.filled(image.to_uint8(result, *stretch_range), 0)
+    return image.array_to_png(out, colormap=colormap)
+
+
+def get_temporal_tile_url(operation,
+                          title,
+                          start,
+                          end,
+                          options,
+                          xyz_path='{z}/{x}/{y}'):
+    """Builds the URL of the tiles of an operation on several years.
+
+    Args:
+        operation: One of `OPERATIONS`.
+        title: Title of the datasets.
+        start: First year.
+        end: Last year.
+        options: dict of the `colormap` and `stretch_range` of the tiles.
+        xyz_path: Tile coordinates, or a template for Leaflet by default.
+
+    Returns:
+        URL string.
+    """
+    path = urllib.parse.quote(f'{operation}/{title}/{start}/{end}')
+    query = urllib.parse.urlencode({
+        'colormap':
+        options['colormap'],
+        'stretch_range':
+        json.dumps(options['stretch_range'], separators=(',', ':')),
+    })
+    return f"/temporal/{path}/{xyz_path}.png?{query}"
+
+
+def install_temporal_tiles(server, catalog):
+    """Serves the tiles of `render_tile()` from a Flask app.
+
+    Tiles are served from `/temporal/{operation}/{title}/{start}/{end}/{z}/
+    {x}/{y}.png`, with optional `colormap` and `stretch_range` query
+    arguments. Their paths match `tiles.TILE_PATH_PATTERN`, so they're cached
+    and rendered like the tiles of single datasets if
+    `tiles.install_tile_cache()` and `rendering.install_tile_renderer()`
+    are installed.
+
+    Args:
+        server: Flask instance serving the Terracotta API.
+        catalog: `catalog.Catalog` of the DB being served.
+    """
+    from flask import request, send_file  # pylint: disable=import-outside-toplevel
+    from terracotta.cmaps import AVAILABLE_CMAPS  # pylint: disable=import-outside-toplevel
+    from terracotta.server.flask_api import convert_exceptions  # pylint: disable=import-outside-toplevel
+
+    @server.route('/temporal/<operation>/<title>/<start>/<end>/<int:tile_z>/'
+                  '<int:tile_x>/<int:tile_y>.png')
+    @convert_exceptions
+    def get_temporal_tile(operation, title, start, end, tile_z, tile_x,
+                          tile_y):  # pylint: disable=unused-variable
+        colormap = request.args.get('colormap')
+        if colormap is not None and colormap not in AVAILABLE_CMAPS:
+            raise exceptions.InvalidArgumentsError(
+                f'Unknown colormap {colormap}')
+
+        stretch_range = request.args.get('stretch_range')
+        if stretch_range is not None:
+            try:
+                lower, upper = map(float, json.loads(stretch_range))
+            except (TypeError, ValueError):
+                raise exceptions.InvalidArgumentsError(
+                    f'Invalid stretch range {stretch_range}') from None
+            stretch_range = [lower, upper]
+
+        tile = render_tile(catalog, operation, title, start, end,
+                           (tile_x, tile_y, tile_z), stretch_range, colormap)
+        return send_file(tile, mimetype='image/png')
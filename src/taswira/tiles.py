@@ -0,0 +1,340 @@
+"""Caching of rendered Terracotta tiles."""
+import contextlib
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+
+TILE_PATH_PATTERN = re.compile(
+    r'^/(?:singleband|temporal)/(?P<keys>.+)/'
+    r'(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$')
+
+
+class TileCache:
+    """Thread-safe LRU cache of encoded tiles, bounded by their total size.
+
+    Args:
+        max_bytes: Memory budget of the cache in bytes.
+    """
+    name = 'memory'
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached tile for the given key, or None on a miss."""
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._tiles.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        """Adds a tile, evicting the least recently used tiles to make room.
+
+        Tiles larger than the whole budget are not cached.
+        """
+        if len(tile) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._tiles:
+                self.size -= len(self._tiles.pop(key))
+            self._tiles[key] = tile
+            self.size += len(tile)
+            while self.size > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self):
+        """Returns a dict of the cache's counters."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'tiles': len(self._tiles),
+                'size': self.size,
+                'max_size': self.max_bytes,
+            }
+
+
+def get_tile_key(path, args):
+    """Builds the cache key of a tile request.
+
+    Args:
+        path: Path of the request (like `/singleband/title/year/z/x/y.png`).
+        args: Mapping of query arguments.
+
+    Returns:
+        A tuple of the dataset keys, the tile coordinates and the options
+        that affect rendering (colormap, stretch range, etc.), or None if the
+        path is not of a tile. The keys of tiles combining several years
+        (see `temporal.install_temporal_tiles()`) are the operation, title
+        and first and last year.
+    """
+    match = TILE_PATH_PATTERN.match(path)
+    if match is None:
+        return None
+
+    keys = tuple(k for k in match.group('keys').split('/') if k)
+    xyz = tuple(int(match.group(c)) for c in 'zxy')
+    return keys, xyz, tuple(sorted(args.items()))
+
+
+def get_tile_url(keys, metadata, xyz='{z}/{x}/{y}'):
+    """Builds the URL the UI requests the tiles of a dataset from.
+
+    Args:
+        keys: Sequence of title and year of the dataset.
+        metadata: dict of the dataset's metadata from the Terracotta driver.
+        xyz: Tile coordinates, or a template for Leaflet by default.
+
+    Returns:
+        URL string.
+    """
+    path = urllib.parse.quote('/'.join(keys))
+    query = urllib.parse.urlencode(get_tile_options(metadata))
+    return f"/singleband/{path}/{xyz}.png?{query}"
+
+
+def get_tile_options(metadata):
+    """Returns a dict of the query arguments for rendering a dataset.
+
+    Datasets are stretched over the range of all years of their indicator if
+    it's known (see `ingestion.get_title_stats()`), so their colors can be
+    compared.
+    """
+    options = {'colormap': metadata['metadata']['colormap']}
+    stretch_range = metadata['metadata'].get('stretch_range')
+    if stretch_range is not None:
+        options['stretch_range'] = json.dumps(stretch_range,
+                                              separators=(',', ':'))
+    return options
+
+
+def get_dataset_identity(dbpath, keys):
+    """Identifies the contents of the raster file of a dataset.
+
+    Args:
+        dbpath: Path to a Terracotta-generated DB.
+        keys: Sequence of title and year of the dataset.
+
+    Returns:
+        A list of the file's path, size and modification time, or None if
+        there's no such dataset, or the keys aren't of a single dataset.
+    """
+    if len(keys) != 2:
+        return None
+
+    with contextlib.closing(sqlite3.connect(dbpath)) as conn:
+        row = conn.execute(
+            "SELECT filepath FROM datasets WHERE title = ? AND year = ?",
+            list(keys)).fetchone()
+    if row is None:
+        return None
+
+    return _get_file_identity(row[0])
+
+
+def _get_file_identity(path):
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+class DiskTileCache:
+    """SQLite-backed cache of encoded tiles, bounded by their total size.
+
+    Tiles are keyed on the identity of the raster file they're rendered from
+    (see `get_dataset_identity()`) instead of the dataset keys, so the cache
+    stays valid across restarts and re-ingestion. It can be shared by several
+    processes. The least recently used tiles are evicted once the total size
+    exceeds the budget.
+
+    Args:
+        cachedir: Path to directory for saving the cache DB.
+        max_bytes: Disk budget of the cache in bytes.
+        dbpath: Path to the Terracotta-generated DB being served.
+    """
+    name = 'disk'
+    DB_NAME = 'tiles.sqlite'
+    EVICTION_INTERVAL = 100  # puts
+    TOUCH_INTERVAL = 60  # seconds
+
+    def __init__(self, cachedir, max_bytes, dbpath):
+        self.path = os.path.join(cachedir, self.DB_NAME)
+        self.max_bytes = max_bytes
+        self.dbpath = dbpath
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._identities = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tiles (
+                    key TEXT PRIMARY KEY,
+                    data BLOB,
+                    size INTEGER,
+                    accessed REAL
+                )""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed)")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # Connections can't be used by processes forked after opening them
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _get_disk_key(self, key):
+        keys, xyz, options = key
+        identity = self._identities.get(keys)
+        try:
+            if identity is None or _get_file_identity(
+                    identity[0]) != identity:
+                identity = get_dataset_identity(self.dbpath, keys)
+                self._identities[keys] = identity
+        except OSError:
+            return None
+
+        if identity is None:
+            return None
+        return hashlib.sha1(json.dumps([identity, xyz,
+                                        options]).encode()).hexdigest()
+
+    def get(self, key):
+        """Returns the cached tile for the given key, or None on a miss."""
+        disk_key = self._get_disk_key(key)
+        row = None
+        if disk_key is not None:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT data, accessed FROM tiles WHERE key = ?",
+                    [disk_key]).fetchone()
+                # Only refresh the access time once in a while, to avoid
+                # a write on every read
+                now = time.time()
+                if row is not None and now - row[1] > self.TOUCH_INTERVAL:
+                    conn.execute(
+                        "UPDATE tiles SET accessed = ? WHERE key = ?",
+                        [now, disk_key])
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0]
+
+    def put(self, key, tile):
+        """Adds a tile, evicting the least recently used tiles if needed."""
+        disk_key = self._get_disk_key(key)
+        if disk_key is None or len(tile) > self.max_bytes:
+            return
+
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                         [disk_key, tile, len(tile), time.time()])
+
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % self.EVICTION_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Deletes the least recently used tiles until within budget."""
+        with self._connect() as conn:
+            size, = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()
+            if size <= self.max_bytes:
+                return
+
+            rows = conn.execute(
+                "SELECT key, size FROM tiles ORDER BY accessed").fetchall()
+            evicted = []
+            for disk_key, tile_size in rows:
+                if size <= self.max_bytes:
+                    break
+                evicted.append((disk_key, ))
+                size -= tile_size
+            conn.executemany("DELETE FROM tiles WHERE key = ?", evicted)
+
+    def stats(self):
+        """Returns a dict of the cache's counters."""
+        with self._connect() as conn:
+            count, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tiles").fetchone()
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'tiles': count,
+                'size': size,
+                'max_size': self.max_bytes,
+            }
+
+
+def install_tile_cache(server, *caches):
+    """Serves the tiles of a Flask app from caches.
+
+    Caches are looked up in the given order, and a tile found in one of them
+    is added to the ones before it. Rendered tiles are added to all caches as
+    they're served. The caches' counters are available from the `/tile-cache`
+    endpoint.
+
+    Args:
+        server: Flask instance serving the Terracotta API.
+        caches: `TileCache` or `DiskTileCache` instances, fastest first.
+    """
+    from flask import Response, g, jsonify, request  # pylint: disable=import-outside-toplevel
+
+    @server.before_request
+    def serve_cached_tile():  # pylint: disable=unused-variable
+        g.tile_key = get_tile_key(request.path, request.args)
+        if g.tile_key is None:
+            return None
+
+        for i, cache in enumerate(caches):
+            tile = cache.get(g.tile_key)
+            if tile is not None:
+                for faster_cache in caches[:i]:
+                    faster_cache.put(g.tile_key, tile)
+                g.tile_key = None
+                return Response(tile, mimetype='image/png')
+
+        return None
+
+    @server.after_request
+    def cache_tile(response):  # pylint: disable=unused-variable
+        if g.get('tile_key') is None or response.status_code != 200:
+            return response
+
+        response.direct_passthrough = False
+        for cache in caches:
+            cache.put(g.tile_key, response.get_data())
+        return response
+
+    @server.route('/tile-cache')
+    def tile_cache_stats():  # pylint: disable=unused-variable
+        return jsonify({cache.name: cache.stats() for cache in caches})
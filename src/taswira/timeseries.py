@@ -0,0 +1,119 @@
+"""Values of a pixel over all years, read from time-series cubes."""
+import contextlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from rasterio.transform import Affine, rowcol
+from rasterio.warp import transform as transform_coords
+
+from .scripts.cube import CUBE_TABLE
+
+
+class CubeReader:
+    """Thread-safe reader of the cubes made by `cube.build_cube()`.
+
+    Cubes are memory-mapped when first read, and mapped again once they're
+    rebuilt. Cubes missing from disk, or not matching the shape recorded in
+    the DB, are ignored.
+
+    Args:
+        dbpath: Path to a DB made by `ingest()`.
+    """
+    def __init__(self, dbpath):
+        self.dbpath = dbpath
+        self._cubes = {}
+        self._lock = threading.Lock()
+
+    def _get_cube(self, title):
+        with contextlib.closing(sqlite3.connect(self.dbpath)) as conn:
+            try:
+                row = conn.execute(
+                    f"SELECT path, metadata FROM {CUBE_TABLE} "
+                    "WHERE title = ?", [title]).fetchone()
+            except sqlite3.OperationalError:
+                return None  # No cube was built
+        if row is None:
+            return None
+
+        with self._lock:
+            cube = self._cubes.get(title)
+            if cube is None or cube[0] != row:
+                metadata = json.loads(row[1])
+                shape = (*metadata['shape'], len(metadata['years']))
+                try:
+                    data = np.load(row[0], mmap_mode='r')
+                except OSError:
+                    return None  # Deleted along with the cache directory
+                if data.shape != shape:
+                    return None  # Not the cube the DB was built with
+                cube = (row, data, metadata)
+                self._cubes[title] = cube
+        return cube[1:]
+
+    def get_series(self, title, lat, lon):
+        """Returns the values of the pixel at a location over all years.
+
+        Args:
+            title: Title of the datasets.
+            lat: Latitude of the location.
+            lon: Longitude of the location.
+
+        Returns:
+            An OrderedDict mapping years to the value of the pixel, which is
+            None for nodata and locations outside the rasters. None if
+            there's no cube for the title.
+        """
+        cube = self._get_cube(title)
+        if cube is None:
+            return None
+
+        data, metadata = cube
+        (x, ), (y, ) = transform_coords('EPSG:4326', metadata['crs'], [lon],
+                                        [lat])
+        row, col = rowcol(Affine(*metadata['transform']), x, y)
+        height, width = metadata['shape']
+        if 0 <= row < height and 0 <= col < width:
+            values = [
+                None if np.isnan(value) else float(value)
+                for value in data[row, col]
+            ]
+        else:
+            values = [None] * len(metadata['years'])
+        return OrderedDict(zip(metadata['years'], values))
+
+
+def install_timeseries(server, reader):
+    """Serves the values of pixels over all years from a Flask app.
+
+    Values are served as JSON lists of `years` and `values` from
+    `/timeseries/{title}?lat={lat}&lon={lon}`.
+
+    Args:
+        server: Flask instance serving the Terracotta API.
+        reader: `CubeReader` of the DB being served.
+    """
+    from flask import jsonify, request  # pylint: disable=import-outside-toplevel
+    from terracotta import exceptions  # pylint: disable=import-outside-toplevel
+    from terracotta.server.flask_api import convert_exceptions  # pylint: disable=import-outside-toplevel
+
+    @server.route('/timeseries/<title>')
+    @convert_exceptions
+    def get_timeseries(title):  # pylint: disable=unused-variable
+        try:
+            lat = float(request.args['lat'])
+            lon = float(request.args['lon'])
+        except (KeyError, ValueError):
+            raise exceptions.InvalidArgumentsError(
+                'lat and lon must be numbers') from None
+
+        series = reader.get_series(title, lat, lon)
+        if series is None:
+            raise exceptions.DatasetNotFoundError(
+                f'No time-series cube for {title}')
+        return jsonify({
+            'years': list(series),
+            'values': list(series.values())
+        })
@@ -0,0 +1,218 @@
+"""Statistics of the datasets of a title within a polygon."""
+import contextlib
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.errors import WindowError
+from rasterio.features import bounds as get_geometry_bounds
+from rasterio.features import geometry_mask
+from rasterio.warp import transform_geom
+from rasterio.windows import Window
+from shapely import geometry as shapes
+
+DEFAULT_ZONAL_THREADS = 4
+DEFAULT_CACHE_SIZE = 64  # polygons and titles
+GEOMETRY_TYPES = ('Polygon', 'MultiPolygon')
+
+
+def get_geometry(geojson):
+    """Extracts a polygon from GeoJSON.
+
+    Args:
+        geojson: dict of a GeoJSON Polygon or MultiPolygon, or of a Feature
+            of one, in longitude and latitude.
+
+    Returns:
+        dict of the geometry.
+
+    Raises:
+        ValueError: If the GeoJSON is not of a valid polygon.
+    """
+    if not isinstance(geojson, dict):
+        raise ValueError('GeoJSON must be an object')
+    if geojson.get('type') == 'Feature':
+        geojson = geojson.get('geometry') or {}
+    if not isinstance(geojson, dict) or geojson.get(
+            'type') not in GEOMETRY_TYPES:
+        raise ValueError(
+            f"GeoJSON must be one of {', '.join(GEOMETRY_TYPES)}")
+    if not geojson.get('coordinates'):
+        raise ValueError('GeoJSON has no coordinates')
+
+    try:
+        polygon = shapes.shape(geojson)
+    except Exception:  # pylint: disable=broad-except
+        raise ValueError('GeoJSON has malformed coordinates') from None
+    if polygon.is_empty or not polygon.is_valid:
+        raise ValueError('GeoJSON is not a valid polygon')
+    return shapes.mapping(polygon)
+
+
+def get_geometry_hash(geometry):
+    """Returns a digest identifying a geometry, for caching."""
+    return hashlib.sha1(
+        json.dumps(geometry, sort_keys=True,
+                   separators=(',', ':')).encode()).hexdigest()
+
+
+def _get_mask(raster, geometry):
+    """Rasterizes a geometry over the part of a raster it covers.
+
+    Returns:
+        A tuple of the window of the raster covering the geometry's bounds,
+        and a boolean array of the pixels of the window within the geometry,
+        or None if the geometry is outside the raster.
+    """
+    geometry = transform_geom('EPSG:4326', raster.crs, geometry)
+    west, south, east, north = get_geometry_bounds(geometry)
+    # Unlike `windows.from_bounds()`, this also works for south-up rasters
+    cols, rows = zip(*(~raster.transform * corner
+                       for corner in ((west, south), (east, north))))
+    col_off, row_off = math.floor(min(cols)), math.floor(min(rows))
+    window = Window(col_off, row_off,
+                    math.ceil(max(cols)) - col_off,
+                    math.ceil(max(rows)) - row_off)
+    try:
+        window = window.intersection(Window(0, 0, raster.width,
+                                            raster.height))
+    except WindowError:
+        return None  # No overlap
+
+    mask = geometry_mask([geometry],
+                         out_shape=(window.height, window.width),
+                         transform=raster.window_transform(window),
+                         invert=True)
+    return window, mask
+
+
+def _get_stats(values):
+    count = int(values.count())
+    if count == 0:
+        return {'sum': None, 'mean': None, 'count': 0}
+
+    total = float(values.sum(dtype='float64'))
+    return {'sum': total, 'mean': total / count, 'count': count}
+
+
+class ZonalStats:
+    """Computes and caches statistics of the datasets of titles in polygons.
+
+    The pixels within a polygon are rasterized once per raster grid, which
+    all datasets of a title usually share, and only the window of every
+    raster covering the polygon is read. Years are read on a pool of
+    threads. Statistics are cached by polygon and title, and computed again
+    once the datasets of the title change.
+
+    Args:
+        dbpath: Path to a Terracotta-generated DB.
+        threads: Number of threads reading rasters.
+        cache_size: Number of polygons and titles to keep statistics of.
+    """
+    def __init__(self,
+                 dbpath,
+                 threads=DEFAULT_ZONAL_THREADS,
+                 cache_size=DEFAULT_CACHE_SIZE):
+        self.dbpath = dbpath
+        self.threads = threads
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_datasets(self, title):
+        with contextlib.closing(sqlite3.connect(self.dbpath)) as conn:
+            return conn.execute(
+                "SELECT year, filepath FROM datasets WHERE title = ? "
+                "ORDER BY year", [title]).fetchall()
+
+    def _compute(self, datasets, geometry):
+        masks = {}
+        masks_lock = threading.Lock()
+
+        def compute_year(path):
+            with rasterio.open(path) as raster:
+                grid = (raster.shape, raster.transform, raster.crs)
+                with masks_lock:
+                    if grid not in masks:
+                        masks[grid] = _get_mask(raster, geometry)
+                    window_mask = masks[grid]
+                if window_mask is None:
+                    return _get_stats(np.ma.masked_all(0))
+
+                window, mask = window_mask
+                data = raster.read(1, window=window, masked=True)
+            return _get_stats(data[mask])
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            stats = executor.map(compute_year,
+                                 [path for _, path in datasets])
+            return OrderedDict(zip([year for year, _ in datasets], stats))
+
+    def get_stats(self, title, geometry):
+        """Returns statistics of the datasets of a title within a polygon.
+
+        Args:
+            title: Title of the datasets.
+            geometry: dict of a polygon, as returned by `get_geometry()`.
+
+        Returns:
+            An OrderedDict mapping years to dicts of the `sum` and `mean` of
+            the values of the pixels within the polygon, and their `count`.
+            The sum and mean are None if there's no such pixel.
+        """
+        datasets = self._get_datasets(title)
+        key = (get_geometry_hash(geometry), title)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] == datasets:
+                self._cache.move_to_end(key)
+                return cached[1]
+
+        stats = self._compute(datasets, geometry)
+        with self._lock:
+            self._cache[key] = (datasets, stats)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return stats
+
+
+def install_zonal_stats(server, zonal_stats):
+    """Serves statistics of titles within polygons from a Flask app.
+
+    Polygons are POSTed as GeoJSON to `/zonal-stats/{title}`, which responds
+    with JSON lists of `years`, and of the `sum`, `mean` and `count` of the
+    pixels within the polygon in every year.
+
+    Args:
+        server: Flask instance serving the Terracotta API.
+        zonal_stats: `ZonalStats` of the DB being served.
+    """
+    from flask import jsonify, request  # pylint: disable=import-outside-toplevel
+    from terracotta import exceptions  # pylint: disable=import-outside-toplevel
+    from terracotta.server.flask_api import convert_exceptions  # pylint: disable=import-outside-toplevel
+
+    @server.route('/zonal-stats/<title>', methods=['POST'])
+    @convert_exceptions
+    def get_zonal_stats(title):  # pylint: disable=unused-variable
+        try:
+            geometry = get_geometry(request.get_json(force=True, silent=True))
+        except ValueError as err:
+            raise exceptions.InvalidArgumentsError(str(err)) from None
+
+        stats = zonal_stats.get_stats(title, geometry)
+        if not stats:
+            raise exceptions.DatasetNotFoundError(f'No datasets for {title}')
+        return jsonify({
+            'years': list(stats),
+            **{
+                field: [s[field] for s in stats.values()]
+                for field in ('sum', 'mean', 'count')
+            }
+        })
@@ -0,0 +1,39 @@
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def tile_server(request, tmpdir):
+    """A Flask app with a fake singleband tile route that records renders.
+
+    Parametrized indirectly with a dict of:
+        blocking: Whether renders wait for `server.release` to be set.
+        years: Years of 'AG Biomass' to add to a datasets DB at
+            `server.dbpath`.
+    """
+    import sqlite3
+
+    from flask import Flask
+
+    params = getattr(request, 'param', {})
+    server = Flask(__name__)
+    server.rendered = []
+    server.release = threading.Event()
+    if not params.get('blocking'):
+        server.release.set()
+
+    @server.route('/singleband/<path:keys>/<int:z>/<int:x>/<int:y>.png')
+    def get_tile(keys, z, x, y):
+        server.release.wait()
+        server.rendered.append(f'{keys}/{z}/{x}/{y}')
+        return f'{keys}/{z}/{x}/{y}'.encode()
+
+    server.dbpath = str(tmpdir.join('db.sqlite'))
+    with sqlite3.connect(server.dbpath) as conn:
+        conn.execute("CREATE TABLE datasets (title, year, filepath)")
+        conn.executemany("INSERT INTO datasets VALUES (?, ?, '')",
+                         [('AG Biomass', str(year))
+                          for year in params.get('years', ())])
+
+    return server
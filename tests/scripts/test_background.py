@@ -0,0 +1,72 @@
+import sqlite3
+
+import pytest
+
+
+def test_ingestion_error(set_config, GCBM_raster_files, tmpdir):
+    from taswira.scripts import get_config
+    from taswira.scripts.background import _run_ingestion
+    from taswira.scripts.ingestion import create_db, get_status
+
+    set_config()
+
+    dbpath = create_db(str(tmpdir))
+    rasterdir = GCBM_raster_files[0].dirname
+    db_results = str(tmpdir.join('missing', 'results.db'))
+    with pytest.raises(sqlite3.OperationalError):
+        _run_ingestion(get_config(), rasterdir, db_results, dbpath,
+                       str(tmpdir), False, 1, None, False, False, False, None,
+                       False)
+    assert get_status(dbpath)['error'].startswith('Ingestion failed: ')
+
+
+def test_ingestion_error_shown(tmpdir):
+    import json
+
+    from flask import Flask
+
+    from taswira.app import get_app
+    from taswira.scripts.console import configure_terracotta
+    from taswira.scripts.ingestion import create_db, set_status
+
+    dbpath = create_db(str(tmpdir))
+    configure_terracotta(dbpath)
+    app = get_app()
+    server = Flask(__name__)
+    app.init_app(server)
+    client = server.test_client()
+
+    outputs = [('title-dropdown', 'options'), ('title-dropdown', 'value'),
+               ('data-version', 'data'), ('ingestion-status', 'children'),
+               ('refresh-interval', 'disabled')]
+    set_status(dbpath, error='boom')
+    response = client.post(
+        '/_dash-update-component',
+        json={
+            'output':
+            '..' + '...'.join(f'{i}.{p}' for i, p in outputs) + '..',
+            'outputs': [{
+                'id': i,
+                'property': p
+            } for i, p in outputs],
+            'inputs': [{
+                'id': 'refresh-interval',
+                'property': 'n_intervals',
+                'value': 1
+            }],
+            'state': [{
+                'id': 'title-dropdown',
+                'property': 'value',
+                'value': None
+            }, {
+                'id': 'data-version',
+                'property': 'data',
+                'value': [0, True]
+            }],
+            'changedPropIds': ['refresh-interval.n_intervals'],
+        })
+    assert response.status_code == 200
+    props = json.loads(response.data)['response']
+    assert props['title-dropdown'] == {'options': [], 'value': None}
+    assert props['ingestion-status'] == {'children': 'boom'}
+    assert props['refresh-interval'] == {'disabled': True}
@@ -0,0 +1,101 @@
+import contextlib
+import sqlite3
+
+
+def _get_driver_catalog(dbpath):
+    from taswira.scripts.catalog import CATALOG_FIELDS
+    from terracotta import get_driver
+
+    driver = get_driver(dbpath, provider='sqlite')
+    catalog = {}
+    with driver.connect():
+        for keys in driver.get_datasets():
+            metadata = driver.get_metadata(keys)
+            extra = {
+                k: metadata['metadata'][k]
+                for k in CATALOG_FIELDS + ('stretch_range', )
+            }
+            catalog.setdefault(keys[0], {})[keys[1]] = {
+                'bounds': tuple(metadata['bounds']),
+                'range': tuple(metadata['range']),
+                'metadata': extra,
+            }
+    return catalog
+
+
+def test_catalog(set_config, GCBM_raster_files, GCBM_compiled_output, tmpdir):
+    from taswira.scripts.catalog import CATALOG_TABLE, Catalog
+    from taswira.scripts.ingestion import ingest
+
+    set_config()
+
+    rasterdir = GCBM_raster_files[0].dirname
+    dbpath = ingest(rasterdir, GCBM_compiled_output, tmpdir)
+    expected = _get_driver_catalog(dbpath)
+
+    catalog = Catalog(dbpath, cache_size=1)
+    assert catalog.get_titles() == {
+        title: len(datasets)
+        for title, datasets in expected.items()
+    }
+    for title, datasets in expected.items():
+        assert catalog.get_datasets(title) == datasets
+
+    # DBs made before the catalog existed get one on first use
+    with contextlib.closing(sqlite3.connect(dbpath)) as conn:
+        conn.execute(f"DROP TABLE {CATALOG_TABLE}")
+        conn.commit()
+    catalog = Catalog(dbpath)
+    for title, datasets in expected.items():
+        assert catalog.get_datasets(title) == datasets
+
+
+def test_catalog_refresh(set_config, GCBM_raster_files, GCBM_compiled_output,
+                         tmpdir):
+    import shutil
+
+    from taswira.scripts.catalog import Catalog
+    from taswira.scripts.ingestion import ingest, ingest_new
+
+    set_config()
+
+    rasterdir = tmpdir.mkdir('raster')
+    shutil.copy(str(GCBM_raster_files[0]), str(rasterdir))
+    dbpath = ingest(str(rasterdir), GCBM_compiled_output, tmpdir)
+    catalog = Catalog(dbpath)
+    title, = catalog.get_titles()
+    assert len(catalog.get_datasets(title)) == 1
+
+    shutil.copy(str(GCBM_raster_files[0]),
+                str(rasterdir.join('AG_Biomass_C_2011.tiff')))
+    ingest_new(str(rasterdir), dbpath, GCBM_compiled_output)
+    assert len(catalog.get_datasets(title)) == 1  # Still cached
+    assert catalog.get_titles() == {title: 2}
+    assert catalog.get_datasets(title) == _get_driver_catalog(dbpath)[title]
+
+
+def test_catalog_stretch_refresh(set_config, GCBM_raster_files,
+                                 GCBM_compiled_output, tmpdir):
+    from taswira.scripts.catalog import CATALOG_TABLE, Catalog, update_catalog
+    from taswira.scripts.ingestion import ingest
+
+    set_config()
+
+    rasterdir = GCBM_raster_files[0].dirname
+    dbpath = ingest(rasterdir, GCBM_compiled_output, tmpdir)
+    with contextlib.closing(sqlite3.connect(dbpath)) as conn:
+        conn.execute(f"UPDATE {CATALOG_TABLE} SET stretch_min = NULL, "
+                     "stretch_max = NULL")
+        conn.commit()
+
+    # Stretch ranges are computed once all rasters are in, without changing
+    # the number of datasets
+    catalog = Catalog(dbpath)
+    title = next(iter(catalog.get_titles()))
+    year, dataset = next(iter(catalog.get_datasets(title).items()))
+    assert 'stretch_range' not in dataset['metadata']
+    update_catalog(dbpath, stretch_ranges={title: [1, 2]})
+    catalog.get_titles()
+    assert catalog.get_datasets(title)[year]['metadata']['stretch_range'] == [
+        1, 2
+    ]
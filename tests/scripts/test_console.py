@@ -1,5 +1,7 @@
 import urllib.request
 
+from tests.scripts.conftest import TEST_CONFIG
+
 
 def test_terracotta_integration(terracotta_server):
     """Check Terracotta integration by making requests to its REST API."""
@@ -9,3 +11,76 @@ def test_terracotta_integration(terracotta_server):
     for endpoint in test_endpoints:
         with urllib.request.urlopen(f"{terracotta_server}/{endpoint}") as response:
             assert response.getcode() == 200
+
+
+def test_lazy_imports():
+    """Check that the UI isn't imported for showing help or ingesting."""
+    import subprocess
+    import sys
+
+    code = """
+import sys
+sys.argv = ['taswira', '--help']
+from taswira.scripts import console, ingestion
+try:
+    console.console()
+except SystemExit:
+    pass
+print(' '.join(sys.modules))
+"""
+    output = subprocess.run([sys.executable, '-c', code],
+                            capture_output=True,
+                            check=True,
+                            text=True).stdout
+    modules = set(output.splitlines()[-1].split())
+    for module in ('dash', 'plotly', 'flask', 'terracotta.server'):
+        assert module not in modules
+
+
+def test_ingest_console(GCBM_raster_files, GCBM_compiled_output, tmpdir):
+    import json
+    import os
+
+    from taswira.scripts.console import ingest_console
+    from taswira.scripts.ingestion import DB_NAME, get_status
+
+    config = tmpdir.join('config.json')
+    config.write(json.dumps(TEST_CONFIG))
+    args = [str(config), GCBM_raster_files[0].dirname, GCBM_compiled_output]
+    cachedir = tmpdir.mkdir('cache')
+    ingest_console(args + ['--cache-dir', str(cachedir)])
+    outpath = tmpdir.join('out.sqlite')
+    ingest_console(args + ['--out', str(outpath)])
+
+    for dbpath in (os.path.join(cachedir, DB_NAME), str(outpath)):
+        status = get_status(dbpath)
+        assert status['finished']
+        assert status['processed'] == len(GCBM_raster_files)
+
+
+def test_serve_console(testdb):
+    import os
+    import subprocess
+    import time
+
+    from taswira.scripts.helpers import get_free_port
+
+    port = get_free_port()
+    proc = subprocess.Popen(
+        ['taswira', 'serve', str(testdb), '--port',
+         str(port)],
+        env=dict(os.environ, IN_DOCKER='1'))
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                with urllib.request.urlopen(
+                        f"http://localhost:{port}/keys") as response:
+                    assert response.getcode() == 200
+                break
+            except OSError:
+                assert time.monotonic() < deadline
+                time.sleep(0.1)
+    finally:
+        proc.terminate()
+        proc.wait(5)
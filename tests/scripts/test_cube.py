@@ -0,0 +1,183 @@
+import os
+
+
+def test_cube(set_config, GCBM_raster_files, GCBM_compiled_output, tmpdir):
+    from flask import Flask
+
+    from taswira.scripts.cube import build_cube
+    from taswira.scripts.ingestion import ingest
+    from taswira.timeseries import CubeReader, install_timeseries
+
+    set_config()
+
+    rasterdir = GCBM_raster_files[0].dirname
+    dbpath = ingest(rasterdir, GCBM_compiled_output, tmpdir, cube=True)
+    reader = CubeReader(dbpath)
+
+    # The second pixel of the second row, as the first one is nodata
+    series = reader.get_series('AG Biomass', 50.015, -119.285)
+    assert series == {'2010': -80000 + 401}
+    assert reader.get_series('AG Biomass', 50.005, -119.295) == {'2010': None}
+    assert reader.get_series('AG Biomass', 0, 0) == {'2010': None}
+    assert reader.get_series('Unknown', 50.015, -119.285) is None
+
+    # Cubes of unchanged rasters are reused
+    path = build_cube(dbpath, 'AG Biomass', str(tmpdir))
+    mtime = os.stat(path).st_mtime_ns
+    assert build_cube(dbpath, 'AG Biomass', str(tmpdir)) == path
+    assert os.stat(path).st_mtime_ns == mtime
+
+    server = Flask(__name__)
+    install_timeseries(server, reader)
+    client = server.test_client()
+    response = client.get('/timeseries/AG Biomass?lat=50.015&lon=-119.285')
+    assert response.get_json() == {'years': ['2010'], 'values': [-79599]}
+    assert client.get('/timeseries/AG Biomass?lat=north').status_code == 400
+    assert client.get('/timeseries/Unknown?lat=0&lon=0').status_code == 404
+
+
+def test_strip_windows(monkeypatch):
+    from taswira.scripts import cube
+
+    monkeypatch.setattr(cube, 'STRIP_SIZE', 256 * 256 * 10 * 4)
+
+    def get_windows(shape, block_shape):
+        windows = list(cube._get_strip_windows(shape, block_shape, 10))
+        for window in windows:
+            assert window.height * window.width * 10 * 4 <= cube.STRIP_SIZE
+        return [(w.row_off, w.col_off, w.height, w.width) for w in windows]
+
+    # Strips of whole rows of blocks, unless a row of blocks is over budget
+    assert get_windows((600, 200), (128, 200)) == [(0, 0, 256, 200),
+                                                   (256, 0, 256, 200),
+                                                   (512, 0, 88, 200)]
+    assert get_windows((300, 700), (256, 256)) == [(0, 0, 256, 256),
+                                                   (0, 256, 256, 256),
+                                                   (0, 512, 256, 188),
+                                                   (256, 0, 44, 256),
+                                                   (256, 256, 44, 256),
+                                                   (256, 512, 44, 188)]
+
+
+def test_cubes_of_several_dbs(tmpdir):
+    import numpy as np
+    import rasterio
+    from terracotta import get_driver
+
+    from taswira.scripts.cube import build_cube
+    from taswira.timeseries import CubeReader
+
+    cubedir = tmpdir.mkdir('cubes')
+    readers = []
+    for name, size, value in (('a', 10, 1), ('b', 3, 2)):
+        path = str(tmpdir.join(f'{name}.tiff'))
+        with rasterio.open(path,
+                           'w',
+                           driver='GTiff',
+                           dtype='float32',
+                           width=size,
+                           height=size,
+                           count=1,
+                           crs='EPSG:4326',
+                           transform=rasterio.transform.from_origin(
+                               0, 10, 1, 1)) as dst:
+            dst.write(np.full((size, size), value, dtype='float32'), 1)
+
+        dbpath = str(tmpdir.join(f'{name}.sqlite'))
+        driver = get_driver(dbpath, provider='sqlite')
+        driver.create(['title', 'year'])
+        with driver.connect():
+            driver.insert(('NPP', '2010'), path, skip_metadata=True)
+        build_cube(dbpath, 'NPP', str(cubedir))
+        readers.append(CubeReader(dbpath))
+
+    # The cube of a DB is never overwritten by another one's
+    assert readers[0].get_series('NPP', 9.5, 0.5) == {'2010': 1}
+    assert readers[0].get_series('NPP', 0.5, 9.5) == {'2010': 1}
+    assert readers[1].get_series('NPP', 9.5, 0.5) == {'2010': 2}
+    assert readers[1].get_series('NPP', 0.5, 9.5) == {'2010': None}
+
+
+def test_cube_refresh(set_config, GCBM_raster_files, GCBM_compiled_output,
+                      tmpdir):
+    import shutil
+
+    from taswira.scripts.ingestion import ingest, ingest_new
+    from taswira.timeseries import CubeReader
+
+    set_config()
+
+    rasterdir = tmpdir.mkdir('raster')
+    shutil.copy(str(GCBM_raster_files[0]), str(rasterdir))
+    dbpath = ingest(str(rasterdir), GCBM_compiled_output, tmpdir, cube=True)
+    reader = CubeReader(dbpath)
+    assert list(reader.get_series('AG Biomass', 50.015, -119.285)) == ['2010']
+    old_cubes = tmpdir.listdir('*.npy')
+
+    shutil.copy(str(GCBM_raster_files[0]),
+                str(rasterdir.join('AG_Biomass_C_2011.tiff')))
+    ingest_new(str(rasterdir), dbpath, GCBM_compiled_output, cube=True)
+    assert reader.get_series('AG Biomass', 50.015, -119.285) == {
+        '2010': -79599,
+        '2011': -79599
+    }
+    assert not any(cube.exists() for cube in old_cubes)
+
+
+def test_shared_cube(tmpdir):
+    import numpy as np
+    import rasterio
+    from terracotta import get_driver
+
+    from taswira.scripts.cube import build_cube
+    from taswira.timeseries import CubeReader
+
+    cubedir = tmpdir.mkdir('cubes')
+    paths = []
+    for year in ('2010', '2011'):
+        paths.append(str(tmpdir.join(f'{year}.tiff')))
+        with rasterio.open(paths[-1],
+                           'w',
+                           driver='GTiff',
+                           dtype='float32',
+                           width=3,
+                           height=3,
+                           count=1,
+                           crs='EPSG:4326',
+                           transform=rasterio.transform.from_origin(
+                               0, 3, 1, 1)) as dst:
+            dst.write(np.full((3, 3), int(year), dtype='float32'), 1)
+
+    drivers, readers = [], []
+    for name in ('a', 'b'):
+        dbpath = str(tmpdir.join(f'{name}.sqlite'))
+        drivers.append(get_driver(dbpath, provider='sqlite'))
+        drivers[-1].create(['title', 'year'])
+        with drivers[-1].connect():
+            drivers[-1].insert(('NPP', '2010'), paths[0], skip_metadata=True)
+        build_cube(dbpath, 'NPP', str(cubedir))
+        readers.append(CubeReader(dbpath))
+    shared = cubedir.listdir('*.npy')
+    assert len(shared) == 1
+
+    # A DB moving on to a new cube leaves the one the other DB still uses
+    with drivers[0].connect():
+        drivers[0].insert(('NPP', '2011'), paths[1], skip_metadata=True)
+    build_cube(str(tmpdir.join('a.sqlite')), 'NPP', str(cubedir))
+    assert readers[0].get_series('NPP', 1.5, 1.5) == {
+        '2010': 2010,
+        '2011': 2011
+    }
+    assert readers[1].get_series('NPP', 1.5, 1.5) == {'2010': 2010}
+    assert shared[0].exists()
+
+    # It's deleted once no DB uses it anymore
+    with drivers[1].connect():
+        drivers[1].insert(('NPP', '2011'), paths[1], skip_metadata=True)
+    build_cube(str(tmpdir.join('b.sqlite')), 'NPP', str(cubedir))
+    assert readers[1].get_series('NPP', 1.5, 1.5) == {
+        '2010': 2010,
+        '2011': 2011
+    }
+    assert not shared[0].exists()
+    assert len(cubedir.listdir('*.npy')) == 1
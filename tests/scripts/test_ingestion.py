@@ -4,7 +4,7 @@ from tests.scripts.conftest import GCBM_TEST_FILES
 
 
 def test_ingest(set_config, GCBM_raster_files, GCBM_compiled_output, tmpdir):
-    from taswira.scripts.ingestion import ingest
+    from taswira.scripts.ingestion import get_status, ingest
     from terracotta import get_driver
 
     set_config()
@@ -19,3 +19,256 @@ def test_ingest(set_config, GCBM_raster_files, GCBM_compiled_output, tmpdir):
 
     datasets = driver.get_datasets()
     assert len(datasets) == len(GCBM_raster_files)
+
+    status = get_status(dbpath)
+    assert status['finished']
+    assert status['processed'] == status['total'] == len(GCBM_raster_files)
+
+
+def test_title_stats(set_config, GCBM_raster_files, GCBM_compiled_output,
+                     tmpdir):
+    from taswira.scripts.ingestion import ingest
+    from terracotta import get_driver
+
+    set_config()
+
+    rasterdir = GCBM_raster_files[0].dirname
+    driver = get_driver(ingest(rasterdir, GCBM_compiled_output, tmpdir),
+                        provider='sqlite')
+
+    by_title = {}
+    for keys in driver.get_datasets():
+        by_title.setdefault(keys[0], []).append(driver.get_metadata(keys))
+
+    for metadata in by_title.values():
+        lowers, uppers = zip(*(m['range'] for m in metadata))
+        for dataset_metadata in metadata:
+            stats = dataset_metadata['metadata']
+            assert stats['stretch_range'] == [min(lowers), max(uppers)]
+            assert len(stats['title_percentiles']) == 99
+            assert stats['title_percentiles'] == sorted(
+                stats['title_percentiles'])
+
+
+def test_ingest_parallel(set_config, GCBM_raster_files, GCBM_compiled_output,
+                         tmpdir):
+    from taswira.scripts.ingestion import ingest
+    from terracotta import get_driver
+
+    set_config()
+
+    rasterdir = GCBM_raster_files[0].dirname
+    serial_dbpath = ingest(rasterdir, GCBM_compiled_output,
+                           tmpdir.mkdir('serial'))
+    parallel_dbpath = ingest(rasterdir,
+                             GCBM_compiled_output,
+                             tmpdir.mkdir('parallel'),
+                             jobs=2)
+
+    serial_driver = get_driver(serial_dbpath, provider='sqlite')
+    parallel_driver = get_driver(parallel_dbpath, provider='sqlite')
+    datasets = serial_driver.get_datasets()
+    assert datasets == parallel_driver.get_datasets()
+    for keys in datasets:
+        assert serial_driver.get_metadata(
+            keys) == parallel_driver.get_metadata(keys)
+
+
+def test_ingest_cached(set_config, GCBM_raster_files, GCBM_compiled_output,
+                       tmpdir, monkeypatch):
+    from taswira.metrics import StageTimings
+    from taswira.scripts import ingestion
+    from terracotta import get_driver
+
+    set_config()
+
+    rasterdir = GCBM_raster_files[0].dirname
+    dbpath = ingestion.ingest(rasterdir,
+                              GCBM_compiled_output,
+                              tmpdir,
+                              cachedir=tmpdir)
+    driver = get_driver(dbpath, provider='sqlite')
+    with driver.connect():
+        expected = {k: driver.get_metadata(k) for k in driver.get_datasets()}
+
+    def _fail(path, *args):
+        raise AssertionError(f"{path} was not read from cache")
+
+    monkeypatch.setattr(ingestion, '_process_raster', _fail)
+    timings = StageTimings()
+    dbpath = ingestion.ingest(rasterdir,
+                              GCBM_compiled_output,
+                              tmpdir,
+                              cachedir=tmpdir,
+                              timings=timings)
+    driver = get_driver(dbpath, provider='sqlite')
+    with driver.connect():
+        assert expected == {
+            k: driver.get_metadata(k)
+            for k in driver.get_datasets()
+        }
+
+    stats = timings.stats()
+    assert stats['counters'] == {
+        'cache_hits': len(expected),
+        'rasters': len(expected)
+    }
+    assert 'compute_metadata' not in stats['stages']
+    assert stats['stages']['results_snapshot']['count'] == 1
+
+
+def test_ingest_new(set_config, GCBM_raster_files, GCBM_compiled_output,
+                    tmpdir):
+    import shutil
+
+    from taswira.scripts.ingestion import ingest, ingest_new
+    from terracotta import get_driver
+
+    set_config()
+
+    rasterdir = tmpdir.mkdir('raster')
+    shutil.copy(str(GCBM_raster_files[0]), str(rasterdir))
+    dbpath = ingest(str(rasterdir), GCBM_compiled_output, tmpdir)
+    assert ingest_new(str(rasterdir), dbpath, GCBM_compiled_output) == []
+
+    shutil.copy(str(GCBM_raster_files[1]), str(rasterdir))
+    assert ingest_new(str(rasterdir), dbpath, GCBM_compiled_output,
+                      min_age=60) == []
+    new_keys = ingest_new(str(rasterdir), dbpath, GCBM_compiled_output)
+    assert new_keys == [(GCBM_TEST_FILES[1]['title'],
+                         GCBM_TEST_FILES[1]['year'])]
+
+    driver = get_driver(dbpath, provider='sqlite')
+    assert len(driver.get_datasets()) == len(GCBM_raster_files)
+
+
+def test_ingest_new_skipped(set_config, GCBM_raster_files,
+                            GCBM_compiled_output, tmpdir):
+    import shutil
+
+    from taswira.metrics import StageTimings
+    from taswira.scripts.ingestion import ingest, ingest_new
+
+    set_config()
+
+    rasterdir = tmpdir.mkdir('raster')
+    shutil.copy(str(GCBM_raster_files[0]), str(rasterdir))
+    dbpath = ingest(str(rasterdir), GCBM_compiled_output, tmpdir)
+
+    broken = rasterdir.join(GCBM_TEST_FILES[1]['name'])
+    broken.write('not a raster')
+    skipped = {}
+    assert ingest_new(str(rasterdir),
+                      dbpath,
+                      GCBM_compiled_output,
+                      skipped=skipped) == []
+    assert list(skipped) == [str(broken)]
+
+    # Unchanged files that were skipped aren't looked at again
+    timings = StageTimings()
+    assert ingest_new(str(rasterdir),
+                      dbpath,
+                      GCBM_compiled_output,
+                      timings=timings,
+                      skipped=skipped) == []
+    assert 'validate' not in timings.stats()['stages']
+
+    shutil.copy(str(GCBM_raster_files[1]), str(broken))
+    assert ingest_new(str(rasterdir),
+                      dbpath,
+                      GCBM_compiled_output,
+                      skipped=skipped) == [(GCBM_TEST_FILES[1]['title'],
+                                            GCBM_TEST_FILES[1]['year'])]
+
+
+def test_ingest_unoptimized(set_config, GCBM_compiled_output, tmpdir):
+    import numpy as np
+    import pytest
+    import rasterio
+    from taswira.scripts.ingestion import UnoptimizedRaster, ingest
+
+    set_config()
+
+    rasterdir = tmpdir.mkdir('raster')
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'nodata': 10000,
+        'width': 1024,
+        'height': 1024,
+        'count': 1,
+        'crs': 'epsg:4326',
+        'transform': rasterio.transform.from_origin(-119.3, 50.0, 0.01, 0.01),
+    }
+    with rasterio.open(str(rasterdir.join('NPP_2013.tiff')), 'w',
+                       **profile) as dst:
+        dst.write(np.ones((1024, 1024), dtype='float32'), 1)
+
+    with pytest.raises(UnoptimizedRaster):
+        ingest(str(rasterdir), GCBM_compiled_output, tmpdir)
+
+    dbpath = ingest(str(rasterdir),
+                    GCBM_compiled_output,
+                    tmpdir,
+                    allow_unoptimized=True)
+    assert os.path.exists(dbpath)
+
+
+def test_ingest_convert(set_config, GCBM_compiled_output, tmpdir,
+                        monkeypatch):
+    import numpy as np
+    import rasterio
+    from taswira.scripts import ingestion
+    from taswira.scripts.convert import convert_raster
+    from terracotta import get_driver
+
+    set_config()
+
+    rasterdir = tmpdir.mkdir('raster')
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'nodata': 10000,
+        'width': 1024,
+        'height': 1024,
+        'count': 1,
+        'crs': 'epsg:4326',
+        'transform': rasterio.transform.from_origin(-119.3, 50.0, 0.01, 0.01),
+    }
+    raster_data = np.arange(1024 * 1024, dtype='float32').reshape(1024, 1024)
+    with rasterio.open(str(rasterdir.join('NPP_2013.tiff')), 'w',
+                       **profile) as dst:
+        dst.write(raster_data, 1)
+
+    dbpath = ingestion.ingest(str(rasterdir),
+                              GCBM_compiled_output,
+                              tmpdir,
+                              cachedir=tmpdir,
+                              convert=True)
+    driver = get_driver(dbpath, provider='sqlite')
+    path, = driver.get_datasets().values()
+    assert path.startswith(str(tmpdir))
+    with rasterio.open(path) as src:
+        assert src.block_shapes == [(256, 256)]
+        assert src.overviews(1) == [2, 4]
+        assert src.compression.name == 'zstd'
+        assert (src.read(1) == raster_data).all()
+
+    # Converted copies are reused
+    convertdir = str(tmpdir.mkdir('cogs'))
+    raster_path = str(rasterdir.join('NPP_2013.tiff'))
+    cog_path = convert_raster(raster_path, convertdir)
+    mtime = os.stat(cog_path).st_mtime_ns
+    assert convert_raster(raster_path, convertdir) == cog_path
+    assert os.stat(cog_path).st_mtime_ns == mtime
+
+    def _fail(path, outputdir):
+        raise AssertionError(f"{path} was converted again")
+
+    monkeypatch.setattr(ingestion, 'convert_raster', _fail)
+    ingestion.ingest(str(rasterdir),
+                     GCBM_compiled_output,
+                     tmpdir,
+                     cachedir=tmpdir,
+                     convert=True)
+    assert list(driver.get_datasets().values()) == [path]
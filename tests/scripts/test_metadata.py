@@ -8,3 +8,55 @@ def test_metadata(set_config, GCBM_compiled_output):
     assert not len(metadata) == 0
     for _, indicator_values in metadata.items():
         assert not len(indicator_values) == 0
+
+
+def test_metadata_missing_indicator(GCBM_compiled_output):
+    from taswira.scripts import update_config
+    from taswira.scripts.metadata import get_metadata
+
+    update_config([{
+        "database_indicator": "NPP",
+        "file_pattern": "NPP*.tiff",
+    }, {
+        "title": "Missing",
+        "database_indicator": "Not an indicator",
+        "file_pattern": "Missing*.tiff",
+    }])
+
+    metadata = get_metadata(GCBM_compiled_output)
+
+    assert list(metadata['NPP']) == sorted(metadata['NPP'])
+    assert metadata['Missing'] == {}
+
+
+def test_metadata_snapshot(set_config, GCBM_compiled_output, tmpdir):
+    import os
+
+    from taswira.scripts.metadata import get_metadata, get_snapshot
+
+    set_config()
+
+    snapshot = get_snapshot(GCBM_compiled_output, tmpdir)
+    mtime = os.path.getmtime(snapshot)
+    assert get_snapshot(GCBM_compiled_output, tmpdir) == snapshot
+    assert os.path.getmtime(snapshot) == mtime
+
+    metadata = get_metadata(GCBM_compiled_output, tmpdir)
+    expected = get_metadata(GCBM_compiled_output)
+    assert metadata.keys() == expected.keys()
+    for title, values in expected.items():
+        assert metadata[title].keys() == values.keys()
+        for year, value in values.items():
+            assert abs(metadata[title][year] - value) <= 1e-9 * abs(value)
+
+
+def test_connect_readonly(GCBM_compiled_output):
+    import sqlite3
+
+    import pytest
+    from taswira.scripts.metadata import _connect_readonly
+
+    conn = _connect_readonly(GCBM_compiled_output)
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("CREATE TABLE t (x INTEGER)")
+    conn.close()
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from shapely.geometry import shape
+
+
+@pytest.mark.parametrize('fast', [False, True])
+def test_compute_metadata(GCBM_raster_files, fast):
+    from terracotta.drivers.raster_base import RasterDriver
+    from taswira.scripts.stats import compute_metadata
+
+    for raster in GCBM_raster_files:
+        expected = RasterDriver.compute_metadata(str(raster))
+        metadata = compute_metadata(str(raster), fast)
+
+        assert metadata['range'] == expected['range']
+        assert metadata['valid_percentage'] == expected['valid_percentage']
+        assert np.allclose(metadata['bounds'], expected['bounds'])
+        assert np.isclose(metadata['mean'], expected['mean'])
+        assert np.isclose(metadata['stdev'], expected['stdev'])
+        assert np.allclose(metadata['percentiles'], expected['percentiles'])
+        assert shape(metadata['convex_hull']).equals(
+            shape(expected['convex_hull']))
+
+
+def test_compute_metadata_sampled(GCBM_raster_files, monkeypatch):
+    from terracotta.drivers.raster_base import RasterDriver
+    from taswira.scripts import stats
+
+    monkeypatch.setattr(stats, 'SAMPLE_SIZE', 10000)
+    raster = str(GCBM_raster_files[0])
+    expected = RasterDriver.compute_metadata(raster)
+    metadata = stats.compute_metadata(raster)
+
+    assert metadata['range'] == expected['range']
+    assert np.isclose(metadata['mean'], expected['mean'])
+    lower, upper = expected['range']
+    assert np.allclose(metadata['percentiles'],
+                       expected['percentiles'],
+                       atol=(upper - lower) * 0.02)
@@ -0,0 +1,68 @@
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def test_get_backend(monkeypatch):
+    from taswira.scripts import wsgi
+
+    installed = set()
+    monkeypatch.setattr(wsgi, '_is_installed', lambda m: m in installed)
+    assert wsgi.get_backend(1) == 'prefork'
+
+    installed.add('waitress')
+    assert wsgi.get_backend(1) == 'waitress'
+    assert wsgi.get_backend(2) == 'prefork'
+
+    installed.add('gunicorn')
+    assert wsgi.get_backend(2) == 'gunicorn'
+
+
+def test_pooled_server():
+    """Check that requests are handled concurrently on the pool's threads."""
+    from taswira.scripts.wsgi import PooledWSGIServer
+
+    def app(environ, start_response):
+        time.sleep(0.5)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'ok']
+
+    server = PooledWSGIServer('127.0.0.1', 0, app, threads=4)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def get(_):
+        url = f'http://127.0.0.1:{server.port}/'
+        with urllib.request.urlopen(url) as response:
+            return response.read()
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        responses = list(executor.map(get, range(4)))
+    elapsed = time.time() - start
+    server.shutdown()
+    server.server_close()
+
+    assert responses == [b'ok'] * 4
+    assert elapsed < 1.5
+
+
+def test_prefork_startup_failure(monkeypatch):
+    """Check that the server gives up on workers that can't start."""
+    import signal
+
+    import pytest
+
+    from taswira.scripts import wsgi
+
+    def fail(*args):
+        raise RuntimeError('Broken worker')
+
+    monkeypatch.setattr(wsgi, '_serve_worker', fail)
+    monkeypatch.setattr(wsgi, 'RESPAWN_DELAY', 0)
+    sigterm_handler = signal.getsignal(signal.SIGTERM)
+    try:
+        with pytest.raises(SystemExit):
+            wsgi._serve_prefork(None, '127.0.0.1', 0, 2, 1)
+    finally:
+        signal.signal(signal.SIGTERM, sigterm_handler)
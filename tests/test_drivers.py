@@ -0,0 +1,30 @@
+import threading
+
+
+def test_thread_safe_driver(tmpdir):
+    import terracotta as tc
+
+    from taswira.drivers import use_thread_safe_driver
+
+    dbpath = str(tmpdir.join('db.sqlite'))
+    driver = use_thread_safe_driver(dbpath)
+    driver.create(['title', 'year'])
+    assert tc.get_driver(dbpath) is driver
+
+    errors = []
+
+    def get_keys():
+        try:
+            with driver.connect():
+                driver.get_keys()
+        except Exception as err:  # pylint: disable=broad-except
+            errors.append(err)
+
+    with driver.connect():
+        threads = [threading.Thread(target=get_keys) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert not errors
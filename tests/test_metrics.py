@@ -0,0 +1,74 @@
+import json
+
+
+def test_stage_timings(tmpdir):
+    from taswira.metrics import StageTimings
+
+    path = tmpdir / 'timings.jsonl'
+    with StageTimings(str(path)) as timings:
+        for name in ('a.tif', 'b.tif'):
+            with timings.time('validate', path=name):
+                pass
+        timings.add('insert', 2.0, rasters=2)
+        timings.count('rasters', 2)
+
+    lines = [json.loads(line) for line in path.read_text('utf-8').splitlines()]
+    assert [line.get('stage') for line in lines
+            ] == ['validate', 'validate', 'insert', None]
+    assert lines[1]['path'] == 'b.tif'
+    assert lines[-1]['summary'] == timings.stats()
+    assert timings.stats()['stages']['insert'] == {
+        'count': 1,
+        'total': 2.0,
+        'max': 2.0
+    }
+    assert 'rasters' in timings.summary()
+
+
+def test_histogram():
+    from taswira.metrics import Histogram
+
+    histogram = Histogram([0.1, 1])
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value)
+
+    cumulative, total, count = histogram.collect()
+    assert cumulative == [(0.1, 2), (1, 3), (float('inf'), 4)]
+    assert total == 5.65
+    assert count == 4
+
+
+def test_install_metrics():
+    from flask import Flask
+    from taswira.metrics import install_metrics
+    from taswira.rendering import TileRenderer, install_tile_renderer
+    from taswira.tiles import TileCache, install_tile_cache
+
+    server = Flask(__name__)
+
+    @server.route('/singleband/<path:keys>/<int:z>/<int:x>/<int:y>.png')
+    def get_tile(keys, z, x, y):
+        return keys.encode()
+
+    renderer = TileRenderer(server, threads=1)
+    cache = TileCache(1024)
+    install_metrics(server, renderer, [cache])
+    install_tile_cache(server, cache)
+    install_tile_renderer(server, renderer)
+
+    client = server.test_client()
+    for _ in range(3):
+        assert client.get('/singleband/NPP/2010/3/1/2.png').status_code == 200
+    assert client.get('/missing').status_code == 404
+
+    response = client.get('/metrics')
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    lines = response.get_data(as_text=True).splitlines()
+    assert ('taswira_requests_total{route="/singleband/<path:keys>/<int:z>/'
+            '<int:x>/<int:y>.png",status="200"} 3') in lines
+    assert 'taswira_requests_total{route="unmatched",status="404"} 1' in lines
+    assert 'taswira_tile_request_seconds_count 3' in lines
+    assert 'taswira_tile_render_seconds_count 1' in lines
+    assert 'taswira_tile_cache_hits_total{cache="memory"} 2' in lines
+    assert ('taswira_tile_cache_hit_ratio{cache="memory"} '
+            '0.6666666666666666') in lines
@@ -0,0 +1,70 @@
+import pytest
+
+pytestmark = pytest.mark.parametrize('tile_server',
+                                     [{'years': range(2010, 2015)}],
+                                     indirect=True)
+
+
+def test_prefetch_following(tile_server):
+    from taswira.prefetch import TilePrefetcher, install_prefetcher
+
+    prefetcher = TilePrefetcher(tile_server, tile_server.dbpath, lookahead=2)
+    install_prefetcher(tile_server, prefetcher)
+    client = tile_server.test_client()
+    client.get('/singleband/AG Biomass/2012/3/1/2.png?colormap=greens')
+    client.get('/singleband/AG Biomass/2014/3/1/2.png?colormap=greens')
+    prefetcher.shutdown()
+
+    assert sorted(tile_server.rendered) == [
+        'AG Biomass/2012/3/1/2', 'AG Biomass/2013/3/1/2',
+        'AG Biomass/2014/3/1/2', 'AG Biomass/2014/3/1/2'
+    ]
+
+
+def test_prefetch_viewport(tile_server):
+    from taswira.prefetch import TilePrefetcher, install_prefetcher
+
+    prefetcher = TilePrefetcher(tile_server, tile_server.dbpath, lookahead=1)
+    install_prefetcher(tile_server, prefetcher)
+    client = tile_server.test_client()
+    response = client.get('/prefetch/AG Biomass/2013?bounds=-10,-10,10,10'
+                          '&zoom=1&colormap=greens')
+    prefetcher.shutdown()
+
+    assert response.status_code == 202
+    assert response.get_json()['queued'] == 8
+    assert sorted(tile_server.rendered) == [
+        f'AG Biomass/{year}/1/{x}/{y}' for year in (2013, 2014)
+        for x in (0, 1) for y in (0, 1)
+    ]
+    assert client.get('/prefetch/AG Biomass/2013?zoom=1').status_code == 400
+
+
+def test_prefetch_years_cache(tile_server, monkeypatch):
+    import sqlite3
+
+    from taswira import prefetch
+
+    reads = []
+    get_years = prefetch.get_years
+    monkeypatch.setattr(prefetch, 'get_years',
+                        lambda *args: reads.append(args) or get_years(*args))
+
+    prefetcher = prefetch.TilePrefetcher(tile_server,
+                                         tile_server.dbpath,
+                                         lookahead=1)
+    key = (('AG Biomass', '2011'), (3, 1, 2), {})
+    prefetcher.prefetch_following(key)
+    prefetcher.prefetch_following(key)
+    assert len(reads) == 1
+
+    # The years are read again for the last one, which may have been followed
+    # by new ones since
+    with sqlite3.connect(tile_server.dbpath) as conn:
+        conn.execute("INSERT INTO datasets VALUES ('AG Biomass', '2015', '')")
+    prefetcher.prefetch_following((('AG Biomass', '2014'), (3, 1, 2), {}))
+    prefetcher.shutdown()
+    assert len(reads) == 2
+    assert set(tile_server.rendered) == {
+        'AG Biomass/2012/3/1/2', 'AG Biomass/2015/3/1/2'
+    }
@@ -0,0 +1,53 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytestmark = pytest.mark.parametrize('tile_server', [{'blocking': True}],
+                                     indirect=True)
+
+
+def test_coalescing(tile_server):
+    from taswira.rendering import TileRenderer, install_tile_renderer
+
+    install_tile_renderer(tile_server, TileRenderer(tile_server, threads=2))
+
+    def get(_):
+        client = tile_server.test_client()
+        return client.get('/singleband/NPP/2010/3/1/2.png').data
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        responses = executor.map(get, range(4))
+        threading.Timer(0.5, tile_server.release.set).start()
+        assert list(responses) == [b'NPP/2010/3/1/2'] * 4
+
+    assert tile_server.rendered == ['NPP/2010/3/1/2']
+
+
+def test_render_order(tile_server):
+    from taswira.tiles import get_tile_key
+    from taswira.rendering import TileRenderer
+
+    renderer = TileRenderer(tile_server, threads=1)
+
+    def render(year, prefetch=False):
+        path = f'/singleband/NPP/{year}/3/1/2.png'
+        return renderer.render(get_tile_key(path, {}), path, b'', prefetch)
+
+    blocking = render(2009)
+    while not blocking.running():
+        time.sleep(0.01)
+    passed = render(2010)
+    passed_prefetch = render(2011, prefetch=True)
+    following = render(2013, prefetch=True)
+    current = render(2012)
+    renderer.set_focus('NPP', '2012')
+    tile_server.release.set()
+
+    for future in (blocking, passed, following, current):
+        assert future.result()[0] == 200
+    assert passed_prefetch.cancelled()
+    assert tile_server.rendered == [
+        f'NPP/{year}/3/1/2' for year in (2009, 2012, 2013, 2010)
+    ]
@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+
+
+def test_get_operand_years():
+    from terracotta import exceptions
+
+    from taswira.temporal import get_operand_years
+
+    years = ['2010', '2011', '2012', '2013']
+    assert get_operand_years(years, 'difference', '2010',
+                             '2012') == ['2010', '2012']
+    assert get_operand_years(years, 'sum', '2011',
+                             '2013') == ['2011', '2012', '2013']
+    assert get_operand_years(years, 'sum', '2012',
+                             '2011') == ['2011', '2012']
+
+    with pytest.raises(exceptions.InvalidArgumentsError):
+        get_operand_years(years, 'product', '2010', '2011')
+    with pytest.raises(exceptions.DatasetNotFoundError):
+        get_operand_years(years, 'ratio', '2009', '2011')
+
+
+def test_combine():
+    from taswira.temporal import combine
+
+    start = np.ma.masked_array([1, 2, 0, 4], [False, False, False, True])
+    end = np.ma.masked_array([3, 2, 5, 1], [False, True, False, True])
+
+    difference = combine('difference', [start, end])
+    assert difference.tolist() == [2, None, 5, None]
+
+    ratio = combine('ratio', [start, end])
+    assert ratio.tolist() == [3, None, None, None]
+
+    total = combine('sum', iter([start, end, end]))
+    assert total.tolist() == [7, 2, 10, None]
+
+
+@pytest.fixture
+def temporal_db(tmpdir):
+    """A DB of three years of a 10x10 raster: the second one is twice the
+    first, and the third one is zero.
+    """
+    import rasterio
+    from terracotta import get_driver
+
+    dbpath = str(tmpdir.join('db.sqlite'))
+    driver = get_driver(dbpath, provider='sqlite')
+    driver.create(['title', 'year'])
+
+    data = np.arange(100, dtype='float32').reshape(10, 10)
+    data[0, 0] = -1  # nodata
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'nodata': -1,
+        'width': 10,
+        'height': 10,
+        'count': 1,
+        'crs': 'EPSG:4326',
+        'transform': rasterio.transform.from_origin(10, 50, 1, 1),
+    }
+    with driver.connect():
+        for year, factor in (('2010', 1), ('2011', 2), ('2012', 0)):
+            path = str(tmpdir.join(f'raster_{year}.tiff'))
+            with rasterio.open(path, 'w', **profile) as dst:
+                dst.write(np.where(data < 0, data, data * factor), 1)
+            driver.insert(('NPP', year), path)
+    return dbpath
+
+
+def test_get_temporal_stretch_range(temporal_db):
+    import shutil
+
+    from terracotta import get_driver
+
+    from taswira.scripts.catalog import Catalog, update_catalog
+    from taswira.temporal import get_temporal_stretch_range
+
+    catalog = Catalog(temporal_db)
+    stretch_range = get_temporal_stretch_range(catalog, 'difference', 'NPP',
+                                               '2010', ('2011', ))
+    lower, upper = stretch_range
+    assert 0 < upper <= 99
+    assert lower == -upper
+    assert get_temporal_stretch_range(catalog, 'difference', 'NPP', '2010',
+                                      ('2011', )) is stretch_range
+
+    # Ratios to zero are all masked
+    assert get_temporal_stretch_range(catalog, 'ratio', 'NPP', '2012',
+                                      ('2010', )) == (0, 2)
+    assert get_temporal_stretch_range(catalog, 'sum', 'NPP', '2012',
+                                      ('2012', )) == (-1, 1)
+
+    # Years ingested since the catalog was cached are found
+    path = temporal_db.replace('db.sqlite', 'raster_2013.tiff')
+    shutil.copy(path.replace('2013', '2010'), path)
+    driver = get_driver(temporal_db, provider='sqlite')
+    with driver.connect():
+        driver.insert(('NPP', '2013'), path)
+        metadata = driver.get_metadata(('NPP', '2013'))
+    update_catalog(temporal_db, [(('NPP', '2013'), path, metadata)])
+    assert get_temporal_stretch_range(catalog, 'difference', 'NPP', '2010',
+                                      ('2013', )) == (-1, 1)
+
+
+def test_install_temporal_tiles(temporal_db):
+    import mercantile
+    from flask import Flask
+
+    from taswira.scripts.catalog import Catalog
+    from taswira.temporal import get_temporal_tile_url, install_temporal_tiles
+
+    server = Flask(__name__)
+    install_temporal_tiles(server, Catalog(temporal_db))
+    client = server.test_client()
+
+    tile = mercantile.tile(15, 45, 4)
+    xyz_path = f'{tile.z}/{tile.x}/{tile.y}'
+    options = {'colormap': 'rdbu', 'stretch_range': [-99, 99]}
+    response = client.get(
+        get_temporal_tile_url('difference', 'NPP', '2010', '2011', options,
+                              xyz_path))
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert client.get(f'/temporal/sum/NPP/2010/2012/{xyz_path}.png'
+                      ).status_code == 200
+
+    assert client.get(f'/temporal/product/NPP/2010/2011/{xyz_path}.png'
+                      ).status_code == 400
+    assert client.get(f'/temporal/sum/NPP/2010/2013/{xyz_path}.png'
+                      ).status_code == 404
+    assert client.get(f'/temporal/sum/NPP/2010/2011/{xyz_path}.png'
+                      '?colormap=unknown').status_code == 400
+    assert client.get(f'/temporal/sum/NPP/2010/2011/{xyz_path}.png'
+                      '?stretch_range=[0]').status_code == 400
@@ -0,0 +1,88 @@
+import pytest
+
+
+def test_tile_cache_eviction():
+    from taswira.tiles import TileCache
+
+    cache = TileCache(10)
+    cache.put('a', b'12345')
+    cache.put('b', b'12345')
+    assert cache.get('a') == b'12345'
+    cache.put('c', b'12345')
+
+    assert cache.get('b') is None
+    assert cache.get('a') == b'12345'
+    assert cache.get('c') == b'12345'
+    assert cache.size == 10
+
+    cache.put('d', b'12345678901')
+    assert cache.get('d') is None
+    assert cache.stats()['hits'] == 3
+    assert cache.stats()['misses'] == 2
+
+
+def test_get_tile_key():
+    from taswira.tiles import get_tile_key
+
+    key = get_tile_key('/singleband/NPP/2010/3/1/2.png', {'colormap': 'greens'})
+    assert key == (('NPP', '2010'), (3, 1, 2), (('colormap', 'greens'), ))
+    key = get_tile_key('/temporal/sum/NPP/2010/2012/3/1/2.png', {})
+    assert key == (('sum', 'NPP', '2010', '2012'), (3, 1, 2), ())
+    assert get_tile_key('/singleband/NPP/2010/preview.png', {}) is None
+    assert get_tile_key('/keys', {}) is None
+
+
+def test_install_tile_cache(tile_server):
+    from taswira.tiles import TileCache, install_tile_cache
+
+    install_tile_cache(tile_server, TileCache(1024))
+    client = tile_server.test_client()
+
+    for _ in range(3):
+        response = client.get('/singleband/NPP/2010/3/1/2.png?colormap=greens')
+        assert response.data == b'NPP/2010/3/1/2'
+    client.get('/singleband/NPP/2010/3/1/2.png?colormap=reds')
+
+    assert len(tile_server.rendered) == 2
+    stats = client.get('/tile-cache').get_json()['memory']
+    assert stats['hits'] == 2
+    assert stats['misses'] == 2
+
+
+@pytest.fixture
+def datasets_db(tmpdir):
+    """A DB with a Terracotta-like datasets table of one dataset."""
+    import sqlite3
+
+    raster_path = tmpdir.join('raster.tiff')
+    raster_path.write('raster')
+    dbpath = str(tmpdir.join('db.sqlite'))
+    with sqlite3.connect(dbpath) as conn:
+        conn.execute("CREATE TABLE datasets (title, year, filepath)")
+        conn.execute("INSERT INTO datasets VALUES (?, ?, ?)",
+                     ['NPP', '2010', str(raster_path)])
+
+    return dbpath
+
+
+def test_disk_tile_cache(datasets_db, tmpdir):
+    from taswira.tiles import DiskTileCache
+
+    key = (('NPP', '2010'), (3, 1, 2), ())
+    cache = DiskTileCache(str(tmpdir), 10, datasets_db)
+    cache.put(key, b'12345')
+    cache.put(key[:1] + ((3, 1, 3), ()), b'12345')
+    assert cache.get(key) == b'12345'
+
+    # Tiles are shared between instances
+    other_cache = DiskTileCache(str(tmpdir), 10, datasets_db)
+    assert other_cache.get(key) == b'12345'
+    assert other_cache.get((('NPP', '2011'), (3, 1, 2), ())) is None
+
+    cache.put(key[:1] + ((3, 1, 4), ()), b'12345')
+    cache.evict()
+    assert cache.stats()['size'] == 10
+
+    # Rewriting the raster invalidates its tiles
+    tmpdir.join('raster.tiff').write('new raster')
+    assert cache.get(key) is None
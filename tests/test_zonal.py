@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def zonal_db(tmpdir):
+    """A DB of two years of a 10x10 raster, the second one twice the first."""
+    import rasterio
+    from terracotta import get_driver
+
+    dbpath = str(tmpdir.join('db.sqlite'))
+    driver = get_driver(dbpath, provider='sqlite')
+    driver.create(['title', 'year'])
+
+    data = np.arange(100, dtype='float32').reshape(10, 10)
+    data[0, 0] = -1  # nodata
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'nodata': -1,
+        'width': 10,
+        'height': 10,
+        'count': 1,
+        'crs': 'EPSG:4326',
+        'transform': rasterio.transform.from_origin(10, 50, 1, 1),
+    }
+    with driver.connect():
+        for year, factor in (('2010', 1), ('2011', 2)):
+            path = str(tmpdir.join(f'raster_{year}.tiff'))
+            with rasterio.open(path, 'w', **profile) as dst:
+                dst.write(np.where(data < 0, data, data * factor), 1)
+            driver.insert(('NPP', year), path, skip_metadata=True)
+    return dbpath
+
+
+def test_zonal_stats(zonal_db):
+    from taswira.zonal import ZonalStats
+
+    # Covers the pixels of the first two rows and columns
+    polygon = {
+        'type': 'Polygon',
+        'coordinates': [[[10, 50], [12, 50], [12, 48], [10, 48], [10, 50]]]
+    }
+    zonal_stats = ZonalStats(zonal_db)
+    stats = zonal_stats.get_stats('NPP', polygon)
+    assert stats == {
+        '2010': {'sum': 22, 'mean': 22 / 3, 'count': 3},
+        '2011': {'sum': 44, 'mean': 44 / 3, 'count': 3},
+    }
+    assert zonal_stats.get_stats('NPP', polygon) is stats
+
+    outside = {
+        'type': 'Polygon',
+        'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]
+    }
+    assert zonal_stats.get_stats('NPP', outside)['2010'] == {
+        'sum': None,
+        'mean': None,
+        'count': 0
+    }
+
+
+def test_install_zonal_stats(zonal_db):
+    from flask import Flask
+
+    from taswira.zonal import ZonalStats, install_zonal_stats
+
+    server = Flask(__name__)
+    install_zonal_stats(server, ZonalStats(zonal_db))
+    client = server.test_client()
+
+    feature = {
+        'type': 'Feature',
+        'geometry': {
+            'type': 'Polygon',
+            'coordinates': [[[10, 50], [20, 50], [20, 40], [10, 40],
+                             [10, 50]]]
+        }
+    }
+    response = client.post('/zonal-stats/NPP', json=feature)
+    assert response.get_json()['count'] == [99, 99]
+    assert response.get_json()['sum'] == [4950, 9900]
+
+    point = {'type': 'Point', 'coordinates': [10, 50]}
+    assert client.post('/zonal-stats/NPP', json=point).status_code == 400
+    assert client.post('/zonal-stats/GPP', json=feature).status_code == 404
+
+
+def test_malformed_geometry(zonal_db):
+    from flask import Flask
+
+    from taswira.zonal import ZonalStats, install_zonal_stats
+
+    server = Flask(__name__)
+    install_zonal_stats(server, ZonalStats(zonal_db))
+    client = server.test_client()
+
+    for coordinates in ([[1, 2]], 'abc', [[[1, 2], [3, 4]]],
+                        [[[0, 0], [1, 1], [1, 0], [0, 1], [0, 0]]]):
+        polygon = {'type': 'Polygon', 'coordinates': coordinates}
+        assert client.post('/zonal-stats/NPP',
+                           json=polygon).status_code == 400
+    assert client.post('/zonal-stats/NPP', data='{').status_code == 400
+    assert client.post('/zonal-stats/NPP',
+                       json={
+                           'type': 'Feature',
+                           'geometry': 'abc'
+                       }).status_code == 400